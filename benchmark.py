@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+"""
+性能基准脚本
+
+用法:
+    python benchmark.py                     # requests、render、app 三组基准
+    python benchmark.py requests            # 经模拟服务的请求路径延迟（无需图形界面）
+    python benchmark.py render              # Markdown 渲染
+    python benchmark.py app                 # 完整应用：渲染吞吐、多轮对话延迟和内存增长
+    python benchmark.py startup             # 启动耗时：导入时间和首帧时间
+    python benchmark.py cache               # 长对话的 prompt 缓存命中率：逐轮滑动窗口与分步窗口对比
+    python benchmark.py proxy               # 代理模式：大量本地客户端直接请求与经代理请求对比
+    python benchmark.py --save-baseline     # 把结果保存为基线，之后的运行与之比较
+请求都发往本地模拟服务（mock_server.py），不访问网络。
+render、app、startup 需要可用的图形显示环境。
+与基线相比有指标变差超过 --tolerance 时以退出码 1 结束。
+"""
+
+# benchmark.py - 性能基准
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import tkinter as tk
+
+import openrouter_chat
+from openrouter_chat import ChatEngine, MarkdownRenderer, ProxyServer
+from mock_server import MockServer
+
+
+def make_markdown(blocks):
+    """生成包含标题、段落、列表、表格和代码块的合成 Markdown 文档"""
+    parts = []
+    for i in range(blocks):
+        kind = i % 5
+        if kind == 0:
+            parts.append(f"## 第 {i} 节\n这是一段包含 **粗体**、*斜体* 和 `行内代码` 的普通文字。\n")
+        elif kind == 1:
+            parts.append("\n".join(f"- 列表项 {j}，带有 **强调** 内容" for j in range(5)) + "\n")
+        elif kind == 2:
+            rows = [f"| {j} | 名称{j} | `{j * 3}` |" for j in range(6)]
+            parts.append("| 序号 | 名称 | 数值 |\n|---|---|---|\n" + "\n".join(rows) + "\n")
+        elif kind == 3:
+            code = "\n".join(f"    value_{j} = compute({j}) * 2" for j in range(8))
+            parts.append(f"```python\ndef block_{i}():\n{code}\n```\n")
+        else:
+            parts.append("> 引用内容，用于测试 quote 标签\n")
+    return "\n".join(parts)
+
+
+def chunked(content, size):
+    """按固定长度切分，模拟流式增量"""
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+def legacy_render(text, content, base_tag="assistant"):
+    """旧版渲染实现（逐行、三层 re.split、每个片段一次 insert），作为对照"""
+    def insert_inline(line):
+        for part in re.split(r'(\*\*[^*]+\*\*)', line):
+            if part.startswith('**') and part.endswith('**'):
+                text.insert(tk.END, part[2:-2], ("bold", base_tag))
+                continue
+            for italic_part in re.split(r'(\*[^*]+\*)', part):
+                if italic_part.startswith('*') and italic_part.endswith('*') and len(italic_part) > 2:
+                    text.insert(tk.END, italic_part[1:-1], ("italic", base_tag))
+                    continue
+                for code_part in re.split(r'(`[^`]+`)', italic_part):
+                    if code_part.startswith('`') and code_part.endswith('`'):
+                        text.insert(tk.END, code_part[1:-1], ("code_inline", base_tag))
+                    else:
+                        text.insert(tk.END, code_part, base_tag)
+
+    lines = content.split('\n')
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith('### '):
+            text.insert(tk.END, line[4:] + '\n', ("h3", base_tag))
+        elif line.startswith('## '):
+            text.insert(tk.END, line[3:] + '\n', ("h2", base_tag))
+        elif line.startswith('# '):
+            text.insert(tk.END, line[2:] + '\n', ("h1", base_tag))
+        elif line.strip().startswith('```'):
+            code_lines = []
+            i += 1
+            while i < len(lines) and not lines[i].strip().startswith('```'):
+                code_lines.append(lines[i])
+                i += 1
+            if code_lines:
+                text.insert(tk.END, '\n'.join(code_lines) + '\n', ("code_block", base_tag))
+        elif '|' in line and line.strip().startswith('|') and line.strip().endswith('|'):
+            table_lines = [line]
+            while i + 1 < len(lines) and '|' in lines[i + 1] and lines[i + 1].strip().startswith('|'):
+                i += 1
+                table_lines.append(lines[i])
+            for j, table_line in enumerate(table_lines):
+                if '---' in table_line:
+                    continue
+                cells = [cell.strip() for cell in table_line.split('|')[1:-1]]
+                tag = "table_header" if j == 0 else "table_cell"
+                text.insert(tk.END, ' | '.join(cells) + '\n', (tag, base_tag))
+        elif line.startswith('> '):
+            text.insert(tk.END, line[2:] + '\n', ("quote", base_tag))
+        elif re.match(r'^[\-\*\+]\s+', line) or re.match(r'^\d+\.\s+', line):
+            match = re.match(r'^([\-\*\+]|\d+\.)\s+(.*)', line)
+            text.insert(tk.END, f"• {match.group(2)}\n", ("list_item", base_tag))
+        else:
+            insert_inline(line + '\n')
+        i += 1
+
+
+def bench_full_render(text, sizes=(200, 1000, 3000), repeat=3):
+    """整条消息渲染：旧版逐片段 insert 与新版单遍扫描批量 insert 的对比"""
+    print(f"{'块数':>6} {'字符数':>9} {'旧版(ms)':>10} {'新版(ms)':>10} {'加速':>7}")
+    results = {}
+    for blocks in sizes:
+        content = make_markdown(blocks)
+        timings = []
+        for render in (lambda: legacy_render(text, content),
+                       lambda: MarkdownRenderer(text, "assistant").render(content)):
+            best = float("inf")
+            for _ in range(repeat):
+                text.delete("1.0", tk.END)
+                start = time.perf_counter()
+                render()
+                best = min(best, time.perf_counter() - start)
+            timings.append(best)
+        old, new = timings
+        print(f"{blocks:>6} {len(content):>9} {old * 1000:>10.1f} {new * 1000:>10.1f} {old / new:>6.1f}x")
+        results[f"render.full_{blocks}_ms"] = new * 1000
+    return results
+
+
+def bench_stream_render(text, blocks=300, chunk_size=16, samples=200):
+    """流式渲染：比较增量渲染器与每次整体重绘在消息不同位置的单片段耗时"""
+    content = make_markdown(blocks)
+    chunks = chunked(content, chunk_size)
+    checkpoints = [int(len(chunks) * f) for f in (0.1, 0.5, 0.9)]
+
+    # 增量渲染：逐片段喂入，记录每个片段的耗时
+    text.delete("1.0", tk.END)
+    renderer = MarkdownRenderer(text, "assistant")
+    per_chunk = []
+    for chunk in chunks:
+        start = time.perf_counter()
+        renderer.feed(chunk)
+        per_chunk.append(time.perf_counter() - start)
+    renderer.finish()
+
+    # 整体重绘：每个片段都删除并重新解析到目前为止的全文
+    naive = {}
+    for cp in checkpoints:
+        prefix = "".join(chunks[:cp])
+        start = time.perf_counter()
+        for _ in range(5):
+            text.delete("1.0", tk.END)
+            full = MarkdownRenderer(text, "assistant")
+            full.feed(prefix)
+            full.finish()
+        naive[cp] = (time.perf_counter() - start) / 5
+
+    print(f"流式渲染: {len(content)} 字符, {len(chunks)} 个片段 (每片 {chunk_size} 字符)")
+    print(f"{'位置':>8} {'增量(ms/片)':>14} {'整体重绘(ms/片)':>16}")
+    results = {}
+    for cp in checkpoints:
+        window = per_chunk[max(0, cp - samples // 2):cp + samples // 2]
+        avg = sum(window) / len(window)
+        print(f"{cp * 100 // len(chunks):>7}% {avg * 1000:>14.3f} {naive[cp] * 1000:>16.3f}")
+        results[f"render.stream_{cp * 100 // len(chunks)}pct_ms_per_chunk"] = avg * 1000
+    return results
+
+
+# 在全新的解释器中启动应用，测量各阶段耗时（秒，从脚本开始计时）
+STARTUP_SCRIPT = r"""
+import json, sys, time
+start = time.perf_counter()
+import openrouter_chat
+imported = time.perf_counter()
+root = openrouter_chat.tk.Tk()
+app = openrouter_chat.ChatApp(root)
+built = time.perf_counter()
+root.update()
+painted = time.perf_counter()
+painted_wall = time.time()
+while app.engine.client is None and time.perf_counter() - painted < 30:
+    root.update()
+    time.sleep(0.002)
+client = time.perf_counter()
+app.shutdown()
+root.destroy()
+print(json.dumps({"import": imported - start, "build": built - imported, "paint": painted - start,
+                  "client": client - start, "painted_wall": painted_wall}))
+"""
+
+
+def bench_startup(runs=5):
+    """冷启动：模块导入、窗口构建、首帧和后台客户端就绪的耗时（取中位数）"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # 独立的工作目录，避免读写真实的配置和会话存储；
+        # 填入 API Key 以触发后台客户端创建，地址不可达，预热会很快失败
+        with open(os.path.join(workdir, "chat_config.json"), "w", encoding="utf-8") as f:
+            json.dump({"api_key": "benchmark", "base_url": "http://127.0.0.1:9"}, f)
+        env = dict(os.environ, PYTHONPATH=repo)
+        for _ in range(runs):
+            launched = time.time()
+            result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=workdir, env=env,
+                                    capture_output=True, text=True, check=True)
+            sample = json.loads(result.stdout.strip().splitlines()[-1])
+            sample["launch_to_paint"] = sample["painted_wall"] - launched
+            samples.append(sample)
+
+    print(f"启动耗时（{runs} 次中位数，毫秒）")
+    results = {}
+    for key, label in (("import", "导入 openrouter_chat"), ("build", "构建窗口"),
+                       ("paint", "脚本开始→首帧"), ("launch_to_paint", "进程启动→首帧"),
+                       ("client", "脚本开始→客户端就绪")):
+        value = statistics.median(s[key] for s in samples) * 1000
+        print(f"  {label:<22} {value:>8.1f}")
+        results[f"startup.{key}_ms"] = value
+    return results
+
+
+def percentile(values, q):
+    """已排序列表的 q 分位数"""
+    return values[min(len(values) - 1, len(values) * q // 100)] if values else 0.0
+
+
+def bench_requests(base_url, requests=200, concurrency=16, stream=True):
+    """请求路径：多个会话并发经 ChatEngine（含重试和故障转移）请求模拟服务"""
+    engine = ChatEngine(api_key="benchmark", base_url=base_url, model="mock/model",
+                        max_retries=3, retry_base_delay=0.05, max_connections=concurrency)
+    samples = []
+    failures = 0
+
+    async def worker(indices):
+        nonlocal failures
+        session = engine.fork()
+        for i in indices:
+            submitted = time.perf_counter()
+            try:
+                if stream:
+                    async for _ in session.ask_stream(f"问题 {i}", submitted):
+                        pass
+                else:
+                    await session.ask(f"问题 {i}", submitted)
+            except Exception:
+                failures += 1
+            samples.append(session.last_metrics)
+
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(range(w, requests, concurrency)) for w in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        await engine.aclose()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    ok = [sample for sample in samples if sample["outcome"] == "ok"]
+    latency = sorted(sample["latency"] for sample in ok)
+    ttft = sorted(sample["ttft"] for sample in ok if sample["ttft"] is not None)
+    speed = sorted(sample["tokens_per_s"] for sample in ok if sample["tokens_per_s"])
+    retries = sum(sample["retries"] for sample in samples)
+    mode = "stream" if stream else "nonstream"
+
+    print(f"请求路径（{'流式' if stream else '非流式'}）: {requests} 个请求, 并发 {concurrency}, "
+          f"耗时 {elapsed:.2f} s, {requests / elapsed:.1f} 请求/s, 失败 {failures}, 重试 {retries}")
+    print(f"  {'':<10}{'p50':>10}{'p90':>10}{'p99':>10}")
+    for label, values, scale in (("总耗时 ms", latency, 1000), ("首token ms", ttft, 1000), ("tok/s", speed, 1)):
+        if values:
+            print(f"  {label:<10}" + "".join(f"{percentile(values, q) * scale:>10.1f}" for q in (50, 90, 99)))
+
+    results = {
+        f"requests.{mode}_latency_p50_ms": percentile(latency, 50) * 1000,
+        f"requests.{mode}_latency_p90_ms": percentile(latency, 90) * 1000,
+        f"requests.{mode}_throughput_per_s": requests / elapsed,
+        f"requests.{mode}_failures": failures,
+    }
+    if ttft:
+        results[f"requests.{mode}_ttft_p50_ms"] = percentile(ttft, 50) * 1000
+    return results
+
+
+def bench_prompt_cache(base_url, turns=80, context_tokens=3000, steps=(0.0, 0.5)):
+    """长对话的 prompt 缓存：上下文窗口逐轮滑动与分步前移时的缓存命中率和首 token 时间
+    
+    模拟服务按消息前缀计算缓存命中，并按未命中的 tokens 计算预填充时间。
+    """
+    results = {}
+    print(f"prompt 缓存: {turns} 轮对话, 上下文 {context_tokens} tokens")
+    print(f"  {'窗口':<10}{'命中率':>10}{'首token p50':>14}{'首token p90':>14}")
+    for step in steps:
+        label = "sliding" if step <= 0 else "stepped"
+        engine = ChatEngine(api_key="benchmark", base_url=base_url, model="mock/model",
+                            context_tokens=context_tokens, max_tokens=200, context_step=step,
+                            system_prompt="你是一个简洁的助手。" * 20)
+
+        async def run():
+            samples = []
+            for i in range(turns):
+                # 每组的对话内容不同，避免命中上一组留下的缓存
+                async for _ in engine.ask_stream(f"[{label}] 问题 {i}: " + "请详细说明这一段内容。" * 30):
+                    pass
+                samples.append(engine.last_metrics)
+            await engine.aclose()
+            return samples
+
+        samples = asyncio.run(run())
+        prompt = sum(sample["prompt_tokens"] or 0 for sample in samples)
+        cached = sum(sample["cached_tokens"] or 0 for sample in samples)
+        ttft = sorted(sample["ttft"] for sample in samples)
+        print(f"  {label:<10}{cached / prompt:>10.0%}{percentile(ttft, 50) * 1000:>12.1f}ms"
+              f"{percentile(ttft, 90) * 1000:>12.1f}ms")
+        results[f"cache.{label}_hit_ratio"] = cached / prompt
+        results[f"cache.{label}_ttft_p50_ms"] = percentile(ttft, 50) * 1000
+    return results
+
+
+def bench_proxy(base_url, clients=200, rounds=3):
+    """代理模式：许多本地客户端（各自独立的连接，如同各自运行的脚本）同时请求，
+    对比直接请求上游与经代理（共用连接池，最多 max_connections 个上游连接）时的首 token 时间和吞吐
+    """
+    import httpx
+    results = {}
+    print(f"代理模式: {clients} 个客户端, 每个 {rounds} 个流式请求")
+    print(f"  {'':<10}{'请求/s':>10}{'首token p50':>14}{'首token p90':>14}{'失败':>8}")
+
+    async def client(url, index):
+        ttfts, failures = [], 0
+        async with httpx.AsyncClient(timeout=60) as http:
+            for i in range(rounds):
+                body = {"model": "mock/model", "stream": True,
+                        "messages": [{"role": "user", "content": f"客户端 {index} 问题 {i}"}]}
+                start = time.perf_counter()
+                try:
+                    async with http.stream("POST", url + "/chat/completions", json=body) as response:
+                        response.raise_for_status()
+                        first = None
+                        async for _ in response.aiter_bytes():
+                            if first is None:
+                                first = time.perf_counter() - start
+                    ttfts.append(first)
+                except httpx.HTTPError:
+                    failures += 1
+        return ttfts, failures
+
+    async def run(label):
+        proxy = engine = None
+        url = base_url
+        if label == "proxy":
+            engine = ChatEngine(api_key="benchmark", base_url=base_url, model="mock/model",
+                                max_retries=3, retry_base_delay=0.05)
+            proxy = await ProxyServer(engine, port=0).start()
+            url = f"http://127.0.0.1:{proxy.port}/v1"
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(client(url, index) for index in range(clients)))
+        elapsed = time.perf_counter() - start
+        if proxy is not None:
+            await proxy.close()
+            await engine.aclose()
+        return elapsed, outcomes
+
+    for label in ("direct", "proxy"):
+        elapsed, outcomes = asyncio.run(run(label))
+        ttft = sorted(value for ttfts, _ in outcomes for value in ttfts)
+        failures = sum(failed for _, failed in outcomes)
+        print(f"  {label:<10}{len(ttft) / elapsed:>10.1f}{percentile(ttft, 50) * 1000:>12.1f}ms"
+              f"{percentile(ttft, 90) * 1000:>12.1f}ms{failures:>8}")
+        results[f"proxy.{label}_throughput_per_s"] = len(ttft) / elapsed
+        results[f"proxy.{label}_ttft_p50_ms"] = percentile(ttft, 50) * 1000
+        results[f"proxy.{label}_failures"] = failures
+    return results
+
+
+def memory_usage():
+    """当前进程的常驻内存（字节），不支持的平台返回 None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def bench_app(base_url, turns=2000, checkpoint=500, sizes=(1000, 3000)):
+    """完整应用：parse_and_insert_markdown 的渲染吞吐，以及经界面发送数千轮对话时的延迟和内存增长"""
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    with open("chat_config.json", "w", encoding="utf-8") as f:
+        json.dump({"api_key": "benchmark", "base_url": base_url, "model": "mock/model",
+                   "metrics_file": ""}, f)
+
+    root = tk.Tk()
+    root.withdraw()
+    app = openrouter_chat.ChatApp(root)
+    results = {}
+    try:
+        while app.engine.client is None:
+            root.update()
+            time.sleep(0.001)
+        tab = app.current_tab()
+
+        # 大段回复的渲染吞吐
+        print(f"{'块数':>6} {'字符数':>9} {'耗时(ms)':>10} {'字符/秒':>12}")
+        for blocks in sizes:
+            content = make_markdown(blocks)
+            start = time.perf_counter()
+            tab.parse_and_insert_markdown(content)
+            elapsed = time.perf_counter() - start
+            print(f"{blocks:>6} {len(content):>9} {elapsed * 1000:>10.1f} {len(content) / elapsed:>12.0f}")
+            results[f"app.render_{blocks}_chars_per_s"] = len(content) / elapsed
+        tab.reset_session()
+
+        # 多轮对话：每轮经 send_message 发出，事件循环中完成请求，回到界面线程渲染
+        tracemalloc.start()
+        base_traced = tracemalloc.get_traced_memory()[0]
+        base_rss = memory_usage()
+        latencies = []
+        print(f"\n{'轮数':>6} {'Python 内存(MB)':>16} {'常驻内存(MB)':>14} {'文本行数':>10} {'历史消息':>10}")
+        for i in range(turns):
+            tab.message_entry.insert("1.0", f"问题 {i}")
+            start = time.perf_counter()
+            tab.send_message()
+            while tab.request_active:
+                root.update()
+                time.sleep(0.0005)
+            latencies.append(time.perf_counter() - start)
+            if (i + 1) % checkpoint == 0:
+                traced = (tracemalloc.get_traced_memory()[0] - base_traced) / 2 ** 20
+                rss = memory_usage()
+                rss_growth = (rss - base_rss) / 2 ** 20 if rss and base_rss else float("nan")
+                lines = int(tab.chat_display.index("end-1c").split(".")[0])
+                print(f"{i + 1:>6} {traced:>16.2f} {rss_growth:>14.2f} {lines:>10} {len(tab.engine.history.messages):>10}")
+        traced = tracemalloc.get_traced_memory()[0] - base_traced
+        tracemalloc.stop()
+
+        latencies.sort()
+        print(f"界面往返: p50 {percentile(latencies, 50) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms")
+        results["app.turn_latency_p50_ms"] = percentile(latencies, 50) * 1000
+        results["app.turn_latency_p90_ms"] = percentile(latencies, 90) * 1000
+        results["app.python_kb_per_turn"] = traced / 1024 / turns
+        rss = memory_usage()
+        if rss and base_rss:
+            results["app.rss_kb_per_turn"] = (rss - base_rss) / 1024 / turns
+        results["app.display_lines"] = int(tab.chat_display.index("end-1c").split(".")[0])
+    finally:
+        app.shutdown()
+        root.destroy()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def higher_is_better(name):
+    return name.endswith(("_per_s", "_ratio"))
+
+
+def compare_baseline(results, baseline, tolerance):
+    """与基线比较，变差超过 tolerance（比例）的指标视为回归，返回回归的指标名"""
+    regressions = []
+    print(f"\n{'指标':<44} {'基线':>12} {'本次':>12} {'变化':>9}")
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        change = (value - old) / old if old else 0.0
+        worse = -change if higher_is_better(name) else change
+        regressed = worse > tolerance and abs(value - old) > 1e-9
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<44} {old:>12.2f} {value:>12.2f} {change:>+8.0%} {'✗ 回归' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="性能基准")
+    parser.add_argument("suites", nargs="*", choices=("render", "startup", "requests", "app", "cache", "proxy"),
+                        help="要运行的基准，默认运行 requests、render 和 app")
+    parser.add_argument("--runs", type=int, default=5, help="启动基准的重复次数")
+    parser.add_argument("--requests", type=int, default=200, help="请求路径基准的请求数")
+    parser.add_argument("--concurrency", type=int, default=16, help="请求路径基准的并发会话数")
+    parser.add_argument("--turns", type=int, default=2000, help="应用基准的对话轮数")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟服务首个 token 前的等待秒数")
+    parser.add_argument("--token-rate", type=float, default=500, help="模拟服务每秒 token 数，0 表示不限速")
+    parser.add_argument("--reply-tokens", type=int, default=64, help="模拟服务回复的 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="模拟服务注入 429 错误的概率")
+    parser.add_argument("--clients", type=int, default=200, help="代理基准的本地客户端数")
+    parser.add_argument("--prompt-rate", type=float, default=20000, help="prompt 缓存基准中模拟服务每秒预填充的 tokens")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="基线文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的变差比例，超过视为回归")
+    args = parser.parse_args()
+    suites = args.suites or ["requests", "render", "app"]
+
+    server = MockServer(latency=args.latency, token_rate=args.token_rate, reply_tokens=args.reply_tokens,
+                        error_rate=args.error_rate, seed=0).start()
+    results = {}
+    try:
+        if "requests" in suites:
+            results.update(bench_requests(server.base_url, args.requests, args.concurrency, stream=True))
+            print()
+            results.update(bench_requests(server.base_url, args.requests, args.concurrency, stream=False))
+            print()
+        if "render" in suites:
+            root = tk.Tk()
+            root.withdraw()
+            text = tk.Text(root)
+            results.update(bench_full_render(text))
+            print()
+            results.update(bench_stream_render(text))
+            root.destroy()
+            print()
+        if "app" in suites:
+            # 应用基准不注入错误，只看界面路径本身
+            server.error_rate = 0
+            results.update(bench_app(server.base_url, args.turns))
+            print()
+        if "cache" in suites:
+            server.error_rate = 0
+            server.prompt_rate = args.prompt_rate
+            results.update(bench_prompt_cache(server.base_url))
+            server.prompt_rate = 0
+            print()
+        if "proxy" in suites:
+            server.error_rate = 0
+            results.update(bench_proxy(server.base_url, args.clients))
+            print()
+        if "startup" in suites:
+            results.update(bench_startup(args.runs))
+    finally:
+        server.stop()
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\n基线已保存到 {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} 项指标回归超过 {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
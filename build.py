@@ -7,6 +7,7 @@ Created on Thu Aug  14 14:43:23 2025
 
 # build.py - 构建脚本
 
+import argparse
 import os
 import subprocess
 import sys
@@ -22,14 +23,18 @@ def install_requirements():
         return False
     return True
 
-def build_executable():
-    """构建可执行文件"""
+def build_executable(onedir=False):
+    """构建可执行文件
+    
+    onedir=True 时输出为目录：启动时不必像单文件版本那样先把运行库解压到临时目录，
+    冷启动明显更快，代价是需要分发整个目录。
+    """
     print("正在构建可执行文件...")
     
     # PyInstaller 命令参数
     cmd = [
         "pyinstaller",  # 假设 pyinstaller 已安装到 PATH；如果失败，可改为 [sys.executable, "-m", "PyInstaller", ...]
-        "--onefile",                    # 打包成单个文件
+        "--onedir" if onedir else "--onefile",  # 打包成目录或单个文件
         "--windowed",                   # Windows下不显示控制台窗口
         "--name=OpenRouterChat",        # 可执行文件名称
         "--distpath=dist",              # 输出目录
@@ -43,13 +48,22 @@ def build_executable():
     try:
         subprocess.check_call(cmd)
         print("可执行文件构建完成!")
-        print("可执行文件位置: dist/OpenRouterChat.exe")
+        print(f"可执行文件位置: {executable_path(onedir)}")
         return True
     except subprocess.CalledProcessError as e:
         print(f"构建失败: {e}")
         return False
 
+def executable_path(onedir):
+    """构建产物中可执行文件的位置"""
+    return "dist/OpenRouterChat/OpenRouterChat.exe" if onedir else "dist/OpenRouterChat.exe"
+
 def main():
+    parser = argparse.ArgumentParser(description="OpenRouter 聊天软件构建工具")
+    parser.add_argument("--onedir", action="store_true",
+                        help="输出为目录而不是单个文件（启动更快，无需每次解压）")
+    args = parser.parse_args()
+    
     print("OpenRouter 聊天软件构建工具")
     print("=" * 40)
     
@@ -64,10 +78,13 @@ def main():
         return
     
     # 构建可执行文件
-    if build_executable():
+    if build_executable(args.onedir):
         print("\n构建成功!")
-        print("你可以在 dist/ 目录下找到 OpenRouterChat.exe")
-        print("这是一个 portable 版本，可以直接运行，无需安装 Python")
+        print(f"你可以在 {executable_path(args.onedir)} 找到可执行文件")
+        if args.onedir:
+            print("请分发整个 dist/OpenRouterChat/ 目录，可以直接运行，无需安装 Python")
+        else:
+            print("这是一个 portable 版本，可以直接运行，无需安装 Python")
     else:
         print("\n构建失败!")
 
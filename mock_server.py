@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+本地模拟 OpenAI 兼容服务
+
+用法: python mock_server.py [--port 8765] [--latency 0.2] [--token-rate 50] [--error-rate 0.05] [--prompt-rate 20000] [--rate-limit 20]
+提供 /v1/models 和 /v1/chat/completions（流式和非流式），用于离线测试和性能基准。
+按消息前缀模拟服务端 prompt 缓存，命中的 tokens 在 usage.prompt_tokens_details.cached_tokens 中返回。
+--rate-limit 模拟 OpenRouter 的每分钟请求数限制：响应带 X-RateLimit-* 头，超出时返回 429。
+把 chat_config.json 中的 base_url 设为 http://127.0.0.1:8765/v1 即可让应用连接到这里。
+"""
+
+# mock_server.py - 模拟服务
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 默认回复模板，按空白切分后逐个作为 token 发送
+REPLY_TEMPLATE = (
+    "## 模拟回复\n"
+    "这是一段来自 **模拟服务** 的回复，包含 *斜体* 和 `行内代码`。\n"
+    "- 第一项 说明\n"
+    "- 第二项 说明\n"
+    "| 名称 | 数值 |\n|---|---|\n| alpha | 1 |\n| beta | 2 |\n"
+    "```python\nprint('hello')\n```\n"
+)
+
+
+def make_reply(tokens):
+    """把回复模板重复到指定的 token 数，返回 token 列表"""
+    template = [piece for piece in REPLY_TEMPLATE.replace("\n", " \n ").split(" ") if piece]
+    pieces = (template * (tokens // len(template) + 1))[:tokens]
+    return [piece if piece == "\n" else piece + " " for piece in pieces]
+
+
+def message_text(message):
+    """消息的文本内容；content 为分段列表（带 cache_control 断点）时拼接各段文本"""
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content)
+    return str(content)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    limit_headers = {}    # 当前请求的限速响应头
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in dict(headers or {}, **self.limit_headers).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        # 兼容带或不带 /v1 前缀的地址
+        path = self.path.split("?")[0]
+        return path[3:] if path.startswith("/v1/") else path
+
+    def do_GET(self):
+        self.limit_headers = {}
+        if self.route() == "/models":
+            self.send_json(200, {"data": [self.server.mock.model_info(model) for model in self.server.mock.models]})
+        else:
+            self.send_json(404, {"error": {"message": "not found", "code": 404}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.route() != "/chat/completions":
+            self.send_json(404, {"error": {"message": "not found", "code": 404}})
+            return
+        mock = self.server.mock
+        request = json.loads(body)
+        mock.count("requests")
+        
+        # 限速
+        allowed, self.limit_headers = mock.rate_limit_check()
+        if not allowed:
+            mock.count("rate_limited")
+            self.send_json(429, {"error": {"message": "rate limit exceeded", "code": 429}})
+            return
+
+        # 错误注入
+        if mock.error_rate and mock.random.random() < mock.error_rate:
+            mock.count("errors")
+            headers = {"Retry-After": str(mock.retry_after)} if mock.error_status == 429 else None
+            self.send_json(mock.error_status, {"error": {"message": "injected error", "code": mock.error_status}}, headers)
+            return
+
+        prompt_tokens, cached_tokens = mock.prompt_cache(request["model"], request["messages"])
+        # 未命中缓存的部分按 prompt_rate 计算预填充时间
+        delay = mock.latency + ((prompt_tokens - cached_tokens) / mock.prompt_rate if mock.prompt_rate else 0)
+        if delay:
+            time.sleep(delay)
+        tokens = make_reply(min(request.get("max_tokens") or mock.reply_tokens, mock.reply_tokens))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens),
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+        if request.get("stream"):
+            self.stream_reply(request, tokens, usage)
+        else:
+            if mock.token_rate:
+                time.sleep(len(tokens) / mock.token_rate)
+            try:
+                self.send_json(200, {
+                    "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": request["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                                 "finish_reason": "stop"}],
+                    "usage": usage
+                })
+            except (BrokenPipeError, ConnectionResetError):
+                mock.count("cancelled")
+
+    def stream_reply(self, request, tokens, usage):
+        """以 SSE 分块发送，每个 token 一个数据块，按 token_rate 控制速度"""
+        mock = self.server.mock
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in self.limit_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        def send_event(data):
+            payload = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            self.wfile.flush()
+
+        chunk = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                 "model": request["model"]}
+        try:
+            for token in tokens:
+                send_event(json.dumps(dict(chunk, choices=[{"index": 0, "delta": {"content": token},
+                                                            "finish_reason": None}]), ensure_ascii=False))
+                if mock.token_rate:
+                    time.sleep(1 / mock.token_rate)
+            if (request.get("stream_options") or {}).get("include_usage"):
+                send_event(json.dumps(dict(chunk, choices=[], usage=usage)))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中途取消
+            mock.count("cancelled")
+
+
+class MockServer:
+    """模拟 OpenAI 兼容服务，在后台线程中运行
+
+    latency: 每个请求返回前的等待秒数；token_rate: 每秒发送的 token 数（0 表示不限速）；
+    reply_tokens: 回复的 token 数上限；error_rate: 注入错误的概率，错误状态码为 error_status；
+    prompt_rate: 每秒预填充的 prompt token 数（0 表示不计预填充时间），命中缓存的部分不计；
+    cache_min_tokens: 命中的前缀至少有这么多 tokens 才算缓存命中；
+    rate_limit: 每 rate_window 秒最多接受的请求数（0 表示不限），按固定时间窗口计数。
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, token_rate=0, reply_tokens=64,
+                 error_rate=0.0, error_status=429, retry_after=0.05, models=("mock/model",), seed=None,
+                 prompt_rate=0, cache_min_tokens=0, cache_entries=100000, rate_limit=0, rate_window=60):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.models = list(models)
+        self.random = random.Random(seed)
+        self.prompt_rate = prompt_rate
+        self.cache_min_tokens = cache_min_tokens
+        self.cache_entries = cache_entries
+        self.prefixes = OrderedDict()    # 见过的消息前缀的哈希
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.window_start = 0.0
+        self.window_count = 0
+        self.stats = {"requests": 0, "errors": 0, "cancelled": 0, "rate_limited": 0,
+                      "prompt_tokens": 0, "cached_tokens": 0}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def rate_limit_check(self):
+        """计入一个请求，返回 (是否接受, 限速响应头)"""
+        if not self.rate_limit:
+            return True, {}
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_count = 0
+            allowed = self.window_count < self.rate_limit
+            if allowed:
+                self.window_count += 1
+            reset = self.window_start + self.rate_window
+        headers = {"X-RateLimit-Limit": str(self.rate_limit),
+                   "X-RateLimit-Remaining": str(self.rate_limit - self.window_count),
+                   "X-RateLimit-Reset": str(int(reset * 1000))}
+        return allowed, headers
+
+    def prompt_cache(self, model, messages):
+        """按消息前缀模拟 prompt 缓存，返回 (prompt tokens, 命中缓存的 tokens)
+        
+        与之前某个请求开头若干条消息完全相同的前缀视为命中（只比较角色和文本，忽略 cache_control）。
+        """
+        digest = hashlib.sha1(model.encode("utf-8"))
+        total = cached = 0
+        hit = True
+        with self.lock:
+            for message in messages:
+                text = message_text(message)
+                digest.update(json.dumps([message.get("role"), text], ensure_ascii=False).encode("utf-8"))
+                key = digest.hexdigest()
+                total += len(text) // 4 + 1
+                if hit and key in self.prefixes:
+                    cached = total
+                    self.prefixes.move_to_end(key)
+                else:
+                    hit = False
+                    self.prefixes[key] = True
+            while len(self.prefixes) > self.cache_entries:
+                self.prefixes.popitem(last=False)
+            if cached < self.cache_min_tokens:
+                cached = 0
+            self.stats["prompt_tokens"] += total
+            self.stats["cached_tokens"] += cached
+        return total, cached
+
+    def model_info(self, model):
+        return {"id": model, "name": model, "context_length": 32768,
+                "top_provider": {"context_length": 32768, "max_completion_tokens": 4096},
+                "pricing": {"prompt": "0", "completion": "0"}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 OpenAI 兼容服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="首个 token 前的等待秒数")
+    parser.add_argument("--token-rate", type=float, default=0, help="每秒 token 数，0 表示不限速")
+    parser.add_argument("--reply-tokens", type=int, default=64, help="回复的 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="注入错误的概率 (0-1)")
+    parser.add_argument("--error-status", type=int, default=429, help="注入错误的 HTTP 状态码")
+    parser.add_argument("--prompt-rate", type=float, default=0, help="每秒预填充的 prompt token 数，0 表示不计")
+    parser.add_argument("--cache-min-tokens", type=int, default=0, help="计为缓存命中的最短前缀 tokens")
+    parser.add_argument("--rate-limit", type=int, default=0, help="每分钟接受的请求数，0 表示不限")
+    parser.add_argument("--model", action="append", dest="models", help="/models 中列出的模型，可重复")
+    args = parser.parse_args()
+
+    server = MockServer(args.host, args.port, latency=args.latency, token_rate=args.token_rate,
+                        reply_tokens=args.reply_tokens, error_rate=args.error_rate,
+                        error_status=args.error_status, models=args.models or ("mock/model",),
+                        prompt_rate=args.prompt_rate, cache_min_tokens=args.cache_min_tokens,
+                        rate_limit=args.rate_limit)
+    print(f"模拟服务已启动: {server.base_url}  (Ctrl+C 退出)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
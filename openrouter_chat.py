@@ -8,14 +8,3023 @@ Created on Thu Aug  14 14:43:23 2025
 # openrouter_chat.py
 
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
+from tkinter import ttk, scrolledtext, messagebox, filedialog
 import threading
+import asyncio
+import argparse
+import codecs
+import contextvars
+import copy
+import hashlib
 import json
 import os
+import sys
 import re
-from openai import OpenAI
+import importlib.util
+import itertools
+import random
+import sqlite3
+import tempfile
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import time
 from datetime import datetime
 
+# openai（连同 httpx、pydantic）导入较慢，由 import_openai() 在第一次创建客户端时加载，
+# 这样界面可以先显示出来
+httpx = None
+AsyncOpenAI = DefaultAsyncHttpxClient = NotFoundError = APIStatusError = None
+# 可以重试或切换模型的错误：429、5xx、超时和连接错误（导入 openai 后填入）
+RETRYABLE_ERRORS = ()
+openai_lock = threading.Lock()
+
+DEFAULT_CONFIG = {
+    "api_key": "",
+    "base_url": "https://openrouter.ai/api/v1",
+    "model": "openai/gpt-oss-20b:free",
+    "max_tokens": 1000,
+    "temperature": 0.7,
+    "context_tokens": 8192,
+    "model_context_tokens": {},
+    "stream": True,
+    "http2": False,
+    "max_connections": 20,
+    "keepalive_expiry": 120,
+    "request_timeout": 60,
+    "max_retries": 2,
+    "retry_base_delay": 1.0,
+    "fallback_models": [],
+    "hedge_delay": 0,
+    "transcript_window": 200,
+    "response_cache": False,
+    "cache_models": [],
+    "cache_zero_temperature_only": False,
+    "cache_ttl": 86400,
+    "cache_max_mb": 50,
+    "cache_memory_items": 256,
+    "catalog_ttl": 86400,
+    "metrics_file": "metrics.jsonl",
+    "metrics_window": 500,
+    "document_chunk_tokens": 4000,
+    "document_concurrency": 4,
+    "paste_attachment_chars": 20000,
+    "syntax_highlight": True,
+    "system_prompt": "",
+    "context_step": 0.5,
+    "cache_control_models": ["anthropic/"],
+    "rate_limits": {":free": [20, 60]},
+    "key_rate_limit": [],
+    "diagnostics": False,
+    "stall_threshold": 0.2,
+    "diagnostics_file": "diagnostics.txt",
+    "theme": "light"
+}
+
+# 模型目录尚未获取时使用的内置模型列表
+DEFAULT_MODELS = (
+    "openai/gpt-oss-20b:free", 
+    "x-ai/grok-4-fast:free",
+    "deepseek/deepseek-chat-v3-0324:free",
+    "deepseek/deepseek-r1-0528:free",
+    "qwen/qwen3-coder:free",
+    "qwen/qwen3-235b-a22b:free",
+    "moonshotai/kimi-k2:free",
+    "mistralai/mistral-small-3.2-24b-instruct:free",
+    "mistralai/devstral-small-2505:free",
+    "tencent/hunyuan-a13b-instruct:free",
+    "z-ai/glm-4.5-air:free",
+    "meta-llama/llama-3.3-70b-instruct:free",
+    "cognitivecomputations/dolphin-mistral-24b-venice-edition:free",
+)
+
+def read_config(path):
+    """读取配置文件，缺失的项使用默认值"""
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    try:
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                config.update(json.load(f))
+    except Exception as e:
+        print(f"配置文件加载失败: {e}")
+    return config
+
+class MarkdownRenderer:
+    """增量 Markdown 渲染器
+    
+    按片段喂入文本，在多次调用之间保留块级状态（代码块、表格），
+    已完成的行只插入一次；只有尚未换行的末尾片段会被删除并重绘，
+    因此每个片段的开销与消息已有长度无关。
+    """
+    
+    _LIST_RE = re.compile(r'^([\-\*\+]|\d+\.)\s+(.*)')
+    # 行内格式单遍扫描：粗体 | 斜体 | 行内代码，同一位置按此顺序优先
+    _INLINE_RE = re.compile(r'\*\*([^*]+)\*\*|\*([^*]+)\*|`([^`]+)`')
+    _INLINE_TAGS = (None, "bold", "italic", "code_inline")
+    _ids = itertools.count()
+    
+    def __init__(self, text_widget, base_tag="assistant", index=tk.END, on_code=None):
+        self.text = text_widget
+        self.base_tag = base_tag
+        # 代码块结束时的回调 (块标签, 语言, 代码)，用于语法高亮；
+        # 设置后每个代码块的文本额外带一个唯一的块标签
+        self.on_code = on_code
+        
+        # 插入点使用右引力标记，插入后自动后移
+        n = next(self._ids)
+        self.insert_mark = f"md_insert{n}"
+        self.tail_mark = f"md_tail{n}"
+        self.text.mark_set(self.insert_mark, "end-1c" if index == tk.END else index)
+        self.text.mark_gravity(self.insert_mark, tk.RIGHT)
+        
+        # 块级状态
+        self.pending = ""       # 尚未遇到换行的末行
+        self.tail_drawn = False
+        self.in_code = False
+        self.table_row = -1     # 当前表格行号，-1 表示不在表格中
+        self.code_tag = None
+        self.code_lang = ""
+        self.code_lines = []
+
+    def feed(self, fragment):
+        """喂入一段文本，渲染新完成的行并重绘末行"""
+        self._clear_tail()
+        self._insert_runs(self._complete_lines(fragment))
+        
+        if self.pending:
+            self.text.mark_set(self.tail_mark, self.insert_mark)
+            self.text.mark_gravity(self.tail_mark, tk.LEFT)
+            self._insert_runs(self._line_runs(self.pending, commit=False))
+            self.tail_drawn = True
+
+    def finish(self):
+        """结束渲染：提交末行并释放标记"""
+        self._clear_tail()
+        self._insert_runs(self._line_runs(self.pending, commit=True))
+        self._close()
+
+    def render(self, content):
+        """一次性渲染完整内容，只调用一次 insert"""
+        runs = self._complete_lines(content)
+        runs.extend(self._line_runs(self.pending, commit=True))
+        self._insert_runs(runs)
+        self._close()
+
+    def _close(self):
+        # 没有结束围栏的代码块在内容结束处结束
+        if self.in_code:
+            self._end_code()
+        self.pending = ""
+        self.text.mark_unset(self.insert_mark, self.tail_mark)
+
+    def _end_code(self):
+        """通知代码块结束（回调在块文本插入之前调用，使用方应延后处理）"""
+        if self.code_tag is not None and self.code_lines:
+            self.on_code(self.code_tag, self.code_lang, "\n".join(self.code_lines) + "\n")
+        self.code_tag = None
+
+    def _complete_lines(self, fragment):
+        """拼接末行与新片段，返回所有已完成行的片段，剩余部分留作末行"""
+        lines = (self.pending + fragment).split('\n')
+        self.pending = lines.pop()
+        runs = []
+        for line in lines:
+            runs.extend(self._line_runs(line, commit=True))
+        return runs
+
+    def _clear_tail(self):
+        """删除上次绘制的临时末行"""
+        if self.tail_drawn:
+            self.text.delete(self.tail_mark, self.insert_mark)
+            self.tail_drawn = False
+
+    def _insert_runs(self, runs):
+        """把 (文本, 标签) 片段合并为一次多段 insert 调用，减少 Tcl 往返"""
+        if not runs:
+            return
+        args = []
+        last_tags = None
+        for chars, tags in runs:
+            # 相邻且标签相同的片段直接拼接
+            if tags == last_tags:
+                args[-2] += chars
+            else:
+                args += [chars, tags]
+                last_tags = tags
+        self.text.insert(self.insert_mark, *args)
+
+    def _line_runs(self, line, commit):
+        """把一行（不含换行符）转换为 (文本, 标签) 片段，commit 时更新块级状态"""
+        base = self.base_tag
+        stripped = line.strip()
+        in_code, table_row = self.in_code, self.table_row
+        runs = []
+        
+        # 代码块内部：直到结束围栏
+        if in_code:
+            if stripped.startswith('```'):
+                in_code = False
+                if commit:
+                    self._end_code()
+            else:
+                tags = ("code_block", base) if self.code_tag is None else ("code_block", self.code_tag, base)
+                runs.append((line + '\n', tags))
+                if commit and self.code_tag is not None:
+                    self.code_lines.append(line)
+        
+        # 表格续行
+        elif table_row >= 0 and '|' in line and stripped.startswith('|'):
+            table_row += 1
+            runs = self._table_runs(line, table_row)
+        
+        else:
+            table_row = -1
+            
+            # 处理标题
+            if line.startswith('### '):
+                runs.append((line[4:] + '\n', ("h3", base)))
+            elif line.startswith('## '):
+                runs.append((line[3:] + '\n', ("h2", base)))
+            elif line.startswith('# '):
+                runs.append((line[2:] + '\n', ("h1", base)))
+            
+            # 代码块开始，围栏后面是语言名
+            elif stripped.startswith('```'):
+                in_code = True
+                if commit and self.on_code is not None:
+                    self.code_tag = f"codeblk{next(self._ids)}"
+                    self.code_lang = stripped[3:].strip().lower()
+                    self.code_lines = []
+            
+            # 表格开始
+            elif '|' in line and stripped.startswith('|') and stripped.endswith('|'):
+                table_row = 0
+                runs = self._table_runs(line, table_row)
+            
+            # 处理引用
+            elif line.startswith('> '):
+                runs.append((line[2:] + '\n', ("quote", base)))
+            
+            # 处理列表
+            elif self._LIST_RE.match(line):
+                content_text = self._LIST_RE.match(line).group(2)
+                runs.append((f"• {content_text}\n", ("list_item", base)))
+            
+            # 处理普通段落（包含行内格式）
+            else:
+                runs = self._inline_runs(line + '\n')
+        
+        if commit:
+            self.in_code, self.table_row = in_code, table_row
+        return runs
+
+    def _table_runs(self, line, row):
+        """渲染表格行，第 0 行为表头，分隔行跳过"""
+        if '---' in line:
+            return []
+        cells = [cell.strip() for cell in line.split('|')[1:-1]]  # 去掉首尾的空元素
+        tag = "table_header" if row == 0 else "table_cell"
+        return [(' | '.join(cells) + '\n', (tag, self.base_tag))]
+
+    def _inline_runs(self, text):
+        """单遍扫描行内Markdown格式，返回扁平的 (文本, 标签) 片段列表"""
+        base = self.base_tag
+        runs = []
+        pos = 0
+        for match in self._INLINE_RE.finditer(text):
+            start = match.start()
+            if start > pos:
+                runs.append((text[pos:start], (base,)))
+            group = match.lastindex
+            runs.append((match.group(group), (self._INLINE_TAGS[group], base)))
+            pos = match.end()
+        if pos < len(text):
+            runs.append((text[pos:], (base,)))
+        return runs
+
+class CodeHighlighter:
+    """代码块语法高亮（需要可选依赖 Pygments）
+    
+    渲染器在代码块结束时登记 (块标签, 语言, 代码)。只有进入可见区域附近（上下各一屏）
+    的块才提交到后台线程做词法分析，结果按代码和语言的哈希缓存，重新渲染时不再分析。
+    着色在主线程中按 token 类型批量 tag_add，每次调度只处理几毫秒，
+    长代码块分多次完成，不会阻塞界面。
+    """
+    
+    # (Pygments token 类型前缀, 标签, 浅色, 深色)，按顺序取第一个匹配
+    STYLES = (
+        ("Token.Comment", "hl_comment", "#6a737d", "#8b949e"),
+        ("Token.Keyword", "hl_keyword", "#d73a49", "#ff7b72"),
+        ("Token.Name.Builtin", "hl_builtin", "#005cc5", "#79c0ff"),
+        ("Token.Name.Function", "hl_function", "#6f42c1", "#d2a8ff"),
+        ("Token.Name.Class", "hl_function", "#6f42c1", "#d2a8ff"),
+        ("Token.Name.Decorator", "hl_function", "#6f42c1", "#d2a8ff"),
+        ("Token.Name.Tag", "hl_keyword", "#d73a49", "#ff7b72"),
+        ("Token.Name.Attribute", "hl_builtin", "#005cc5", "#79c0ff"),
+        ("Token.Literal.String", "hl_string", "#032f62", "#a5d6ff"),
+        ("Token.Literal.Number", "hl_number", "#005cc5", "#79c0ff"),
+        ("Token.Operator", "hl_operator", "#d73a49", "#ff7b72"),
+    )
+    # 每次 tag_add 的最多区间数，和每次调度的时间预算（秒）
+    BATCH = 1000
+    BUDGET = 0.008
+    
+    # 词法分析结果缓存，所有标签页共用
+    memo = OrderedDict()
+    memo_size = 256
+    memo_lock = threading.Lock()
+    token_tags = {}
+    
+    def __init__(self, text_widget, root, executor):
+        self.text = text_widget
+        self.root = root
+        self.executor = executor
+        self.blocks = OrderedDict()     # 块标签 -> (语言, 代码)，尚未提交分析
+        self.jobs = deque()             # 待着色的 (块标签, 高亮标签, 区间)
+        self.scheduled = False
+        self.applying = False
+
+    @staticmethod
+    def available():
+        return importlib.util.find_spec("pygments") is not None
+
+    def configure_tags(self, dark=False):
+        """创建（或按主题更新）高亮标签的颜色"""
+        for prefix, tag, light_color, dark_color in self.STYLES:
+            self.text.tag_configure(tag, foreground=dark_color if dark else light_color)
+
+    @classmethod
+    def token_tag(cls, ttype):
+        tag = cls.token_tags.get(ttype, False)
+        if tag is False:
+            name = str(ttype)
+            tag = next((tag for prefix, tag, *colors in cls.STYLES
+                        if name == prefix or name.startswith(prefix + ".")), None)
+            cls.token_tags[ttype] = tag
+        return tag
+
+    @classmethod
+    def lex(cls, language, code):
+        """词法分析（在后台线程中运行），返回 {高亮标签: [(行, 列, 结束行, 结束列), ...]}，行号从 0 开始"""
+        key = hashlib.sha1(f"{language}\0{code}".encode("utf-8")).hexdigest()
+        with cls.memo_lock:
+            if key in cls.memo:
+                cls.memo.move_to_end(key)
+                return cls.memo[key]
+        
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+        spans = {}
+        try:
+            # 不去掉首尾空行，保证位置与文本控件中的内容一致
+            lexer = get_lexer_by_name(language, stripnl=False, ensurenl=False)
+        except ClassNotFound:
+            lexer = None
+        if lexer is not None:
+            line = col = 0
+            for ttype, value in lexer.get_tokens(code):
+                newlines = value.count("\n")
+                if newlines:
+                    end_line, end_col = line + newlines, len(value) - value.rfind("\n") - 1
+                else:
+                    end_line, end_col = line, col + len(value)
+                tag = cls.token_tag(ttype)
+                if tag is not None and not value.isspace():
+                    spans.setdefault(tag, []).append((line, col, end_line, end_col))
+                line, col = end_line, end_col
+        
+        with cls.memo_lock:
+            cls.memo[key] = spans
+            while len(cls.memo) > cls.memo_size:
+                cls.memo.popitem(last=False)
+        return spans
+
+    def add(self, block_tag, language, code):
+        """渲染器回调：登记一个已结束的代码块"""
+        self.blocks[block_tag] = (language, code)
+        self.schedule()
+
+    def schedule(self):
+        """在空闲时检查哪些待着色的块进入了可见区域（滚动和插入时调用）"""
+        if self.blocks and not self.scheduled:
+            self.scheduled = True
+            self.root.after_idle(self.check)
+
+    def check(self):
+        self.scheduled = False
+        if not self.text.winfo_exists():
+            # 所在的标签页或窗口已关闭
+            self.blocks.clear()
+            return
+        top = int(self.text.index("@0,0").split(".")[0])
+        bottom = int(self.text.index(f"@0,{self.text.winfo_height()}").split(".")[0])
+        margin = bottom - top + 1
+        for block_tag, (language, code) in list(self.blocks.items()):
+            ranges = self.text.tag_ranges(block_tag)
+            if not ranges or not language:
+                # 没有语言名，或所在消息已移出渲染窗口（重新渲染时会重新登记）
+                del self.blocks[block_tag]
+                self.text.tag_delete(block_tag)
+                continue
+            first = int(str(ranges[0]).split(".")[0])
+            last = int(str(ranges[-1]).split(".")[0])
+            if last < top - margin or first > bottom + margin:
+                continue
+            del self.blocks[block_tag]
+            future = self.executor.submit(self.lex, language, code)
+            future.add_done_callback(lambda f, block_tag=block_tag: self.root.after(0, lambda: self.apply(block_tag, f)))
+
+    def apply(self, block_tag, future):
+        """分析完成（主线程）：把着色任务按批排队"""
+        try:
+            spans = future.result()
+        except Exception as e:
+            print(f"语法高亮失败: {e}")
+            spans = {}
+        for tag, tag_spans in spans.items():
+            for i in range(0, len(tag_spans), self.BATCH):
+                self.jobs.append((block_tag, tag, tag_spans[i:i + self.BATCH]))
+        # 最后删除块标签
+        self.jobs.append((block_tag, None, None))
+        if not self.applying:
+            self.applying = True
+            self.root.after(0, self.apply_jobs)
+
+    def apply_jobs(self):
+        """在时间预算内执行若干批 tag_add，剩余的留到下一次调度"""
+        if not self.text.winfo_exists():
+            self.jobs.clear()
+            self.applying = False
+            return
+        deadline = time.perf_counter() + self.BUDGET
+        while self.jobs and time.perf_counter() < deadline:
+            block_tag, tag, spans = self.jobs.popleft()
+            # 每批重新取块的位置：两批之间上方可能插入或删除了消息
+            ranges = self.text.tag_ranges(block_tag)
+            if tag is None or not ranges:
+                self.text.tag_delete(block_tag)
+                continue
+            base = int(str(ranges[0]).split(".")[0])
+            indices = []
+            for line, col, end_line, end_col in spans:
+                indices += (f"{base + line}.{col}", f"{base + end_line}.{end_col}")
+            self.text.tag_add(tag, *indices)
+        if self.jobs:
+            self.root.after(1, self.apply_jobs)
+        else:
+            self.applying = False
+
+_CJK_RE = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]')
+# 每条消息的角色与格式开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text):
+    """粗略估算文本的 token 数：CJK 字符约 1 字 1 token，其余约 4 字符 1 token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def format_wait(seconds):
+    """把等待秒数格式化为秒、分钟或小时"""
+    if seconds < 60:
+        return f"{max(seconds, 1):.0f} 秒"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} 分钟"
+    return f"{seconds / 3600:.1f} 小时"
+
+def remove_file(path):
+    """删除文件，失败时只打印提示"""
+    try:
+        os.remove(path)
+    except OSError as e:
+        print(f"文件删除失败: {e}")
+
+def read_chunks(path, max_tokens, block=65536):
+    """流式读取文本文件，按估算的 token 数切块，逐块产出 (文本, 已读字节数)
+    
+    按行累积，单行超过上限时按字符切开；任何时候内存中只有一块。
+    编码为 UTF-8（可带 BOM）；开头或中途遇到无法按 UTF-8 解码的字节时，从该处起按 GB18030 读取。
+    """
+    with open(path, 'rb') as f:
+        head = f.read(block)
+        f.seek(0)
+        encoding = "utf-8-sig" if head.startswith(codecs.BOM_UTF8) else "utf-8"
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(head)
+        except UnicodeDecodeError:
+            encoding = "gb18030"
+        decoder = codecs.getincrementaldecoder(encoding)(errors="strict" if encoding != "gb18030" else "replace")
+        
+        def decode(raw, final=False):
+            nonlocal decoder
+            try:
+                return decoder.decode(raw, final)
+            except UnicodeDecodeError:
+                # 出错时解码器缓冲的不完整字节不变，连同本行一起改用 GB18030
+                pending = decoder.getstate()[0]
+                decoder = codecs.getincrementaldecoder("gb18030")(errors="replace")
+                return decoder.decode(pending + raw, final)
+        
+        parts, tokens, read = [], 0, 0
+        for raw in iter(lambda: f.readline(block), b""):
+            read += len(raw)
+            line = decode(raw)
+            line_tokens = estimate_tokens(line)
+            if parts and tokens + line_tokens > max_tokens:
+                yield "".join(parts), read - len(raw)
+                parts, tokens = [], 0
+            # 超长的行切开后按字符比例估算每一段结束处的字节位置
+            length = len(line)
+            while line_tokens > max_tokens:
+                cut = len(line) * max_tokens // line_tokens
+                yield line[:cut], read - len(raw) + len(raw) * (length - len(line) + cut) // length
+                line = line[cut:]
+                line_tokens = estimate_tokens(line)
+            parts.append(line)
+            tokens += line_tokens
+        parts.append(decode(b"", final=True))
+        if any(parts):
+            yield "".join(parts), read
+
+class ChatHistory:
+    """聊天历史
+    
+    消息追加时计算一次 token 数并缓存，选择上下文窗口时只需从末尾
+    回溯被选中的消息，不会重新估算整个历史。
+    """
+    
+    def __init__(self):
+        self.messages = []
+        self.tokens = []
+        self.system_indices = []
+        self.system_tokens = 0
+        self.window_start = 0   # 分步窗口的起点，见 select()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def append(self, message, tokens=None):
+        """追加一条消息并缓存其 token 数（已知时直接使用）"""
+        count = tokens if tokens is not None else estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if message["role"] == "system":
+            self.system_indices.append(len(self.messages))
+            self.system_tokens += count
+        self.messages.append(message)
+        self.tokens.append(count)
+        return count
+
+    def pop(self):
+        """移除并返回最后一条消息"""
+        message = self.messages.pop()
+        count = self.tokens.pop()
+        if self.system_indices and self.system_indices[-1] == len(self.messages):
+            self.system_indices.pop()
+            self.system_tokens -= count
+        self.window_start = min(self.window_start, len(self.messages))
+        return message
+
+    def clear(self):
+        self.__init__()
+
+    def select(self, budget, step=0.0):
+        """选择能放入 token 预算的历史后缀
+        
+        system 消息始终保留；以 user 消息为起点的一轮对话要么整轮保留，
+        要么整轮丢弃；最后一轮无论是否超出预算都会保留。
+        
+        step 为 0 时每次取最长的后缀，预算用满后每一轮都丢弃最早的一轮，请求前缀随之改变。
+        step > 0 时窗口起点固定，放不下时才一次性前移，腾出约 step 比例的预算；
+        两次前移之间的请求前缀不变，服务端可以复用 prompt 缓存。
+        """
+        if step <= 0:
+            start = self.suffix_start(budget)
+        elif self.suffix_tokens(self.window_start) <= budget:
+            start = self.window_start
+        else:
+            start = self.window_start = self.suffix_start(int(budget * (1 - step)))
+        
+        system = [self.messages[i] for i in self.system_indices if i < start]
+        return system + self.messages[start:]
+
+    def suffix_tokens(self, start):
+        """从 start 开始的消息加上全部 system 消息的 token 数"""
+        return self.system_tokens + sum(count for message, count in zip(self.messages[start:], self.tokens[start:])
+                                        if message["role"] != "system")
+
+    def suffix_start(self, budget):
+        """能放入预算的最长后缀的起点（一轮对话的起点，或整个历史都放得下时为 0）"""
+        used = self.system_tokens
+        start = len(self.messages)
+        turn_cost = 0
+        
+        for i in range(len(self.messages) - 1, -1, -1):
+            role = self.messages[i]["role"]
+            if role == "system":
+                continue
+            turn_cost += self.tokens[i]
+            if role != "user":
+                continue
+            # 到达一轮的起点，判断整轮是否放得下
+            if used + turn_cost > budget and start < len(self.messages):
+                break
+            used += turn_cost
+            turn_cost = 0
+            start = i
+        # 开头不是 user 消息时（如打开会话只加载了最近一页），整段放得下也一并保留
+        if turn_cost and used + turn_cost <= budget:
+            start = 0
+        return start
+
+class ConversationStore:
+    """持久化会话存储（SQLite WAL 模式）
+    
+    每条消息作为一行追加写入，不会重写已有记录；打开会话时只加载
+    末尾若干条，更早的消息按 id 分页读取，启动开销与归档大小无关。
+    
+    消息追加时同时写入 FTS5 全文索引（不保存正文副本的 contentless 表）。
+    unicode61 分词不会切分中文，索引前在每个中日韩字符两侧加空格，
+    查询时把中文词写成逐字短语，按相邻位置匹配。
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL DEFAULT '',
+            model TEXT NOT NULL DEFAULT '',
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            session_id INTEGER NOT NULL REFERENCES sessions(id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+        CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated);
+        CREATE TABLE IF NOT EXISTS store_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+    
+    def __init__(self, path):
+        # 后台线程也会追加消息，连接由锁保护
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(self.SCHEMA)
+            self.fts = self._create_index()
+
+    def _create_index(self):
+        """创建全文索引（需要 SQLite 的 FTS5 扩展），不可用时返回 False
+        
+        索引建立之前已有的消息记为待补建范围，由 build_index() 分批补上。
+        """
+        exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                    "body, content='', tokenize='unicode61 remove_diacritics 2')")
+                if not exists:
+                    end = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+                    self.conn.executemany("INSERT OR REPLACE INTO store_meta (key, value) VALUES (?, ?)",
+                                          [("fts_backfill_cursor", 0), ("fts_backfill_end", end)])
+        except sqlite3.OperationalError as e:
+            print(f"全文索引不可用: {e}")
+            return False
+        return True
+
+    @staticmethod
+    def index_text(text):
+        """索引用文本：中日韩字符逐字分开"""
+        return _CJK_RE.sub(lambda m: f" {m.group(0)} ", text)
+
+    @staticmethod
+    def match_query(query):
+        """把搜索框的输入转换为 FTS5 查询，每个词为一个短语，最后一个词按前缀匹配"""
+        phrases = []
+        for term in query.split():
+            if not re.search(r'\w', term):
+                continue
+            phrases.append('"' + ConversationStore.index_text(term).replace('"', '""') + '"')
+        if phrases:
+            # 边输入边搜索时最后一个词可能还没输完
+            phrases[-1] += "*"
+        return " ".join(phrases)
+
+    def build_index(self, batch=2000):
+        """分批为索引建立之前的消息补建全文索引，可在后台线程中调用"""
+        if not self.fts:
+            return
+        while True:
+            with self.lock, self.conn:
+                cursor, end = (self.conn.execute("SELECT value FROM store_meta WHERE key = ?", (key,)).fetchone()[0]
+                               for key in ("fts_backfill_cursor", "fts_backfill_end"))
+                if cursor >= end:
+                    return
+                rows = self.conn.execute(
+                    "SELECT id, content FROM messages WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                    (cursor, end, batch)).fetchall()
+                self.conn.executemany("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+                                      [(msg_id, self.index_text(content)) for msg_id, content in rows])
+                cursor = rows[-1][0] if rows else end
+                self.conn.execute("UPDATE store_meta SET value = ? WHERE key = 'fts_backfill_cursor'", (cursor,))
+
+    def create_session(self, model, title=""):
+        """新建会话，返回会话 id"""
+        now = time.time()
+        with self.lock, self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO sessions (title, model, created, updated) VALUES (?, ?, ?, ?)",
+                (title, model, now, now))
+        return cur.lastrowid
+
+    def append(self, session_id, role, content, tokens):
+        """追加一条消息，返回消息 id"""
+        now = time.time()
+        with self.lock, self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO messages (session_id, role, content, tokens, created) VALUES (?, ?, ?, ?, ?)",
+                (session_id, role, content, tokens, now))
+            if self.fts:
+                self.conn.execute("INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+                                  (cur.lastrowid, self.index_text(content)))
+            # 首条用户消息作为会话标题
+            self.conn.execute(
+                "UPDATE sessions SET updated = ?, "
+                "title = CASE WHEN title = '' AND ? = 'user' THEN ? ELSE title END WHERE id = ?",
+                (now, role, content[:40].replace("\n", " "), session_id))
+        return cur.lastrowid
+
+    def delete_message(self, message_id):
+        """删除一条消息（如收到回复前就被取消的用户消息），同时从全文索引中移除"""
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT content FROM messages WHERE id = ?", (message_id,)).fetchone()
+            if row is None:
+                return
+            self.conn.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            if self.fts:
+                # 无内容的索引删除时需要提供原索引文本；尚未补建索引的旧消息不在索引中
+                cursor, end = (self.conn.execute("SELECT value FROM store_meta WHERE key = ?", (key,)).fetchone()[0]
+                               for key in ("fts_backfill_cursor", "fts_backfill_end"))
+                if message_id <= cursor or message_id > end:
+                    self.conn.execute("INSERT INTO messages_fts (messages_fts, rowid, body) VALUES ('delete', ?, ?)",
+                                      (message_id, self.index_text(row[0])))
+
+    def list_sessions(self, limit=50, offset=0):
+        """按最近更新时间列出会话"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, title, model, updated FROM sessions ORDER BY updated DESC LIMIT ? OFFSET ?",
+                (limit, offset)).fetchall()
+
+    def load_messages(self, session_id, limit, before_id=None):
+        """读取 before_id 之前（默认为末尾）的最多 limit 条消息，按时间正序返回"""
+        if before_id is None:
+            before_id = 2 ** 63 - 1
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, role, content, tokens, created FROM messages "
+                "WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before_id, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+    def load_messages_from(self, session_id, from_id):
+        """读取 from_id 及之后的全部消息，按时间正序返回"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, role, content, tokens, created FROM messages "
+                "WHERE session_id = ? AND id >= ? ORDER BY id",
+                (session_id, from_id)).fetchall()
+
+    @staticmethod
+    def snippet(content, query, width=60):
+        """截取内容中第一个搜索词附近的一段，用于结果列表"""
+        text = " ".join(content.split())
+        lowered = text.lower()
+        positions = [lowered.find(term.lower()) for term in query.split()]
+        pos = min((p for p in positions if p >= 0), default=0)
+        start = max(0, pos - width // 3)
+        return ("…" if start else "") + text[start:start + width] + ("…" if start + width < len(text) else "")
+
+    def search(self, query, limit=50):
+        """在所有会话中全文搜索，最新的消息在前
+        
+        返回 (消息 id, 会话 id, 角色, 内容, 时间, 会话标题, 模型) 列表。
+        """
+        match = self.match_query(query)
+        if not self.fts or not match:
+            return []
+        with self.lock:
+            return self.conn.execute(
+                "SELECT m.id, m.session_id, m.role, m.content, m.created, s.title, s.model "
+                "FROM messages_fts f JOIN messages m ON m.id = f.rowid JOIN sessions s ON s.id = m.session_id "
+                "WHERE messages_fts MATCH ? ORDER BY f.rowid DESC LIMIT ?",
+                (match, limit)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class ResponseCache:
+    """回复缓存
+    
+    以 (model, 消息窗口, temperature, max_tokens) 的规范化哈希为键。
+    前端是有界的内存 LRU 层，后端是 SQLite 磁盘层，按 TTL 过期，
+    总大小超限时按最近使用时间淘汰。
+    """
+    
+    def __init__(self, path, memory_items=256, ttl=86400, max_bytes=50 * 1024 * 1024):
+        self.memory = OrderedDict()    # key -> (response, created)
+        self.memory_items = memory_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, used REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_used ON responses(used)")
+            self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(params):
+        """请求参数的规范化哈希"""
+        canonical = json.dumps(
+            {k: params[k] for k in ("model", "messages", "temperature", "max_tokens")},
+            sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """查询缓存，未命中或已过期时返回 None"""
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None and now - entry[1] < self.ttl:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        
+        with self.lock:
+            row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] >= self.ttl:
+                self._delete(key)
+                row = None
+            if row is not None:
+                with self.conn:
+                    self.conn.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+        
+        if row is None:
+            self.memory.pop(key, None)
+            self.misses += 1
+            return None
+        self._remember(key, row[0], row[1])
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, response):
+        """写入缓存，必要时淘汰最久未使用的条目"""
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        self._remember(key, response, now)
+        with self.lock:
+            self._delete(key)
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO responses (key, response, size, created, used) VALUES (?, ?, ?, ?, ?)",
+                    (key, response, size, now, now))
+            self.total_bytes += size
+            self._evict(now)
+
+    def _remember(self, key, response, created):
+        self.memory[key] = (response, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _delete(self, key):
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            with self.conn:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= row[0]
+
+    def _evict(self, now):
+        """删除过期条目，并按最近使用时间淘汰直到总大小不超过上限"""
+        with self.conn:
+            expired = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses WHERE created <= ?", (now - self.ttl,)).fetchone()[0]
+            if expired:
+                self.conn.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+                self.total_bytes -= expired
+            while self.total_bytes > self.max_bytes:
+                rows = self.conn.execute("SELECT key, size FROM responses ORDER BY used LIMIT 64").fetchall()
+                if not rows:
+                    break
+                for key, size in rows:
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.memory.pop(key, None)
+                    self.total_bytes -= size
+                    if self.total_bytes <= self.max_bytes:
+                        break
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def make_response_cache(config, path="response_cache.db"):
+    """按配置创建回复缓存，未启用时返回 None"""
+    if not config["response_cache"]:
+        return None
+    return ResponseCache(
+        path,
+        memory_items=config["cache_memory_items"],
+        ttl=config["cache_ttl"],
+        max_bytes=int(config["cache_max_mb"] * 1024 * 1024)
+    )
+
+class ModelCatalog:
+    """模型目录：{base_url}/models 的本地缓存
+    
+    启动时同步读取磁盘缓存（不访问网络），之后在事件循环中后台刷新。
+    缓存超过 ttl 秒后带 If-None-Match / If-Modified-Since 重新验证，
+    服务端返回 304 时只更新获取时间。每个模型保存上下文长度、
+    最大回复 tokens 和单价，供请求大小计算和界面显示使用。
+    """
+
+    def __init__(self, path="model_catalog.json", ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.base_url = None
+        self.fetched = 0
+        self.etag = None
+        self.last_modified = None
+        self.models = {}
+        self.ids = []
+        self.search_keys = []
+
+    def load(self):
+        """读取磁盘缓存，文件不存在或损坏时保持为空"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        self.base_url = data.get("base_url")
+        self.fetched = data.get("fetched", 0)
+        self.etag = data.get("etag")
+        self.last_modified = data.get("last_modified")
+        self._set_models(data.get("models", {}))
+        return self
+
+    def save(self):
+        """原子地写入磁盘缓存"""
+        data = {
+            "base_url": self.base_url,
+            "fetched": self.fetched,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "models": self.models
+        }
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"模型目录保存失败: {e}")
+
+    def _set_models(self, models):
+        # 先准备好排序和检索用的小写键，再整体替换，界面线程读取时不会看到中间状态
+        ids = sorted(models)
+        search_keys = [(f"{model_id} {models[model_id].get('name', '')}".lower(), model_id) for model_id in ids]
+        self.models, self.ids, self.search_keys = models, ids, search_keys
+
+    @staticmethod
+    def parse(data):
+        """把 /models 的响应转换为 {id: 元数据}，兼容只有 id 的 OpenAI 格式"""
+        models = {}
+        for item in data.get("data", []):
+            top_provider = item.get("top_provider") or {}
+            pricing = item.get("pricing") or {}
+            models[item["id"]] = {
+                "name": item.get("name", ""),
+                "context_length": item.get("context_length") or top_provider.get("context_length"),
+                "max_completion_tokens": top_provider.get("max_completion_tokens"),
+                "prompt_price": pricing.get("prompt"),
+                "completion_price": pricing.get("completion")
+            }
+        return models
+
+    def is_stale(self, base_url):
+        """缓存过期或来自其他 API 地址时需要刷新"""
+        return base_url != self.base_url or time.time() - self.fetched >= self.ttl
+
+    async def refresh(self, client, force=False, scheduler=None):
+        """从服务端刷新目录，返回模型列表是否有变化；给出 scheduler 时以后台优先级排队"""
+        base_url = str(client.base_url)
+        if not force and not self.is_stale(base_url):
+            return False
+        if scheduler is not None:
+            await scheduler.acquire(None, RequestScheduler.BACKGROUND)
+        
+        # 同一地址的缓存带上验证头，未变化时服务端只需返回 304
+        headers = {}
+        if base_url == self.base_url:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+        
+        try:
+            response = await client.get("/models", cast_to=httpx.Response, options={"headers": headers})
+        except APIStatusError as e:
+            if e.status_code != 304:
+                raise
+            self.fetched = time.time()
+            self.save()
+            return False
+        
+        models = self.parse(response.json())
+        changed = models != self.models
+        self.base_url = base_url
+        self.fetched = time.time()
+        self.etag = response.headers.get("etag")
+        self.last_modified = response.headers.get("last-modified")
+        self._set_models(models)
+        self.save()
+        return changed
+
+    def context_length(self, model):
+        """模型的上下文长度，未知时返回 None"""
+        info = self.models.get(model)
+        return info and info["context_length"]
+
+    def max_completion_tokens(self, model):
+        """模型单次回复的最大 tokens，未知时返回 None"""
+        info = self.models.get(model)
+        return info and info["max_completion_tokens"]
+
+    def search(self, query, limit=200):
+        """按空格分隔的关键词过滤模型（不区分大小写），前缀匹配的排在前面"""
+        words = query.lower().split()
+        if not words:
+            return self.ids[:limit]
+        prefix, other = [], []
+        for key, model_id in self.search_keys:
+            if all(word in key for word in words):
+                (prefix if key.startswith(words[0]) else other).append(model_id)
+                if len(prefix) >= limit:
+                    break
+        return (prefix + other)[:limit]
+
+def load_model_catalog(config, path="model_catalog.json"):
+    """按配置创建模型目录并读取磁盘缓存"""
+    return ModelCatalog(path, ttl=config["catalog_ttl"]).load()
+
+class Telemetry:
+    """请求性能统计
+    
+    每个请求一条样本：排队时间、首 token 时间（流式）、总耗时、prompt/completion tokens、
+    生成速度、重试次数和结果。样本逐行追加到 JSONL 指标文件，便于离线分析；
+    成功的样本按实际使用的模型保留最近 window 条，用于计算分位数和直方图。
+    时间单位均为秒。
+    """
+    
+    # 直方图的桶上界（秒），最后一个桶收集更慢的请求
+    LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32)
+    
+    def __init__(self, path=None, window=500):
+        self.path = path
+        self.window = window
+        self.samples = {}    # model -> deque[sample]
+        self.lock = threading.Lock()
+        self.file = None
+        if path:
+            try:
+                self.file = open(path, 'a', encoding='utf-8')
+            except OSError as e:
+                print(f"指标文件打开失败: {e}")
+
+    def record(self, sample):
+        """记录一条样本（可在任意线程中调用）"""
+        line = json.dumps(sample, ensure_ascii=False)
+        with self.lock:
+            if sample["outcome"] == "ok":
+                model = sample["used_model"]
+                if model not in self.samples:
+                    self.samples[model] = deque(maxlen=self.window)
+                self.samples[model].append(sample)
+            if self.file is not None:
+                self.file.write(line + "\n")
+                self.file.flush()
+
+    def values(self, model, field):
+        """某模型最近样本中某一字段的取值（已排序，忽略缺失值）"""
+        with self.lock:
+            samples = list(self.samples.get(model, ()))
+        return sorted(sample[field] for sample in samples if sample.get(field) is not None)
+
+    def percentiles(self, model, field, quantiles=(50, 90, 99)):
+        """返回 {分位: 值}，没有样本时返回 None"""
+        values = self.values(model, field)
+        if not values:
+            return None
+        return {q: values[min(len(values) - 1, len(values) * q // 100)] for q in quantiles}
+
+    def histogram(self, model, field="latency", bounds=LATENCY_BUCKETS):
+        """按 bounds 分桶计数，返回长度为 len(bounds) + 1 的列表"""
+        counts = [0] * (len(bounds) + 1)
+        for value in self.values(model, field):
+            counts[next((i for i, bound in enumerate(bounds) if value <= bound), len(bounds))] += 1
+        return counts
+
+    def totals(self, model, *fields):
+        """某模型最近样本中各字段之和（缺失值按 0 计）"""
+        with self.lock:
+            samples = list(self.samples.get(model, ()))
+        return tuple(sum(sample.get(field) or 0 for sample in samples) for field in fields)
+
+    def models(self):
+        """有成功样本的模型"""
+        with self.lock:
+            return sorted(self.samples)
+
+    def close(self):
+        """关闭指标文件"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+def make_telemetry(config):
+    """按配置创建请求统计，metrics_file 为空时只在内存中统计"""
+    return Telemetry(config["metrics_file"] or None, window=config["metrics_window"])
+
+class TokenBucket:
+    """令牌桶：最多积攒 capacity 个请求，每 period 秒补满
+    
+    blocked_until 之前不发放；服务端告知的限速窗口在 window_reset 时刻重置，届时直接补满。
+    """
+    
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0    # 服务端要求等待时（429、剩余额度为 0）暂停到这个时刻
+        self.window_reset = 0.0
+
+    def refill(self, now):
+        if self.window_reset and now >= self.window_reset:
+            self.tokens = self.capacity
+            self.window_reset = 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def eta(self, now, queued=0):
+        """排在 queued 个请求之后，距离拿到令牌的预计秒数，0 表示现在就可以发出"""
+        self.refill(now)
+        needed = queued + 1 - self.tokens
+        eta = needed / self.rate if needed > 0 else 0.0
+        if self.window_reset and queued < self.capacity:
+            eta = min(eta, self.window_reset - now)
+        return max(self.blocked_until - now, eta, 0.0)
+
+    def take(self):
+        self.tokens -= 1
+
+# 正在发出的请求对应的模型，供响应钩子把限速头记到对应的令牌桶（每个请求任务各自一份）
+requested_model = contextvars.ContextVar("requested_model", default=None)
+
+class RequestScheduler:
+    """按模型和 API Key 限速的请求调度器
+    
+    rate_limits 把模型名中包含的子串映射到 [请求数, 秒]，匹配的每个模型各有一个令牌桶；
+    key_limit 为整个 Key 的 [请求数, 秒]，为空表示不限。请求发出前先取得所有相关令牌桶的令牌，
+    取不到就排队等待，而不是直接撞上 429。排队按优先级：界面上的发送（INTERACTIVE）
+    排在后台任务（BACKGROUND，如附件分块、模型目录刷新）之前，同一优先级先到先得。
+    响应中的限速头（X-RateLimit-*、Retry-After）用于校正令牌桶；没有配置限速的模型
+    收到限速头后按每 LEARNED_PERIOD 秒 X-RateLimit-Limit 个请求建立令牌桶。
+    只在引擎的事件循环中使用。
+    """
+    
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    LEARNED_PERIOD = 60
+    
+    def __init__(self, rate_limits=None, key_limit=None):
+        self.rate_limits = rate_limits or {}
+        self.key_limit = key_limit or None
+        self.buckets = {}    # 模型 -> TokenBucket，None 为整个 Key 的令牌桶
+        self.waiters = []    # (优先级, 序号, 令牌桶列表)
+        self.seq = itertools.count()
+        self.changed = asyncio.Event()
+        if self.key_limit:
+            self.buckets[None] = TokenBucket(*self.key_limit)
+
+    def notify(self):
+        """唤醒所有排队的请求重新检查"""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def bucket(self, model):
+        """模型的令牌桶，没有配置限速时返回 None"""
+        if model not in self.buckets:
+            limit = next((limit for pattern, limit in self.rate_limits.items() if pattern in model), None)
+            if limit is None:
+                return None
+            self.buckets[model] = TokenBucket(*limit)
+        return self.buckets[model]
+
+    def buckets_for(self, model):
+        buckets = [self.bucket(model)] if model is not None else []
+        return [bucket for bucket in buckets + [self.buckets.get(None)] if bucket is not None]
+
+    async def acquire(self, model, priority=INTERACTIVE, on_wait=None):
+        """等到可以向 model 发出请求（model 为 None 时只受 Key 的限速），返回等待的秒数
+        
+        需要排队时调用 on_wait(排队位置, 预计等待秒数)，位置或预计时间变化时再次调用。
+        """
+        requested_model.set(model)
+        buckets = self.buckets_for(model)
+        if not buckets:
+            return 0.0
+        start = time.monotonic()
+        entry = (priority, next(self.seq), buckets)
+        self.waiters.append(entry)
+        reported = None
+        try:
+            while True:
+                now = time.monotonic()
+                # 每个令牌桶只为排在前面、同样用到它的请求预留令牌，
+                # 一个模型（如 :free）额度用尽时不会挡住其他模型的请求
+                queued = {bucket: sum(1 for other in self.waiters if other[:2] < entry[:2] and bucket in other[2])
+                          for bucket in buckets}
+                estimate = max(bucket.eta(now, queued[bucket]) for bucket in buckets)
+                if estimate <= 0:
+                    for bucket in buckets:
+                        bucket.take()
+                    return now - start
+                if on_wait is not None:
+                    ahead = max(count for bucket, count in queued.items() if bucket.eta(now, count) > 0)
+                    if reported != (ahead, round(estimate)):
+                        reported = (ahead, round(estimate))
+                        on_wait(ahead + 1, estimate)
+                wait = max(bucket.eta(now) for bucket in buckets)
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout=max(wait, 0.05))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiters.remove(entry)
+            self.notify()
+
+    @staticmethod
+    def parse_seconds(value):
+        """限速头中的时间转为距现在的秒数
+        
+        支持秒数、毫秒或秒级时间戳（OpenRouter 的 X-RateLimit-Reset）和 "1m30s"、"250ms" 这样的时长。
+        """
+        try:
+            number = float(value)
+        except ValueError:
+            parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+            units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+            return sum(float(amount) * units[unit] for amount, unit in parts) if parts else None
+        if number > 1e12:
+            return number / 1000 - time.time()
+        if number > 1e9:
+            return number - time.time()
+        return number
+
+    def observe(self, model, status, headers):
+        """根据响应的限速头校正令牌桶；剩余额度为 0 或收到 429 时暂停发放到服务端给出的时刻
+        
+        不属于某个模型的请求（预热、模型目录）的限速头不一定针对整个 Key，不用于校正。
+        """
+        if model is None:
+            return
+        
+        def header(*names):
+            return next((headers[name] for name in names if headers.get(name)), None)
+        
+        limit = header("x-ratelimit-limit", "x-ratelimit-limit-requests")
+        remaining = header("x-ratelimit-remaining", "x-ratelimit-remaining-requests")
+        reset = header("x-ratelimit-reset", "x-ratelimit-reset-requests")
+        retry_after = header("retry-after")
+        if status != 429 and remaining is None:
+            return
+        try:
+            limit = int(float(limit)) if limit else None
+            remaining = int(float(remaining)) if remaining is not None else None
+            reset = self.parse_seconds(reset) if reset else None
+            retry_after = self.parse_seconds(retry_after) if retry_after else None
+        except ValueError:
+            return
+        
+        key = model if self.bucket(model) is not None else None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            # 没有限额的 429（如上游供应商繁忙）只由故障转移的退避处理
+            if not limit:
+                return
+            bucket = self.buckets[model] = TokenBucket(limit, self.LEARNED_PERIOD)
+        
+        now = time.monotonic()
+        bucket.refill(now)
+        wait = retry_after
+        if reset is not None and reset > 0:
+            bucket.window_reset = now + reset
+        if remaining is not None:
+            bucket.tokens = min(bucket.tokens, remaining)
+            if remaining <= 0:
+                wait = max(wait or 0, reset or 0)
+        if status == 429:
+            bucket.tokens = min(bucket.tokens, 0)
+            wait = wait or reset or 1 / bucket.rate
+        if wait and wait > 0:
+            bucket.blocked_until = max(bucket.blocked_until, now + wait)
+        self.notify()
+
+def make_scheduler(config):
+    """按配置创建请求调度器"""
+    return RequestScheduler(config["rate_limits"], config["key_rate_limit"])
+
+def import_openai():
+    """导入 openai 和 httpx，并把用到的名称填入模块全局变量（可在任意线程中调用）"""
+    global httpx, AsyncOpenAI, DefaultAsyncHttpxClient, NotFoundError, APIStatusError, RETRYABLE_ERRORS
+    with openai_lock:
+        if AsyncOpenAI is not None:
+            return
+        import httpx
+        import openai
+        DefaultAsyncHttpxClient = openai.DefaultAsyncHttpxClient
+        NotFoundError = openai.NotFoundError
+        APIStatusError = openai.APIStatusError
+        RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+        AsyncOpenAI = openai.AsyncOpenAI
+
+class ChatEngine:
+    """无界面的异步聊天引擎
+    
+    持有 AsyncOpenAI 客户端、聊天历史和上下文选择，负责请求的完整生命周期。
+    所有请求都在同一个事件循环中并发执行，可以直接在脚本或测试中使用：
+    
+        engine = ChatEngine(api_key="...", model="openai/gpt-oss-20b:free")
+        reply = asyncio.run(engine.ask("你好"))
+    """
+    
+    def __init__(self, api_key="", base_url="https://openrouter.ai/api/v1",
+                 model="openai/gpt-oss-20b:free", max_tokens=1000, temperature=0.7,
+                 context_tokens=8192, model_context_tokens=None,
+                 cache=None, cache_models=None, cache_zero_temperature_only=False,
+                 http2=False, max_connections=20, keepalive_expiry=120, request_timeout=60,
+                 max_retries=2, retry_base_delay=1.0, fallback_models=None, hedge_delay=0,
+                 catalog=None, telemetry=None, document_chunk_tokens=4000, document_concurrency=4,
+                 system_prompt="", context_step=0.5, cache_control_models=None, scheduler=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.context_tokens = context_tokens
+        self.model_context_tokens = model_context_tokens or {}
+        
+        # 服务端 prompt 缓存：固定的系统提示放在最前面，上下文窗口分步前移（见 ChatHistory.select），
+        # cache_control_models 中的模型（按前缀匹配）还会在消息上标注缓存断点
+        self.system_prompt = system_prompt
+        self.context_step = context_step
+        self.cache_control_models = cache_control_models or []
+        
+        # 模型目录（可选）：提供各模型的上下文长度和最大回复 tokens
+        self.catalog = catalog
+        self.history = ChatHistory()
+        self.client = None
+        
+        # 连接池设置：所有请求共享同一个保持长连接的 HTTP 客户端
+        self.http2 = http2
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.request_timeout = request_timeout
+        
+        # 故障转移：可重试错误按抖动退避重试，重试用尽后依次切换到备用模型；
+        # hedge_delay > 0 时，主请求超过该秒数仍未返回首个 token 就向备用模型发出对冲请求
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.fallback_models = fallback_models or []
+        self.hedge_delay = hedge_delay
+        self.last_model = model
+        
+        # 回复缓存（可选）：可限定模型，或只缓存 temperature 为 0 的请求
+        self.cache = cache
+        self.cache_models = cache_models or []
+        self.cache_zero_temperature_only = cache_zero_temperature_only
+        self.last_reply_cached = False
+        
+        # 请求统计（可选）：每个请求的耗时、tokens 和结果，最近一次的样本保存在 last_metrics
+        self.telemetry = telemetry
+        self.last_metrics = None
+        
+        # 大文件附件：切块的 token 上限和同时处理的块数
+        self.document_chunk_tokens = document_chunk_tokens
+        self.document_concurrency = document_concurrency
+        
+        # 请求调度（可选）：按模型和 Key 限速并按优先级排队，所有分支共用
+        self.scheduler = scheduler
+        
+        # 消息写入历史后的回调 (role, content, tokens)，用于持久化
+        self.on_message = None
+        # 最后一条消息被撤回时的回调（无参数），用于从存储中删除
+        self.on_unrecord = None
+        # 请求因限速排队时的回调 (排队位置, 预计等待秒数)，开始发出时以 (0, 0) 调用
+        self.on_queue = None
+        
+        if api_key:
+            self.configure(api_key, base_url)
+
+    @classmethod
+    def from_config(cls, config, **overrides):
+        """根据 chat_config.json 的内容创建引擎
+        
+        overrides 覆盖对应的构造参数，如界面传入已加载的模型目录或不带 api_key 延后创建客户端；
+        被覆盖的缓存、目录等对象不会再按配置创建。
+        """
+        params = {
+            "api_key": config["api_key"],
+            "base_url": config["base_url"],
+            "model": config["model"],
+            "max_tokens": config["max_tokens"],
+            "temperature": config["temperature"],
+            "context_tokens": config["context_tokens"],
+            "model_context_tokens": config["model_context_tokens"],
+            "cache_models": config["cache_models"],
+            "cache_zero_temperature_only": config["cache_zero_temperature_only"],
+            "http2": config["http2"],
+            "max_connections": config["max_connections"],
+            "keepalive_expiry": config["keepalive_expiry"],
+            "request_timeout": config["request_timeout"],
+            "max_retries": config["max_retries"],
+            "retry_base_delay": config["retry_base_delay"],
+            "fallback_models": config["fallback_models"],
+            "hedge_delay": config["hedge_delay"],
+            "document_chunk_tokens": config["document_chunk_tokens"],
+            "document_concurrency": config["document_concurrency"],
+            "system_prompt": config["system_prompt"],
+            "context_step": config["context_step"],
+            "cache_control_models": config["cache_control_models"]
+        }
+        # 需要打开文件的对象只在没有被覆盖时创建
+        factories = {
+            "cache": make_response_cache,
+            "catalog": load_model_catalog,
+            "telemetry": make_telemetry,
+            "scheduler": make_scheduler
+        }
+        for name, factory in factories.items():
+            if name not in overrides:
+                params[name] = factory(config)
+        params.update(overrides)
+        return cls(**params)
+
+    def fork(self, **overrides):
+        """创建共享客户端（连接池）和回复缓存的新引擎
+
+        新引擎有独立的聊天历史，overrides 可覆盖 model、temperature 等设置。
+        客户端和缓存仍由原引擎负责关闭。
+        """
+        engine = copy.copy(self)
+        engine.history = ChatHistory()
+        engine.on_message = None
+        engine.on_unrecord = None
+        engine.on_queue = None
+        engine.last_reply_cached = False
+        engine.last_metrics = None
+        for name, value in overrides.items():
+            setattr(engine, name, value)
+        engine.last_model = engine.model
+        return engine
+
+    def configure(self, api_key, base_url=None):
+        """（重新）创建客户端，使用显式配置的长连接池"""
+        self.api_key = api_key
+        if base_url is not None:
+            self.base_url = base_url
+        import_openai()
+        
+        # HTTP/2 需要可选依赖 h2，未安装时退回 HTTP/1.1
+        http2 = self.http2 and importlib.util.find_spec("h2") is not None
+        if self.http2 and not http2:
+            print("未安装 h2，HTTP/2 不可用，使用 HTTP/1.1")
+        
+        http_client = DefaultAsyncHttpxClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            event_hooks={"response": [self.observe_response]}
+        )
+        # 重试由引擎的故障转移策略统一处理
+        self.client = AsyncOpenAI(
+            base_url=self.base_url,
+            api_key=self.api_key,
+            http_client=http_client,
+            timeout=self.request_timeout,
+            max_retries=0
+        )
+
+    async def observe_response(self, response):
+        """响应钩子：把限速头交给调度器"""
+        if self.scheduler is not None:
+            self.scheduler.observe(requested_model.get(), response.status_code, response.headers)
+
+    async def warm_up(self):
+        """用轻量的鉴权请求预热连接池
+        
+        依次请求两次：第一次包含 DNS、TCP 和 TLS 建连，第二次复用已建立的连接。
+        优先使用 OpenRouter 的 /key 接口（会校验 Key），不存在时退回 /models。
+        返回 (建连耗时, 往返耗时)，单位为秒。
+        """
+        path = "/key"
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            try:
+                await self.client.get(path, cast_to=httpx.Response)
+            except NotFoundError:
+                if path == "/models":
+                    raise
+                path = "/models"
+                await self.client.get(path, cast_to=httpx.Response)
+            timings.append(time.perf_counter() - start)
+        return timings[0], timings[1]
+
+    async def aclose(self):
+        """关闭客户端及其连接"""
+        if self.client is not None:
+            await self.client.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+    def context_window(self, model=None):
+        """模型的上下文长度：配置的 model_context_tokens 优先，其次是模型目录，最后是 context_tokens"""
+        model = model or self.model
+        if model in self.model_context_tokens:
+            return self.model_context_tokens[model]
+        if self.catalog is not None:
+            return self.catalog.context_length(model) or self.context_tokens
+        return self.context_tokens
+
+    def reply_tokens(self, model=None):
+        """回复的 max_tokens，不超过模型目录中该模型的上限"""
+        limit = self.catalog.max_completion_tokens(model or self.model) if self.catalog is not None else None
+        return min(self.max_tokens, limit) if limit else self.max_tokens
+
+    def prompt_budget(self, model=None):
+        """模型可用于上下文的 token 预算（扣除回复所需的 max_tokens）"""
+        return max(self.context_window(model) - self.reply_tokens(model), 0)
+
+    def record(self, role, content):
+        """把消息写入聊天历史并通知回调"""
+        tokens = self.history.append({"role": role, "content": content})
+        if self.on_message is not None:
+            self.on_message(role, content, tokens)
+
+    def unrecord(self):
+        """从聊天历史撤回最后一条消息并通知回调（请求在收到回复前被取消时撤回用户消息）"""
+        self.history.pop()
+        if self.on_unrecord is not None:
+            self.on_unrecord()
+
+    def record_interrupted(self, parts):
+        """请求被取消：已收到部分回复时写入历史，否则撤回本轮的用户消息"""
+        if any(parts):
+            self.record("assistant", "".join(parts))
+        else:
+            self.unrecord()
+
+    def context_messages(self):
+        """本次请求的消息：固定的系统提示在前，其后是按 token 预算选择的历史"""
+        budget = self.prompt_budget()
+        if not self.system_prompt:
+            return self.history.select(budget, self.context_step)
+        budget -= estimate_tokens(self.system_prompt) + MESSAGE_OVERHEAD_TOKENS
+        return ([{"role": "system", "content": self.system_prompt}]
+                + self.history.select(max(budget, 0), self.context_step))
+
+    @staticmethod
+    def with_cache_breakpoints(messages):
+        """在第一条 system 消息和最后两条 user 消息上标注 cache_control 断点，返回新列表
+        
+        Anthropic 等模型只缓存显式断点之前的前缀（每个请求最多 4 个断点）：
+        最后一条 user 消息的断点写入缓存，上一条的断点用于命中上一轮写入的缓存。
+        """
+        systems = [i for i, message in enumerate(messages) if message["role"] == "system"][:1]
+        users = [i for i, message in enumerate(messages) if message["role"] == "user"][-2:]
+        marked = set(systems + users)
+        return [dict(message, content=[{"type": "text", "text": message["content"],
+                                        "cache_control": {"type": "ephemeral"}}])
+                if i in marked and isinstance(message["content"], str) else message
+                for i, message in enumerate(messages)]
+
+    def request_params(self, messages, model=None, **overrides):
+        """组装请求参数，overrides 可覆盖 max_tokens、temperature 等采样参数"""
+        model = model or self.model
+        if any(model.startswith(prefix) for prefix in self.cache_control_models):
+            messages = self.with_cache_breakpoints(messages)
+        params = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": self.reply_tokens(model),
+            "temperature": self.temperature,
+        }
+        params.update(overrides)
+        return params
+
+    def candidate_models(self, model=None):
+        """主模型在前，其后按用户设定的顺序排列备用模型"""
+        primary = model or self.model
+        return [primary] + [m for m in self.fallback_models if m != primary]
+
+    def retry_delay(self, error, retry):
+        """退避时间：优先使用 Retry-After，否则为带随机抖动的指数退避"""
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                return min(float(response.headers.get("retry-after", "")), 30.0)
+            except ValueError:
+                pass
+        return self.retry_base_delay * (2 ** retry) * random.uniform(0.5, 1.5)
+
+    async def with_failover(self, attempt, models, sample=None, priority=RequestScheduler.INTERACTIVE):
+        """依次对 models 调用 attempt(model)，返回 (实际使用的模型, 结果)
+        
+        每次尝试前先在调度器中排队，等待时间计入样本的排队时间。
+        """
+        last_error = None
+        for model in models:
+            for retry in range(self.max_retries + 1):
+                if self.scheduler is not None:
+                    waited = await self.scheduler.acquire(model, priority, self.on_queue)
+                    if waited and sample is not None:
+                        sample["queue"] += waited
+                    if waited and self.on_queue is not None:
+                        self.on_queue(0, 0)
+                try:
+                    return model, await attempt(model)
+                except RETRYABLE_ERRORS as e:
+                    last_error = e
+                    if sample is not None:
+                        sample["retries"] += 1
+                    if retry < self.max_retries:
+                        await asyncio.sleep(self.retry_delay(e, retry))
+        raise last_error
+
+    async def hedged(self, attempt, model=None, discard=None, sample=None, priority=RequestScheduler.INTERACTIVE):
+        """带对冲的故障转移
+        
+        主请求在 hedge_delay 秒内未返回时，从下一个备用模型起发出第二个请求，
+        先成功的一方胜出，另一方被取消；若双方同时成功，落败的结果交给 discard 释放。
+        """
+        models = self.candidate_models(model)
+        primary = asyncio.create_task(self.with_failover(attempt, models, sample, priority))
+        if self.hedge_delay <= 0 or len(models) < 2:
+            return await primary
+        
+        pending = {primary}
+        winner = error = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay)
+            if not done:
+                pending.add(asyncio.create_task(self.with_failover(attempt, models[1:], sample, priority)))
+                if sample is not None:
+                    sample["hedged"] = True
+            while True:
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    elif discard is not None:
+                        await discard(task.result()[1])
+                if winner is not None or not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # 落败或被取消时，未完成的请求一并取消，关闭其连接
+            for task in pending:
+                task.cancel()
+        if winner is None:
+            raise error
+        return winner
+
+    def new_sample(self, model, stream, submitted=None):
+        """开始一条请求统计样本；submitted 为请求提交时的 time.perf_counter()，用于计算排队时间"""
+        now = time.perf_counter()
+        return {
+            "time": time.time(),
+            "model": model or self.model,
+            "used_model": None,
+            "stream": stream,
+            "queue": now - submitted if submitted is not None else 0.0,
+            "ttft": None,
+            "latency": None,
+            "prompt_tokens": None,
+            "cached_tokens": None,
+            "completion_tokens": None,
+            "tokens_per_s": None,
+            "retries": 0,
+            "hedged": False,
+            "outcome": None,
+            "error": None,
+            "_start": now
+        }
+
+    def finish_sample(self, sample, outcome, error=None, usage=None, reply=None):
+        """补全样本的耗时、tokens 和生成速度，并交给 telemetry 记录"""
+        start = sample.pop("_start")
+        sample["latency"] = time.perf_counter() - start
+        sample["outcome"] = outcome
+        if error is not None:
+            sample["error"] = f"{type(error).__name__}: {error}"
+        if usage is not None:
+            sample["prompt_tokens"] = usage.prompt_tokens
+            sample["completion_tokens"] = usage.completion_tokens
+            # 命中服务端 prompt 缓存的 tokens（不支持的服务端没有这一项）
+            details = getattr(usage, "prompt_tokens_details", None)
+            if isinstance(details, dict):
+                sample["cached_tokens"] = details.get("cached_tokens")
+            elif details is not None:
+                sample["cached_tokens"] = getattr(details, "cached_tokens", None)
+        elif reply:
+            # 服务端没有返回 usage 时按字符估算
+            sample["completion_tokens"] = estimate_tokens(reply)
+            sample["usage_estimated"] = True
+        # 生成速度不计首 token 之前的等待
+        generating = sample["latency"] - (sample["ttft"] or 0)
+        if sample["completion_tokens"] and generating > 0:
+            sample["tokens_per_s"] = sample["completion_tokens"] / generating
+        self.last_metrics = sample
+        if self.telemetry is not None:
+            self.telemetry.record(sample)
+
+    async def _create(self, messages, model=None, submitted=None, priority=RequestScheduler.INTERACTIVE, **overrides):
+        """带故障转移的非流式补全，返回 (实际使用的模型, completion)"""
+        async def attempt(candidate):
+            return await self.client.chat.completions.create(**self.request_params(messages, candidate, **overrides))
+        
+        sample = self.new_sample(model, False, submitted)
+        try:
+            used_model, completion = await self.hedged(attempt, model, sample=sample, priority=priority)
+        except asyncio.CancelledError:
+            self.finish_sample(sample, "cancelled")
+            raise
+        except Exception as e:
+            self.finish_sample(sample, "error", e)
+            raise
+        sample["used_model"] = used_model
+        self.finish_sample(sample, "ok", usage=completion.usage)
+        return used_model, completion
+
+    async def create(self, messages, model=None, **overrides):
+        """对给定消息列表做一次非流式补全，返回完整的 completion 对象"""
+        used_model, completion = await self._create(messages, model, **overrides)
+        return completion
+
+    async def complete(self, messages, model=None):
+        """对给定消息列表做一次非流式补全，不修改历史"""
+        completion = await self.create(messages, model)
+        return completion.choices[0].message.content or ""
+
+    async def _deltas(self, stream, usage=None):
+        """从 SSE 流中产出增量文本，结束或被取消时关闭底层连接
+        
+        流末尾带 usage 的数据块（没有 choices）存入 usage 列表。
+        """
+        try:
+            async for chunk in stream:
+                if usage is not None and getattr(chunk, "usage", None) is not None:
+                    usage.append(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            await stream.close()
+
+    async def _open_stream(self, messages, model=None, submitted=None):
+        """带故障转移地打开流式补全，等到首个增量到达才算成功
+        
+        返回 (实际使用的模型, 增量迭代器)；首个 token 之后的错误不再重试。
+        迭代结束、出错或被关闭时记录请求统计。
+        """
+        usage = []
+        
+        async def attempt(candidate):
+            stream = await self.client.chat.completions.create(
+                **self.request_params(messages, candidate), stream=True,
+                stream_options={"include_usage": True})
+            deltas = self._deltas(stream, usage)
+            try:
+                first = await deltas.__anext__()
+            except StopAsyncIteration:
+                first = ""
+            return first, deltas
+        
+        sample = self.new_sample(model, True, submitted)
+        try:
+            used_model, (first, deltas) = await self.hedged(
+                attempt, model, discard=lambda result: result[1].aclose(), sample=sample)
+        except asyncio.CancelledError:
+            self.finish_sample(sample, "cancelled")
+            raise
+        except Exception as e:
+            self.finish_sample(sample, "error", e)
+            raise
+        sample["used_model"] = used_model
+        sample["ttft"] = time.perf_counter() - sample["_start"]
+        self.last_metrics = sample
+        
+        async def chained():
+            parts = [first]
+            outcome, error = "cancelled", None
+            try:
+                if first:
+                    yield first
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+                outcome = "ok"
+            except Exception as e:
+                outcome, error = "error", e
+                raise
+            finally:
+                await deltas.aclose()
+                self.finish_sample(sample, outcome, error, usage[-1] if usage else None, "".join(parts))
+        return used_model, chained()
+
+    async def stream(self, messages, model=None):
+        """对给定消息列表做一次流式补全，逐个产出增量文本，不修改历史"""
+        used_model, deltas = await self._open_stream(messages, model)
+        async for delta in deltas:
+            yield delta
+
+    def cache_key(self, messages, model=None):
+        """可缓存时返回请求的缓存键，否则返回 None"""
+        if self.cache is None:
+            return None
+        params = self.request_params(messages, model)
+        if self.cache_models and params["model"] not in self.cache_models:
+            return None
+        if self.cache_zero_temperature_only and params["temperature"] != 0:
+            return None
+        return ResponseCache.make_key(params)
+
+    async def ask(self, prompt, submitted=None):
+        """发送一条用户消息（带上下文），返回完整回复
+        
+        submitted 为请求提交时的 time.perf_counter()，用于统计排队时间。
+        """
+        self.record("user", prompt)
+        # 按当前模型的 token 预算选择上下文，避免超限
+        messages = self.context_messages()
+        
+        key = self.cache_key(messages)
+        response = self.cache.get(key) if key else None
+        self.last_reply_cached = response is not None
+        self.last_model = self.model
+        if response is None:
+            try:
+                self.last_model, completion = await self._create(messages, submitted=submitted)
+            except asyncio.CancelledError:
+                self.unrecord()
+                raise
+            response = completion.choices[0].message.content or ""
+            # 只缓存主模型的非空回复（被截断或过滤时可能为空）
+            if key and response and self.last_model == self.model:
+                self.cache.put(key, response)
+        
+        self.record("assistant", response)
+        return response
+
+    async def ask_stream(self, prompt, submitted=None):
+        """发送一条用户消息（带上下文），以异步迭代器逐个产出回复增量
+        
+        命中缓存时一次性产出完整回复，并把 last_reply_cached 置为 True。
+        请求被取消时，已收到的部分回复仍写入历史；一个增量都没收到时撤回本轮的用户消息。
+        随后继续抛出 CancelledError。
+        """
+        self.record("user", prompt)
+        messages = self.context_messages()
+        
+        key = self.cache_key(messages)
+        cached = self.cache.get(key) if key else None
+        self.last_reply_cached = cached is not None
+        self.last_model = self.model
+        if cached is not None:
+            parts = [cached]
+            yield cached
+        else:
+            parts = []
+            try:
+                self.last_model, deltas = await self._open_stream(messages, submitted=submitted)
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+            except asyncio.CancelledError:
+                self.record_interrupted(parts)
+                raise
+            # 只缓存主模型的非空回复（被截断或过滤时可能为空）
+            if key and any(parts) and self.last_model == self.model:
+                self.cache.put(key, "".join(parts))
+        
+        # 完整回复写入聊天历史
+        self.record("assistant", "".join(parts))
+
+    # 附件各块的处理（map）和结果合并（reduce）的系统提示
+    DOCUMENT_MAP_PROMPT = "你在阅读一份长文档中的一部分。只根据这一部分完成任务；如果这一部分与任务无关，简短说明即可。"
+    DOCUMENT_REDUCE_PROMPT = "下面是对同一份文档各部分依次处理的结果。把它们合并成一个完整、连贯、不重复的回答。"
+    
+    async def ask_document(self, path, question="", progress=None):
+        """针对一个文本文件提问，以异步迭代器逐个产出最终回复的增量
+        
+        文档请求不带聊天上下文，历史中只记录问题和最终回复；
+        在收到最终回复之前被取消时撤回问题。
+        progress(阶段, 已读字节, 总字节, 已完成请求数) 在引擎线程中调用，阶段为 "map" 或 "reduce"。
+        """
+        name = os.path.basename(path)
+        task = question or "概括这份文档的要点。"
+        self.record("user", f"📎 {name}\n{question}".rstrip())
+        parts = []
+        self.last_reply_cached = False
+        try:
+            final = await self.document_messages(path, name, task, progress)
+            self.last_model, deltas = await self._open_stream(final)
+            async for delta in deltas:
+                parts.append(delta)
+                yield delta
+        except asyncio.CancelledError:
+            self.record_interrupted(parts)
+            raise
+        self.record("assistant", "".join(parts))
+
+    async def document_messages(self, path, name, task, progress=None):
+        """把文档处理成最终一次请求的消息
+        
+        文件流式读取并按 token 切块：只有一块时直接提问；否则最多 document_concurrency
+        块同时请求，各块的结果按 token 预算分组合并，直到剩下一组，返回最后一次合并的消息。
+        各块和中间合并的请求在调度器中以后台优先级排队，不挤占其他标签页的发送。
+        """
+        total = os.path.getsize(path)
+        chunk_tokens = max(256, min(self.document_chunk_tokens,
+                                    self.prompt_budget() - estimate_tokens(task) - 200))
+        
+        def report(stage, read, done):
+            if progress is not None:
+                progress(stage, read, total, done)
+        
+        # 读取和切块在线程中进行，不阻塞事件循环中其他标签页的流式回复
+        chunks = enumerate(read_chunks(path, chunk_tokens))
+        head = await asyncio.to_thread(lambda: list(itertools.islice(chunks, 2)))
+        if len(head) < 2:
+            text = head[0][1][0] if head else ""
+            final = [{"role": "user", "content": f"文档《{name}》:\n\n{text}\n\n任务: {task}"}]
+        else:
+            results = {}
+            read = 0
+            reading = asyncio.Lock()
+            
+            async def mapper():
+                nonlocal read
+                while True:
+                    # 各协程共用一个块迭代器，依次在线程中读取下一块
+                    async with reading:
+                        item = await asyncio.to_thread(next, chunks, None)
+                    if item is None:
+                        return
+                    index, (text, offset) = item
+                    read = max(read, offset)
+                    messages = [{"role": "system", "content": self.DOCUMENT_MAP_PROMPT},
+                                {"role": "user", "content": f"文档《{name}》的第 {index + 1} 部分:\n\n{text}\n\n任务: {task}"}]
+                    used_model, completion = await self._create(messages, priority=RequestScheduler.BACKGROUND)
+                    results[index] = completion.choices[0].message.content or ""
+                    report("map", read, len(results))
+            
+            chunks = itertools.chain(head, chunks)
+            await self.run_bounded(mapper() for _ in range(self.document_concurrency))
+            partials = [results[index] for index in sorted(results)]
+            
+            # 每组至少两项，保证每一轮都在减少
+            while True:
+                groups = [[]]
+                for partial in partials:
+                    group = groups[-1]
+                    if len(group) >= 2 and estimate_tokens("".join(group + [partial])) > chunk_tokens:
+                        groups.append([partial])
+                    else:
+                        group.append(partial)
+                if len(groups) == 1:
+                    break
+                partials = [None] * len(groups)
+                pending = iter(enumerate(groups))
+                
+                async def reducer():
+                    for index, group in pending:
+                        used_model, completion = await self._create(self.reduce_messages(group, task),
+                                                                    priority=RequestScheduler.BACKGROUND)
+                        partials[index] = completion.choices[0].message.content or ""
+                        report("reduce", total, sum(partial is not None for partial in partials))
+                
+                await self.run_bounded(reducer() for _ in range(self.document_concurrency))
+            final = self.reduce_messages(groups[0], task)
+        return final
+
+    def reduce_messages(self, partials, task):
+        """把若干块的结果合并为一次请求的消息列表"""
+        body = "\n\n".join(f"[第 {index + 1} 部分]\n{partial}" for index, partial in enumerate(partials))
+        return [{"role": "system", "content": self.DOCUMENT_REDUCE_PROMPT},
+                {"role": "user", "content": f"{body}\n\n任务: {task}"}]
+
+    @staticmethod
+    async def run_bounded(coroutines):
+        """并发运行若干协程，任一出错或被取消时取消其余协程"""
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def compare(self, prompt, models, on_delta=None, on_done=None):
+        """把同一条提示同时发给多个模型流式生成，返回各模型的请求统计样本（顺序与 models 相同）
+        
+        每个模型使用一个不做故障转移和对冲的分支，共用同一个客户端，总耗时取决于最慢的模型。
+        on_delta(序号, 增量) 和 on_done(序号, 样本) 在引擎线程中调用；
+        某个模型出错不影响其他模型，它的样本 outcome 为 "error"。不读写聊天历史和回复缓存。
+        """
+        messages = [{"role": "user", "content": prompt}]
+        if self.system_prompt:
+            messages.insert(0, {"role": "system", "content": self.system_prompt})
+        
+        async def run(index, model):
+            engine = self.fork(model=model, fallback_models=[], hedge_delay=0)
+            try:
+                used_model, deltas = await engine._open_stream(messages, model)
+                async for delta in deltas:
+                    if on_delta is not None:
+                        on_delta(index, delta)
+            except Exception:
+                # 错误已记录在样本中
+                pass
+            if on_done is not None:
+                on_done(index, engine.last_metrics)
+            return engine.last_metrics
+        
+        return await asyncio.gather(*(run(index, model) for index, model in enumerate(models)))
+
+class UiWatchdog:
+    """界面主循环卡顿诊断（可选）
+    
+    - 心跳：每 interval 秒用 after() 调度一次，实际触发时间比预定晚多少就是主循环延迟；
+    - 回调计时：替换 tkinter.CallWrapper，统计按钮命令、事件绑定和 after 回调的次数与耗时；
+    - 栈采样：后台线程发现心跳超过 threshold 秒没有到来时，抓取主线程当前的调用栈。
+    计时只对启用之后注册的回调生效，所以要在创建界面之前 start()。时间单位均为秒。
+    """
+    
+    def __init__(self, root, threshold=0.2, interval=0.1, window=2000):
+        self.root = root
+        self.threshold = threshold
+        self.interval = interval
+        self.lags = deque(maxlen=window)
+        self.handlers = {}      # 回调名称 -> [次数, 总耗时, 最大耗时]
+        self.stalls = deque(maxlen=50)
+        self.active = []        # 主线程正在执行的回调（嵌套时有多个）
+        self.pending = None     # 已经采样到、心跳尚未恢复的卡顿
+        self.lock = threading.Lock()
+        self.main_thread = threading.get_ident()
+        self.last_beat = None
+        self.running = False
+        self.call_wrapper = tk.CallWrapper
+
+    @staticmethod
+    def callback_name(func):
+        """回调的可读名称：方法名，lambda 附带文件和行号"""
+        # after() 把回调包在内部函数 callit 中（callit 的 __name__ 已改为原回调的名称）
+        code = getattr(func, "__code__", None)
+        if code is not None and code.co_name == "callit" and func.__closure__:
+            cells = dict(zip(code.co_freevars, func.__closure__))
+            if "func" in cells:
+                func = cells["func"].cell_contents
+        func = getattr(func, "__func__", func)
+        name = getattr(func, "__qualname__", None) or repr(func)
+        code = getattr(func, "__code__", None)
+        if "<lambda>" in name and code is not None:
+            name += f" ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return name
+
+    def start(self):
+        """开始心跳和回调计时，返回自身"""
+        watchdog = self
+        
+        class TimedCallWrapper(self.call_wrapper):
+            def __init__(self, func, subst, widget):
+                super().__init__(func, subst, widget)
+                self.name = watchdog.callback_name(func)
+            
+            def __call__(self, *args):
+                watchdog.active.append(self.name)
+                start = time.perf_counter()
+                try:
+                    return super().__call__(*args)
+                finally:
+                    watchdog.active.pop()
+                    watchdog.record_handler(self.name, time.perf_counter() - start)
+        
+        tk.CallWrapper = TimedCallWrapper
+        self.running = True
+        self.last_beat = time.perf_counter()
+        self.root.after(int(self.interval * 1000), self.beat)
+        threading.Thread(target=self.watch, daemon=True).start()
+        return self
+
+    def stop(self):
+        """停止诊断并恢复 tkinter 的回调包装"""
+        self.running = False
+        tk.CallWrapper = self.call_wrapper
+
+    def record_handler(self, name, elapsed):
+        with self.lock:
+            stats = self.handlers.get(name)
+            if stats is None:
+                stats = self.handlers[name] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def beat(self):
+        """心跳（主线程）：记录延迟，超过阈值时结束一次卡顿记录"""
+        now = time.perf_counter()
+        with self.lock:
+            lag = max(0.0, now - self.last_beat - self.interval)
+            self.lags.append(lag)
+            if lag >= self.threshold:
+                stall = self.pending or {"time": time.time() - lag, "handler": "", "stacks": {}}
+                stall["duration"] = lag
+                self.stalls.append(stall)
+            self.pending = None
+            self.last_beat = now
+        if self.running:
+            self.root.after(int(self.interval * 1000), self.beat)
+
+    def watch(self):
+        """后台线程：心跳迟迟不到时采样主线程的调用栈"""
+        while self.running:
+            time.sleep(self.threshold / 2)
+            with self.lock:
+                if time.perf_counter() - self.last_beat - self.interval < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.main_thread)
+                stack = "".join(traceback.format_stack(frame, limit=20)) if frame is not None else ""
+                if self.pending is None:
+                    self.pending = {"time": time.time(), "handler": " > ".join(self.active), "stacks": {}}
+                stacks = self.pending["stacks"]
+                stacks[stack] = stacks.get(stack, 0) + 1
+
+    def report(self):
+        """生成文本诊断报告"""
+        with self.lock:
+            lags = sorted(self.lags)
+            handlers = sorted(((name, list(stats)) for name, stats in self.handlers.items()),
+                              key=lambda item: -item[1][1])
+            stalls = list(self.stalls)
+        
+        lines = [f"诊断时间: {datetime.now():%Y-%m-%d %H:%M:%S}  卡顿阈值: {self.threshold * 1000:.0f} ms", ""]
+        if lags:
+            p = {q: lags[min(len(lags) - 1, len(lags) * q // 100)] * 1000 for q in (50, 90, 99)}
+            lines.append(f"主循环延迟（最近 {len(lags)} 次心跳）: p50 {p[50]:.1f} ms  p90 {p[90]:.1f} ms  "
+                         f"p99 {p[99]:.1f} ms  最大 {lags[-1] * 1000:.1f} ms")
+        
+        lines += ["", "回调耗时（按总耗时排序；回调中弹出对话框时包含等待用户的时间）:",
+                  f"  {'总计 ms':>10}{'次数':>8}{'平均 ms':>10}{'最大 ms':>10}  回调"]
+        for name, (count, total, peak) in handlers[:30]:
+            lines.append(f"  {total * 1000:>10.1f}{count:>8}{total / count * 1000:>10.2f}{peak * 1000:>10.1f}  {name}")
+        
+        lines += ["", f"卡顿记录（{len(stalls)} 次，最新的在前）:"]
+        for stall in reversed(stalls):
+            when = datetime.fromtimestamp(stall["time"]).strftime("%H:%M:%S")
+            lines.append(f"[{when}] 阻塞 {stall['duration'] * 1000:.0f} ms  回调: {stall['handler'] or '(未知)'}")
+            for stack, count in sorted(stall["stacks"].items(), key=lambda item: -item[1]):
+                lines.append(f"  采样 {count} 次:")
+                lines += ["    " + line for line in stack.rstrip().splitlines()]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """把诊断报告写入文件"""
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.report())
+
+def configure_chat_tags(text_widget, dark=False):
+    """设置聊天文本控件的角色和 Markdown 标签样式，dark 为 True 时使用深色主题的颜色"""
+    # 基础标签
+    text_widget.tag_configure("user", foreground="#0066cc", font=("Microsoft YaHei", 10, "bold"))
+    text_widget.tag_configure("assistant", foreground="#00aa00", font=("Microsoft YaHei", 10))
+    text_widget.tag_configure("error", foreground="#cc0000", font=("Microsoft YaHei", 10))
+    text_widget.tag_configure("timestamp", foreground="#888888", font=("Microsoft YaHei", 8))
+    text_widget.tag_configure("system", foreground="#666666", font=("Microsoft YaHei", 9, "italic"))
+    
+    # Markdown标签样式
+    text_widget.tag_configure("h1", font=("Microsoft YaHei", 16, "bold"), spacing1=10, spacing3=5)
+    text_widget.tag_configure("h2", font=("Microsoft YaHei", 14, "bold"), spacing1=8, spacing3=4)
+    text_widget.tag_configure("h3", font=("Microsoft YaHei", 12, "bold"), spacing1=6, spacing3=3)
+    text_widget.tag_configure("bold", font=("Microsoft YaHei", 10, "bold"))
+    text_widget.tag_configure("italic", font=("Microsoft YaHei", 10, "italic"))
+    text_widget.tag_configure("code_inline", font=("Consolas", 9), background="#f6f8fa")
+    text_widget.tag_configure("code_block", font=("Consolas", 9), background="#f6f8fa", lmargin1=20, lmargin2=20)
+    text_widget.tag_configure("list_item", lmargin1=20, lmargin2=30)
+    text_widget.tag_configure("table_header", font=("Microsoft YaHei", 10, "bold"), background="#f0f0f0")
+    text_widget.tag_configure("table_cell", font=("Microsoft YaHei", 10))
+    text_widget.tag_configure("quote", font=("Microsoft YaHei", 10, "italic"), foreground="#666666", lmargin1=20, lmargin2=20)
+    
+    # 深色主题覆盖部分颜色
+    if dark:
+        text_widget.tag_configure("user", foreground="#87CEEB", font=("Microsoft YaHei", 10, "bold"))
+        text_widget.tag_configure("assistant", foreground="#90EE90", font=("Microsoft YaHei", 10))
+        text_widget.tag_configure("error", foreground="#FF6B6B", font=("Microsoft YaHei", 10))
+        text_widget.tag_configure("system", foreground="#BBBBBB", font=("Microsoft YaHei", 9, "italic"))
+        text_widget.tag_configure("code_inline", background="#404040")
+        text_widget.tag_configure("code_block", background="#404040")
+        text_widget.tag_configure("table_header", background="#404040")
+
+class ChatTab:
+    """一个标签页中的独立会话
+
+    每个标签页有自己的聊天记录窗口、上下文历史、模型和采样参数，
+    以及各自的进行中请求；客户端、事件循环和会话存储由 ChatApp 共享。
+    """
+    # 存储中的角色与界面显示名称的对应
+    ROLE_LABELS = {"user": "用户", "assistant": "助手", "system": "系统"}
+    # 助手回复末尾的标注：缓存命中、被用户中断
+    REPLY_MARKS = {"cached": "⚡ 缓存回复\n", "truncated": "⏹ 回复已中断\n"}
+    
+    def __init__(self, app, title):
+        self.app = app
+        self.root = app.root
+        self.loop = app.loop
+        self.store = app.store
+        self.page_size = app.page_size
+        self.title = title
+        
+        # 独立的引擎：历史和采样参数属于本标签页，客户端与缓存与其他标签页共享
+        self.engine = app.engine.fork()
+        self.engine.on_message = self.record_message
+        self.engine.on_unrecord = self.unrecord_message
+        self.engine.on_queue = self.show_queue
+        
+        self.stream_renderer = None
+        self.stream_record = None
+        self.stream_parts = []
+        self.request_active = False
+        self.request_future = None
+        # 标签页已关闭：之后到达的界面回调直接丢弃
+        self.closed = False
+        # 待发送的附件 (路径, 是否为粘贴生成的临时文件)，内容不进入输入框
+        self.attachment = None
+        
+        # 聊天记录窗口：records 保存全部消息源记录，
+        # 文本控件中只渲染 records[rendered_lo:rendered_hi]
+        self.records = []
+        self.record_ids = itertools.count()
+        self.rendered_lo = 0
+        self.rendered_hi = 0
+        
+        # 当前会话在发送第一条消息时才创建
+        self.session_id = None
+        self.oldest_message_id = None   # 已加载的最早消息 id，None 表示没有更早的消息
+        self.last_message_id = None     # 最近写入存储的消息 id，撤回时删除
+        self.message_records = {}       # 存储中的消息 id -> 记录 id，搜索结果据此定位到具体的一条
+        self.loading_older = False
+        
+        self.create_widgets(app.notebook)
+        app.notebook.add(self.frame, text=title)
+
+    def create_widgets(self, parent):
+        """创建标签页内的聊天区域和输入区域"""
+        self.frame = ttk.Frame(parent, padding="5")
+        
+        # 聊天显示区域
+        chat_frame = ttk.LabelFrame(self.frame, text="聊天记录", padding="5")
+        chat_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
+        
+        self.chat_display = scrolledtext.ScrolledText(
+            chat_frame, 
+            wrap=tk.WORD, 
+            state=tk.DISABLED,
+            font=("Microsoft YaHei", 10),
+            height=20
+        )
+        self.chat_display.pack(fill=tk.BOTH, expand=True)
+        # 滚动到顶部时分页加载更早的消息
+        self.chat_display.config(yscrollcommand=self.on_chat_scroll)
+        # 代码块语法高亮（可选）：渲染器在代码块结束时通知高亮器
+        self.highlighter = None
+        self.on_code_block = None
+        if self.app.highlight_executor is not None:
+            self.highlighter = CodeHighlighter(self.chat_display, self.root, self.app.highlight_executor)
+            self.on_code_block = self.highlighter.add
+        
+        # 输入框架
+        input_frame = ttk.LabelFrame(self.frame, text="输入消息", padding="5")
+        input_frame.pack(fill=tk.X)
+        
+        # 本标签页的采样参数
+        params_frame = ttk.Frame(input_frame)
+        params_frame.pack(fill=tk.X, pady=(0, 5))
+        
+        ttk.Label(params_frame, text="温度:").pack(side=tk.LEFT)
+        self.temperature_var = tk.StringVar(value=str(self.engine.temperature))
+        ttk.Spinbox(params_frame, textvariable=self.temperature_var, from_=0.0, to=2.0,
+                    increment=0.1, width=6).pack(side=tk.LEFT, padx=(5, 20))
+        
+        ttk.Label(params_frame, text="最大 tokens:").pack(side=tk.LEFT)
+        self.max_tokens_var = tk.StringVar(value=str(self.engine.max_tokens))
+        ttk.Spinbox(params_frame, textvariable=self.max_tokens_var, from_=1, to=32768,
+                    increment=100, width=8).pack(side=tk.LEFT, padx=(5, 0))
+        
+        # 附件：大文件流式读取、分块处理，不放进输入框；点击附件名称取消
+        ttk.Button(params_frame, text="附件...", command=self.choose_attachment).pack(side=tk.LEFT, padx=(20, 0))
+        self.attachment_label = ttk.Label(params_frame, text="", cursor="hand2")
+        self.attachment_label.pack(side=tk.LEFT, padx=(5, 0))
+        self.attachment_label.bind("<Button-1>", lambda e: self.set_attachment(None))
+        self.progress_label = ttk.Label(params_frame, text="")
+        self.progress_label.pack(side=tk.RIGHT)
+        
+        # 输入区域容器
+        input_container = ttk.Frame(input_frame)
+        input_container.pack(fill=tk.BOTH, expand=True)
+        
+        # 消息输入框
+        self.message_entry = tk.Text(
+            input_container, 
+            height=4,
+            font=("Microsoft YaHei", 10),
+            wrap=tk.WORD
+        )
+        self.message_entry.pack(fill=tk.BOTH, side=tk.LEFT, expand=True)
+        
+        # 发送按钮框架
+        button_frame = ttk.Frame(input_container)
+        button_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(10, 0))
+        
+        # 发送按钮
+        self.send_button = ttk.Button(button_frame, text="发送\n(Ctrl+Enter)", command=self.send_message)
+        self.send_button.pack(fill=tk.X, pady=(0, 5))
+        
+        # 停止按钮
+        self.stop_button = ttk.Button(button_frame, text="停止\n(Esc)", command=self.stop_request, state="disabled")
+        self.stop_button.pack(fill=tk.X, pady=(0, 5))
+        
+        # 清空按钮
+        clear_button = ttk.Button(button_frame, text="清空历史", command=self.clear_chat)
+        clear_button.pack(fill=tk.X)
+        
+        # 绑定快捷键
+        self.message_entry.bind("<Control-Return>", lambda e: self.send_message())
+        self.message_entry.bind("<<Paste>>", self.on_paste)
+        
+        # 配置聊天显示的标签样式
+        self.setup_chat_tags()
+
+    def apply_theme(self, theme, dark):
+        """把主题颜色应用到本标签页的文本控件"""
+        # 配置聊天显示区域
+        self.chat_display.config(
+            bg=theme["chat_bg"],
+            fg=theme["fg"],
+            insertbackground=theme["fg"],
+            selectbackground=theme["select_bg"],
+            selectforeground=theme["select_fg"]
+        )
+        
+        # 配置输入框
+        self.message_entry.config(
+            bg=theme["entry_bg"],
+            fg=theme["entry_fg"],
+            insertbackground=theme["fg"],
+            selectbackground=theme["select_bg"],
+            selectforeground=theme["select_fg"]
+        )
+        
+        # 重新配置聊天标签颜色以适应主题
+        self.setup_chat_tags(dark)
+
+    def set_title(self, title):
+        """更新标签页标题"""
+        self.title = title
+        self.app.notebook.tab(self.frame, text=title)
+
+    def set_model(self, model):
+        """切换本标签页使用的模型"""
+        self.engine.model = model
+        self.engine.last_model = model
+
+    def read_sampling_params(self):
+        """读取采样参数输入框，无效时提示并返回 False"""
+        try:
+            temperature = float(self.temperature_var.get())
+            max_tokens = int(self.max_tokens_var.get())
+        except ValueError:
+            messagebox.showerror("错误", "温度和最大 tokens 必须是数字")
+            return False
+        if not 0 <= temperature <= 2 or max_tokens <= 0:
+            messagebox.showerror("错误", "温度应在 0 到 2 之间，最大 tokens 应大于 0")
+            return False
+        self.engine.temperature = temperature
+        self.engine.max_tokens = max_tokens
+        return True
+
+    def setup_chat_tags(self, dark=False):
+        """设置聊天显示的标签样式和Markdown支持"""
+        configure_chat_tags(self.chat_display, dark)
+        if self.highlighter is not None:
+            self.highlighter.configure_tags(dark)
+        # 搜索命中的高亮（最后创建，优先级最高）
+        self.chat_display.tag_configure("search_hit", background="#ffe066", foreground="#000000")
+
+    def parse_and_insert_markdown(self, content, base_tag="assistant", index=tk.END):
+        """解析并插入Markdown格式的内容"""
+        self.chat_display.config(state=tk.NORMAL)
+        
+        MarkdownRenderer(self.chat_display, base_tag, index, self.on_code_block).render(content)
+        
+        self.chat_display.config(state=tk.DISABLED)
+
+    def add_message(self, role, content, tag="assistant", created=None):
+        """添加消息到聊天显示区域末尾"""
+        record = self.new_record(role, content, tag, created)
+        self.render_record(record, tk.END)
+        self.rendered_hi = len(self.records)
+        self.trim_transcript(keep_bottom=True)
+        self.chat_display.see(tk.END)
+
+    def new_record(self, role, content, tag, created=None):
+        """创建消息源记录并追加到记录列表（窗口不在末尾时先跳回最新）"""
+        self.show_latest()
+        record = [next(self.record_ids), role, content, tag, created if created is not None else time.time()]
+        self.records.append(record)
+        return record
+
+    def render_record(self, record, index):
+        """在指定位置渲染一条消息记录，并以标记记录其起始位置"""
+        record_id, role, content, tag, created = record
+        self.chat_display.config(state=tk.NORMAL)
+        
+        # 起始标记渲染期间为左引力；渲染完成后改为右引力，
+        # 这样在它之前插入（向上翻页）时标记会随内容后移
+        start = f"msg{record_id}"
+        self.chat_display.mark_set(start, "end-1c" if index == tk.END else index)
+        self.chat_display.mark_gravity(start, tk.LEFT)
+        
+        # 右引力插入标记，连续插入时自动后移
+        at = "msg_insert"
+        self.chat_display.mark_set(at, start)
+        self.chat_display.mark_gravity(at, tk.RIGHT)
+        
+        # 添加时间戳
+        timestamp = datetime.fromtimestamp(created).strftime("%H:%M:%S")
+        self.chat_display.insert(at, f"[{timestamp}] ", "timestamp")
+        
+        # 添加角色标识
+        if role == "用户":
+            self.chat_display.insert(at, f"{role}: ", "user")
+            self.chat_display.insert(at, f"{content}\n\n")
+        elif role == "助手":
+            self.chat_display.insert(at, f"{role}: \n", "assistant")
+            # 使用Markdown解析器处理AI回复
+            self.parse_and_insert_markdown(content, "assistant", at)
+            self.chat_display.config(state=tk.NORMAL)
+            if tag in self.REPLY_MARKS:
+                self.chat_display.insert(at, self.REPLY_MARKS[tag], "system")
+            self.chat_display.insert(at, "\n")
+        else:
+            self.chat_display.insert(at, f"{role}: ", tag)
+            self.chat_display.insert(at, f"{content}\n\n")
+        
+        self.chat_display.mark_gravity(start, tk.RIGHT)
+        self.chat_display.config(state=tk.DISABLED)
+
+    def unrender_records(self, lo, hi):
+        """从文本控件中删除 records[lo:hi]（必须位于已渲染窗口的一端）"""
+        if lo >= hi:
+            return
+        first = f"msg{self.records[lo][0]}"
+        last = f"msg{self.records[hi][0]}" if hi < self.rendered_hi else "end-1c"
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.delete(first, last)
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.mark_unset(*(f"msg{record[0]}" for record in self.records[lo:hi]))
+
+    def trim_transcript(self, keep_bottom):
+        """窗口模式下把已渲染消息数限制在 transcript_window 以内"""
+        excess = self.rendered_hi - self.rendered_lo - self.app.transcript_window
+        if self.app.transcript_window <= 0 or excess <= 0:
+            return
+        if keep_bottom:
+            self.unrender_records(self.rendered_lo, self.rendered_lo + excess)
+            self.rendered_lo += excess
+        else:
+            self.unrender_records(self.rendered_hi - excess, self.rendered_hi)
+            self.rendered_hi -= excess
+
+    def show_latest(self):
+        """窗口已离开末尾时，重新渲染最新的一段消息"""
+        if self.rendered_hi == len(self.records):
+            return
+        self.unrender_records(self.rendered_lo, self.rendered_hi)
+        window = self.app.transcript_window if self.app.transcript_window > 0 else len(self.records)
+        self.rendered_lo = self.rendered_hi = max(0, len(self.records) - window)
+        for record in self.records[self.rendered_lo:]:
+            self.render_record(record, tk.END)
+            self.rendered_hi += 1
+
+    def stored_records(self, rows):
+        """把从存储读取的消息行转换为源记录，并登记消息 id 与记录 id 的对应"""
+        records = []
+        for msg_id, role, content, tokens, created in rows:
+            record = [next(self.record_ids), self.ROLE_LABELS.get(role, role), content, role, created]
+            self.message_records[msg_id] = record[0]
+            records.append(record)
+        return records
+
+    def find_stored_record(self, message_id):
+        """在已加载的记录中查找存储中的一条消息，不是从存储加载的（本次新发送的）返回 None"""
+        record_id = self.message_records.get(message_id)
+        if record_id is None:
+            return None
+        return next((index for index, record in enumerate(self.records) if record[0] == record_id), None)
+
+    def find_record(self, role, content):
+        """在已加载的记录中按角色和内容查找一条消息（从最新的开始），找不到返回 None"""
+        label = self.ROLE_LABELS.get(role, role)
+        for index in range(len(self.records) - 1, -1, -1):
+            if self.records[index][1] == label and self.records[index][2] == content:
+                return index
+        return None
+
+    def show_record(self, index, terms=()):
+        """把渲染窗口移到 records[index] 附近并滚动过去，高亮其中的搜索词"""
+        if not self.rendered_lo <= index < self.rendered_hi:
+            self.unrender_records(self.rendered_lo, self.rendered_hi)
+            window = self.app.transcript_window if self.app.transcript_window > 0 else len(self.records)
+            self.rendered_lo = self.rendered_hi = max(0, min(index - window // 2, len(self.records) - window))
+            for record in self.records[self.rendered_lo:self.rendered_lo + window]:
+                self.render_record(record, tk.END)
+                self.rendered_hi += 1
+        
+        start = f"msg{self.records[index][0]}"
+        end = f"msg{self.records[index + 1][0]}" if index + 1 < self.rendered_hi else "end-1c"
+        self.chat_display.tag_remove("search_hit", "1.0", tk.END)
+        first = None
+        for term in terms:
+            pos = start
+            while True:
+                pos = self.chat_display.search(term, pos, stopindex=end, nocase=True)
+                if not pos:
+                    break
+                after = f"{pos}+{len(term)}c"
+                self.chat_display.tag_add("search_hit", pos, after)
+                if first is None or self.chat_display.compare(pos, "<", first):
+                    first = pos
+                pos = after
+        self.chat_display.see(start)
+        if first is not None:
+            self.chat_display.see(first)
+
+    def record_message(self, role, content, tokens):
+        """引擎回调：把新消息追加写入会话存储"""
+        if self.store is None:
+            return
+        try:
+            if self.session_id is None:
+                self.session_id = self.store.create_session(self.engine.model)
+            self.last_message_id = self.store.append(self.session_id, role, content, tokens)
+        except sqlite3.Error as e:
+            print(f"会话保存失败: {e}")
+
+    def unrecord_message(self):
+        """引擎回调：从会话存储中删除被撤回的最后一条消息"""
+        if self.store is None or self.last_message_id is None:
+            return
+        try:
+            self.store.delete_message(self.last_message_id)
+        except sqlite3.Error as e:
+            print(f"会话保存失败: {e}")
+        self.last_message_id = None
+
+    def send_message(self):
+        """发送消息"""
+        if self.request_active:
+            return
+        if not self.engine.client:
+            # 后台线程刚创建的客户端可能还没分发到本标签页
+            self.engine.client = self.app.engine.client
+        if not self.engine.client:
+            messagebox.showerror("错误", "请先连接 API")
+            return
+            
+        message = self.message_entry.get("1.0", tk.END).strip()
+        attachment = self.attachment
+        if (not message and attachment is None) or not self.read_sampling_params():
+            return
+            
+        # 清空输入框和附件（临时文件在处理完成后删除）
+        self.message_entry.delete("1.0", tk.END)
+        self.attachment = None
+        self.attachment_label.config(text="")
+        
+        # 新会话的第一条消息作为标签页标题
+        if self.session_id is None and not self.engine.history.messages:
+            self.set_title((message or os.path.basename(attachment[0]))[:12].replace("\n", " "))
+        
+        # 添加用户消息到显示区域
+        if attachment is not None:
+            self.add_message("用户", f"📎 {os.path.basename(attachment[0])}\n{message}".rstrip(), "user")
+        else:
+            self.add_message("用户", message, "user")
+        
+        # 禁用发送按钮，防止重复发送
+        self.request_active = True
+        self.send_button.config(state="disabled", text="发送中...")
+        self.stop_button.config(state="normal")
+        
+        # 提交到引擎的事件循环，记录提交时间以统计排队时间
+        submitted = time.perf_counter()
+        if attachment is not None:
+            coroutine = self.call_document(*attachment, message)
+        else:
+            coroutine = self.call_api(message, submitted)
+        self.request_future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def choose_attachment(self):
+        """选择要作为附件发送的文本文件"""
+        path = filedialog.askopenfilename(
+            parent=self.frame, title="选择附件",
+            filetypes=[("文本文件", "*.txt *.log *.md *.csv *.json *.xml *.py"), ("所有文件", "*.*")])
+        if path:
+            self.set_attachment(path)
+
+    def set_attachment(self, path, temporary=False):
+        """设置待发送的附件，path 为 None 时取消（删除未发送的临时文件）"""
+        self.discard_attachment()
+        self.attachment = (path, temporary) if path else None
+        if path is None:
+            self.attachment_label.config(text="")
+            return
+        size = os.path.getsize(path) / 1024
+        size = f"{size / 1024:.1f} MB" if size >= 1024 else f"{size:.0f} KB"
+        self.attachment_label.config(text=f"📎 {os.path.basename(path)} ({size}) ✕")
+
+    def discard_attachment(self):
+        """丢弃待发送的附件，粘贴生成的临时文件随之删除（替换、取消附件和关闭标签页时调用）"""
+        if self.attachment is not None and self.attachment[1]:
+            remove_file(self.attachment[0])
+        self.attachment = None
+
+    def on_paste(self, event):
+        """粘贴超长文本时保存为临时文件并作为附件，避免输入框卡顿"""
+        try:
+            text = self.root.clipboard_get()
+        except tk.TclError:
+            return None
+        if len(text) < self.app.paste_attachment_chars:
+            return None
+        fd, path = tempfile.mkstemp(prefix="paste-", suffix=".txt")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        self.set_attachment(path, temporary=True)
+        return "break"
+
+    def stop_request(self):
+        """取消进行中的请求：任务被取消后底层 HTTP 流随之关闭"""
+        if self.request_future is None or self.request_future.done():
+            return
+        self.stop_button.config(state="disabled")
+        self.request_future.cancel()
+
+    def post(self, callback):
+        """从引擎线程把界面更新交给 Tk 主线程执行，标签页关闭后不再执行"""
+        self.root.after(0, lambda: self.closed or callback())
+
+    async def call_api(self, message, submitted=None):
+        """在引擎事件循环中调用 API，并把结果转发到 Tk 主线程"""
+        try:
+            if self.app.stream:
+                self.post(self.begin_stream_message)
+                first = True
+                async for delta in self.engine.ask_stream(message, submitted):
+                    self.post(lambda d=delta: self.append_stream_delta(d))
+                    if first and not self.engine.last_reply_cached:
+                        # 首个 token 到达时先显示首 token 时间
+                        self.report_metrics()
+                    first = False
+                cached = self.engine.last_reply_cached
+                self.post(lambda: self.finish_stream_message(cached))
+                self.report_failover()
+                if not cached:
+                    self.report_metrics()
+                return
+            
+            response = await self.engine.ask(message, submitted)
+            cached = self.engine.last_reply_cached
+            
+            # 在主线程中更新 UI
+            self.post(lambda: self.handle_api_response(response, cached))
+            self.report_failover()
+            if not cached:
+                self.report_metrics()
+            
+        except asyncio.CancelledError:
+            self.post(self.handle_api_cancelled)
+            raise
+        except Exception as e:
+            error_msg = f"API 调用失败: {str(e)}"
+            self.post(lambda: self.handle_api_error(error_msg))
+
+    async def call_document(self, path, temporary, question):
+        """在引擎事件循环中处理附件：进度显示在标签页中，最终回复以流式显示"""
+        def progress(stage, read, total, done):
+            if stage == "map":
+                text = f"附件已读 {read / max(total, 1):.0%} · 已完成 {done} 块"
+            else:
+                text = f"合并结果 · 已完成 {done} 组"
+            self.post(lambda: self.progress_label.config(text=text))
+        
+        try:
+            self.post(self.begin_stream_message)
+            self.post(lambda: self.progress_label.config(text="正在读取附件..."))
+            async for delta in self.engine.ask_document(path, question, progress):
+                self.post(lambda d=delta: self.append_stream_delta(d))
+            self.post(self.finish_stream_message)
+            self.report_failover()
+            self.report_metrics()
+        except asyncio.CancelledError:
+            self.post(self.handle_api_cancelled)
+            raise
+        except Exception as e:
+            error_msg = f"附件处理失败: {str(e)}"
+            self.post(lambda: self.handle_api_error(error_msg))
+        finally:
+            if temporary:
+                remove_file(path)
+
+    def show_queue(self, position, wait):
+        """引擎线程：请求因限速排队时在标签页中显示排队位置和预计等待，开始发出时清除"""
+        if position:
+            text = f"限速排队中 · 第 {position} 位 · 预计 {format_wait(wait)}"
+        else:
+            text = ""
+        self.post(lambda: self.progress_label.config(text=text))
+
+    def report_metrics(self):
+        """把最近一次请求的统计交给状态栏显示"""
+        sample = dict(self.engine.last_metrics)
+        self.post(lambda: self.app.show_metrics(sample))
+
+    def report_failover(self):
+        """回复来自备用模型时在聊天记录中说明"""
+        used_model = self.engine.last_model
+        if used_model != self.engine.model:
+            self.post(lambda: self.add_message("系统", f"{self.engine.model} 不可用，已由 {used_model} 回复", "system"))
+
+    def begin_stream_message(self):
+        """为流式回复插入消息头，并记录正文起始位置"""
+        record = self.new_record("助手", "", "assistant")
+        self.stream_record = record
+        self.stream_parts = []
+        
+        self.chat_display.config(state=tk.NORMAL)
+        
+        start = f"msg{record[0]}"
+        self.chat_display.mark_set(start, "end-1c")
+        self.chat_display.mark_gravity(start, tk.LEFT)
+        
+        timestamp = datetime.fromtimestamp(record[4]).strftime("%H:%M:%S")
+        self.chat_display.insert(tk.END, f"[{timestamp}] ", "timestamp")
+        self.chat_display.insert(tk.END, "助手: \n", "assistant")
+        
+        # 增量渲染器：每个增量只渲染新完成的行
+        self.stream_renderer = MarkdownRenderer(self.chat_display, "assistant", on_code=self.on_code_block)
+        
+        self.chat_display.see(tk.END)
+        self.chat_display.config(state=tk.DISABLED)
+        self.rendered_hi = len(self.records)
+
+    def append_stream_delta(self, delta):
+        """追加一段流式增量文本"""
+        self.stream_parts.append(delta)
+        self.chat_display.config(state=tk.NORMAL)
+        self.stream_renderer.feed(delta)
+        self.chat_display.see(tk.END)
+        self.chat_display.config(state=tk.DISABLED)
+
+    def finish_stream_message(self, cached=False, truncated=False):
+        """流式结束，提交渲染器中剩余的末行"""
+        self.chat_display.config(state=tk.NORMAL)
+        self.stream_renderer.finish()
+        self.stream_renderer = None
+        mark = "cached" if cached else "truncated" if truncated else None
+        if mark:
+            self.chat_display.insert(tk.END, self.REPLY_MARKS[mark], "system")
+            self.stream_record[3] = mark
+        self.chat_display.insert(tk.END, "\n")
+        self.chat_display.mark_gravity(f"msg{self.stream_record[0]}", tk.RIGHT)
+        self.chat_display.see(tk.END)
+        self.chat_display.config(state=tk.DISABLED)
+        
+        # 源记录保存完整文本，供窗口模式重新渲染
+        self.stream_record[2] = "".join(self.stream_parts)
+        self.stream_record = None
+        self.trim_transcript(keep_bottom=True)
+        
+        self.end_request()
+        self.app.update_cache_status()
+
+    def handle_api_response(self, response, cached=False):
+        """处理 API 响应"""
+        self.add_message("助手", response, "cached" if cached else "assistant")
+        self.app.update_cache_status()
+        self.end_request()
+
+    def end_request(self):
+        """请求结束，恢复输入"""
+        self.request_active = False
+        self.request_future = None
+        self.progress_label.config(text="")
+        self.send_button.config(state="normal", text="发送\n(Ctrl+Enter)")
+        self.stop_button.config(state="disabled")
+
+    def handle_api_cancelled(self):
+        """处理用户中断：保留已收到的部分并标注；一个增量都没收到时移除空的回复气泡"""
+        if self.stream_renderer is not None and any(self.stream_parts):
+            self.finish_stream_message(truncated=True)
+        else:
+            if self.stream_renderer is not None:
+                self.discard_stream_message()
+            self.add_message("系统", "请求已停止", "system")
+        self.end_request()
+
+    def discard_stream_message(self):
+        """删除还没有内容的流式回复消息头"""
+        self.stream_renderer.finish()
+        self.stream_renderer = None
+        self.unrender_records(len(self.records) - 1, len(self.records))
+        self.records.pop()
+        self.rendered_hi = len(self.records)
+        self.stream_record = None
+
+    def handle_api_error(self, error_msg):
+        """处理 API 错误"""
+        # 流式中途出错时保留已收到的部分
+        if self.stream_renderer is not None:
+            self.finish_stream_message()
+        self.add_message("错误", error_msg, "error")
+        self.end_request()
+
+    def clear_chat(self):
+        """清空聊天记录（已保存的会话保留在历史会话中）"""
+        if self.request_active:
+            messagebox.showinfo("提示", "请等待当前回复完成")
+            return
+        if messagebox.askyesno("确认", "确定要清空所有聊天记录吗？"):
+            self.reset_session()
+            self.add_message("系统", "聊天记录已清空", "system")
+
+    def reset_session(self, session_id=None):
+        """清空显示和上下文，切换到指定会话（None 表示新会话）"""
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.delete("1.0", tk.END)
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.mark_unset(*(f"msg{record[0]}" for record in self.records[self.rendered_lo:self.rendered_hi]))
+        self.records = []
+        self.rendered_lo = self.rendered_hi = 0
+        self.engine.history.clear()
+        self.session_id = session_id
+        self.oldest_message_id = None
+        self.last_message_id = None
+        self.message_records = {}
+
+    def new_session(self):
+        """开始新会话"""
+        if self.request_active:
+            messagebox.showinfo("提示", "请等待当前回复完成")
+            return
+        self.reset_session()
+        self.add_message("系统", "已开始新会话", "system")
+
+    def open_session(self, session_id, around_id=None, terms=()):
+        """打开历史会话，只加载末尾一页消息
+        
+        指定 around_id 时（跳转到搜索结果）改为加载该消息之前的一页和它之后的全部消息，
+        并把窗口移到该消息处；上下文仍然只取末尾一页。
+        """
+        if self.request_active:
+            messagebox.showinfo("提示", "请等待当前回复完成")
+            return
+        self.reset_session(session_id)
+        
+        older = self.store.load_messages(session_id, self.page_size, around_id)
+        rows = older if around_id is None else older + self.store.load_messages_from(session_id, around_id)
+        for msg_id, role, content, tokens, created in rows[-self.page_size:]:
+            self.engine.history.append({"role": role, "content": content}, tokens)
+        self.records = self.stored_records(rows)
+        
+        if len(older) == self.page_size:
+            self.oldest_message_id = rows[0][0]
+        
+        if around_id is None:
+            self.show_latest()
+            self.chat_display.see(tk.END)
+        elif len(older) < len(rows):
+            self.show_record(len(older), terms)
+
+    def on_chat_scroll(self, first, last):
+        """滚动条回调：到达顶部或底部时调度加载窗口外的消息"""
+        self.chat_display.vbar.set(first, last)
+        if self.highlighter is not None:
+            self.highlighter.schedule()
+        # 流式回复进行中不移动窗口，避免移出正在写入的消息
+        if self.loading_older or self.stream_renderer is not None:
+            return
+        has_earlier = self.rendered_lo > 0 or self.oldest_message_id is not None
+        if float(first) <= 0.0 and has_earlier:
+            self.loading_older = True
+            self.root.after_idle(self.load_older_messages)
+        elif float(last) >= 1.0 and self.rendered_hi < len(self.records):
+            self.loading_older = True
+            self.root.after_idle(self.load_newer_messages)
+
+    def load_older_messages(self):
+        """在顶部渲染上一页消息（必要时先从存储读取），并保持当前可见位置"""
+        self.loading_older = False
+        
+        if self.rendered_lo == 0 and self.oldest_message_id is not None:
+            rows = self.store.load_messages(self.session_id, self.page_size, self.oldest_message_id)
+            self.oldest_message_id = rows[0][0] if len(rows) == self.page_size else None
+            older = self.stored_records(rows)
+            self.records[0:0] = older
+            self.rendered_lo += len(older)
+            self.rendered_hi += len(older)
+        
+        if self.rendered_lo == 0:
+            return
+        
+        self.chat_display.mark_set("view_anchor", "@0,0")
+        self.chat_display.mark_set("page_insert", "1.0")
+        self.chat_display.mark_gravity("page_insert", tk.RIGHT)
+        new_lo = max(0, self.rendered_lo - self.page_size)
+        for record in self.records[new_lo:self.rendered_lo]:
+            self.render_record(record, "page_insert")
+        self.rendered_lo = new_lo
+        self.trim_transcript(keep_bottom=False)
+        
+        # 原先可见的第一行现在位于插入内容之后
+        self.chat_display.yview("view_anchor")
+
+    def load_newer_messages(self):
+        """在底部渲染下一页消息，并从顶部移出超出窗口的消息"""
+        self.loading_older = False
+        
+        self.chat_display.mark_set("view_anchor", "@0,0")
+        new_hi = min(len(self.records), self.rendered_hi + self.page_size)
+        for record in self.records[self.rendered_hi:new_hi]:
+            self.render_record(record, tk.END)
+        self.rendered_hi = new_hi
+        self.trim_transcript(keep_bottom=True)
+        
+        self.chat_display.yview("view_anchor")
+
 class ChatApp:
     def __init__(self, root):
         self.root = root
@@ -25,8 +3034,14 @@ class ChatApp:
         
         # 配置文件路径
         self.config_file = "chat_config.json"
-        self.chat_history = []
-        self.client = None
+        self.history_db = "chat_history.db"
+        self.connection_status = "未连接"
+        
+        # 会话存储和标签页：每个标签页是一个独立会话
+        self.store = None
+        self.page_size = 50
+        self.tabs = []
+        self.tab_numbers = itertools.count(1)
         
         # 主题配置
         self.current_theme = "light"
@@ -61,8 +3076,38 @@ class ChatApp:
             }
         }
         
-        # 加载配置
-        self.load_config()
+        # 加载配置
+        self.load_config()
+        
+        # 模型目录先从磁盘缓存读取，连接成功后再在后台刷新
+        self.catalog = load_model_catalog(self.config)
+        self.catalog_timer = None
+        
+        # 聊天引擎运行在后台线程的事件循环中，界面只负责展示。
+        # 这个引擎持有所有标签页共享的客户端（连接池）和回复缓存，各标签页使用它的分支。
+        # 不传 api_key：客户端在窗口显示后由后台线程创建（见 start_client）
+        self.engine = ChatEngine.from_config(self.config, api_key="", catalog=self.catalog)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        
+        # 打开会话存储
+        try:
+            self.store = ConversationStore(self.history_db)
+        except sqlite3.Error as e:
+            print(f"会话存储打开失败: {e}")
+        else:
+            # 为全文索引建立之前的旧消息补建索引
+            threading.Thread(target=self.build_search_index, daemon=True).start()
+        
+        # 代码高亮的词法分析在后台线程中进行
+        self.highlight_executor = None
+        if self.config["syntax_highlight"] and CodeHighlighter.available():
+            self.highlight_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="highlight")
+        
+        # 可选的界面卡顿诊断，要在创建界面之前启动才能为所有回调计时
+        self.watchdog = None
+        if self.diagnostics:
+            self.watchdog = UiWatchdog(self.root, self.config["stall_threshold"]).start()
         
         # 创建自定义样式
         self.setup_styles()
@@ -73,15 +3118,40 @@ class ChatApp:
         # 应用主题
         self.apply_theme()
         
-        # 初始化客户端
+        # 先显示窗口：openai 的导入和客户端创建放到后台线程，完成后再预热连接
+        self.client_lock = threading.Lock()
         if self.api_key:
-            self.init_client()
+            self.set_connection_status("连接中...")
+            threading.Thread(target=self.start_client, daemon=True).start()
+
+    def build_search_index(self):
+        """后台线程：补建全文索引"""
+        try:
+            self.store.build_index()
+        except sqlite3.Error as e:
+            print(f"全文索引补建失败: {e}")
 
     def setup_styles(self):
         """设置自定义样式"""
         self.style = ttk.Style()
         
-        # 定义自定义样式
+        # 只创建当前主题，另一个主题在第一次切换时再创建
+        self.ensure_style_theme(self.current_theme)
+
+    def ensure_style_theme(self, theme):
+        """按需创建 ttk 自定义主题，返回主题名"""
+        name = f"custom_{theme}"
+        if name in self.style.theme_names():
+            return name
+        
+        if theme == "light":
+            self.create_light_style()
+        else:
+            self.create_dark_style()
+        return name
+
+    def create_light_style(self):
+        """定义浅色自定义样式"""
         self.style.theme_create("custom_light", parent="clam", settings={
             "TLabelframe": {
                 "configure": {"background": "#f8f9fa", "bordercolor": "#e9ecef", "lightcolor": "#f8f9fa", "darkcolor": "#e9ecef"}
@@ -106,7 +3176,9 @@ class ChatApp:
                 "configure": {"fieldbackground": "#ffffff", "foreground": "#000000", "bordercolor": "#e9ecef"}
             }
         })
-        
+
+    def create_dark_style(self):
+        """定义深色自定义样式"""
         self.style.theme_create("custom_dark", parent="clam", settings={
             "TLabelframe": {
                 "configure": {"background": "#212529", "bordercolor": "#495057", "lightcolor": "#212529", "darkcolor": "#495057"}
@@ -134,45 +3206,37 @@ class ChatApp:
 
     def load_config(self):
         """加载配置文件"""
-        default_config = {
-            "api_key": "",
-            "base_url": "https://openrouter.ai/api/v1",
-            "model": "openai/gpt-oss-20b:free",
-            "max_tokens": 1000,
-            "temperature": 0.7,
-            "theme": "light"
-        }
-        
-        try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    for key, value in default_config.items():
-                        if key not in config:
-                            config[key] = value
-            else:
-                config = default_config
-        except Exception as e:
-            config = default_config
-            print(f"配置文件加载失败: {e}")
+        config = read_config(self.config_file)
+        self.config = config
         
         self.api_key = config["api_key"]
         self.base_url = config["base_url"] 
         self.model = config["model"]
         self.max_tokens = config["max_tokens"]
         self.temperature = config["temperature"]
+        self.context_tokens = config["context_tokens"]
+        self.model_context_tokens = config["model_context_tokens"]
+        self.stream = config["stream"]
+        self.transcript_window = config["transcript_window"]
         self.current_theme = config.get("theme", "light")
+        self.diagnostics = config["diagnostics"]
+        self.paste_attachment_chars = config["paste_attachment_chars"]
 
     def save_config(self):
         """保存配置文件"""
-        config = {
+        config = dict(self.config)
+        config.update({
             "api_key": self.api_key,
             "base_url": self.base_url,
             "model": self.model,
             "max_tokens": self.max_tokens,
             "temperature": self.temperature,
+            "context_tokens": self.context_tokens,
+            "model_context_tokens": self.model_context_tokens,
+            "stream": self.stream,
+            "transcript_window": self.transcript_window,
             "theme": self.current_theme
-        }
+        })
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, ensure_ascii=False, indent=2)
@@ -200,23 +3264,17 @@ class ChatApp:
         
         ttk.Label(row1_frame, text="模型:").pack(side=tk.LEFT)
         self.model_var = tk.StringVar(value=self.model)
-        model_combo = ttk.Combobox(row1_frame, textvariable=self.model_var, width=25, state="readonly")
-        model_combo['values'] = (
-            "openai/gpt-oss-20b:free", 
-            "x-ai/grok-4-fast:free",
-            "deepseek/deepseek-chat-v3-0324:free",
-            "deepseek/deepseek-r1-0528:free",
-            "qwen/qwen3-coder:free",
-            "qwen/qwen3-235b-a22b:free",
-            "moonshotai/kimi-k2:free",
-            "mistralai/mistral-small-3.2-24b-instruct:free",
-            "mistralai/devstral-small-2505:free",
-            "tencent/hunyuan-a13b-instruct:free",
-            "z-ai/glm-4.5-air:free",
-            "meta-llama/llama-3.3-70b-instruct:free",
-            "cognitivecomputations/dolphin-mistral-24b-venice-edition:free",
-        )
-        model_combo.pack(side=tk.LEFT, padx=(5, 0))
+        # 模型列表来自本地缓存的模型目录，可以输入关键词过滤
+        self.model_combo = ttk.Combobox(row1_frame, textvariable=self.model_var, width=25)
+        self.model_combo['values'] = self.catalog.ids or DEFAULT_MODELS
+        self.model_combo.pack(side=tk.LEFT, padx=(5, 0))
+        self.model_combo.bind("<KeyRelease>", self.filter_models)
+        self.model_combo.bind("<Return>", self.choose_model)
+        # 模型选择作用于当前标签页
+        self.model_combo.bind("<<ComboboxSelected>>", self.choose_model)
+        
+        self.model_info_label = ttk.Label(row1_frame, text="")
+        self.model_info_label.pack(side=tk.LEFT, padx=(10, 0))
         
         # 第二行：按钮和状态
         row2_frame = ttk.Frame(settings_frame)
@@ -229,176 +3287,139 @@ class ChatApp:
         self.theme_btn = ttk.Button(row2_frame, text="🌙 深色", command=self.toggle_theme)
         self.theme_btn.pack(side=tk.LEFT, padx=(10, 0))
         
+        # 标签页和会话按钮
+        new_tab_btn = ttk.Button(row2_frame, text="新标签页", command=self.new_tab)
+        new_tab_btn.pack(side=tk.LEFT, padx=(10, 0))
+        close_tab_btn = ttk.Button(row2_frame, text="关闭标签页", command=self.close_tab)
+        close_tab_btn.pack(side=tk.LEFT, padx=(10, 0))
+        new_session_btn = ttk.Button(row2_frame, text="新会话", command=lambda: self.current_tab().new_session())
+        new_session_btn.pack(side=tk.LEFT, padx=(10, 0))
+        sessions_btn = ttk.Button(row2_frame, text="历史会话", command=self.show_sessions)
+        sessions_btn.pack(side=tk.LEFT, padx=(10, 0))
+        search_btn = ttk.Button(row2_frame, text="搜索", command=self.show_search)
+        search_btn.pack(side=tk.LEFT, padx=(10, 0))
+        compare_btn = ttk.Button(row2_frame, text="对比", command=self.show_compare)
+        compare_btn.pack(side=tk.LEFT, padx=(10, 0))
+        stats_btn = ttk.Button(row2_frame, text="性能统计", command=self.show_statistics)
+        stats_btn.pack(side=tk.LEFT, padx=(10, 0))
+        if self.watchdog is not None:
+            diagnostics_btn = ttk.Button(row2_frame, text="诊断", command=self.show_diagnostics)
+            diagnostics_btn.pack(side=tk.LEFT, padx=(10, 0))
+        
         # 状态标签
-        self.status_label = ttk.Label(row2_frame, text="未连接")
+        self.status_label = ttk.Label(row2_frame, text=self.connection_status)
         self.status_label.pack(side=tk.LEFT, padx=(20, 0))
         
-        # 聊天显示区域
-        chat_frame = ttk.LabelFrame(main_frame, text="聊天记录", padding="5")
-        chat_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
-        
-        self.chat_display = scrolledtext.ScrolledText(
-            chat_frame, 
-            wrap=tk.WORD, 
-            state=tk.DISABLED,
-            font=("Microsoft YaHei", 10),
-            height=20
-        )
-        self.chat_display.pack(fill=tk.BOTH, expand=True)
-        
-        # 输入框架
-        input_frame = ttk.LabelFrame(main_frame, text="输入消息", padding="5")
-        input_frame.pack(fill=tk.X)
-        
-        # 输入区域容器
-        input_container = ttk.Frame(input_frame)
-        input_container.pack(fill=tk.BOTH, expand=True)
-        
-        # 消息输入框
-        self.message_entry = tk.Text(
-            input_container, 
-            height=4,
-            font=("Microsoft YaHei", 10),
-            wrap=tk.WORD
-        )
-        self.message_entry.pack(fill=tk.BOTH, side=tk.LEFT, expand=True)
-        
-        # 发送按钮框架
-        button_frame = ttk.Frame(input_container)
-        button_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(10, 0))
-        
-        # 发送按钮
-        self.send_button = ttk.Button(button_frame, text="发送\n(Ctrl+Enter)", command=self.send_message)
-        self.send_button.pack(fill=tk.X, pady=(0, 5))
-        
-        # 清空按钮
-        clear_button = ttk.Button(button_frame, text="清空历史", command=self.clear_chat)
-        clear_button.pack(fill=tk.X)
+        # 底部状态栏：最近一次请求的耗时和速度
+        self.metrics_label = ttk.Label(main_frame, text="", anchor=tk.W)
+        self.metrics_label.pack(side=tk.BOTTOM, fill=tk.X, pady=(5, 0))
         
-        # 绑定快捷键
-        self.message_entry.bind("<Control-Return>", lambda e: self.send_message())
+        # 会话标签页
+        self.notebook = ttk.Notebook(main_frame)
+        self.notebook.pack(fill=tk.BOTH, expand=True)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        self.new_tab()
         
-        # 配置聊天显示的标签样式
-        self.setup_chat_tags()
+        # Esc 停止当前标签页的请求
+        self.root.bind("<Escape>", lambda e: self.current_tab().stop_request())
+        # Ctrl+F 搜索所有会话
+        self.root.bind("<Control-f>", self.show_search)
 
-    def setup_chat_tags(self):
-        """设置聊天显示的标签样式和Markdown支持"""
-        # 基础标签
-        self.chat_display.tag_configure("user", foreground="#0066cc", font=("Microsoft YaHei", 10, "bold"))
-        self.chat_display.tag_configure("assistant", foreground="#00aa00", font=("Microsoft YaHei", 10))
-        self.chat_display.tag_configure("error", foreground="#cc0000", font=("Microsoft YaHei", 10))
-        self.chat_display.tag_configure("timestamp", foreground="#888888", font=("Microsoft YaHei", 8))
-        self.chat_display.tag_configure("system", foreground="#666666", font=("Microsoft YaHei", 9, "italic"))
-        
-        # Markdown标签样式
-        self.chat_display.tag_configure("h1", font=("Microsoft YaHei", 16, "bold"), spacing1=10, spacing3=5)
-        self.chat_display.tag_configure("h2", font=("Microsoft YaHei", 14, "bold"), spacing1=8, spacing3=4)
-        self.chat_display.tag_configure("h3", font=("Microsoft YaHei", 12, "bold"), spacing1=6, spacing3=3)
-        self.chat_display.tag_configure("bold", font=("Microsoft YaHei", 10, "bold"))
-        self.chat_display.tag_configure("italic", font=("Microsoft YaHei", 10, "italic"))
-        self.chat_display.tag_configure("code_inline", font=("Consolas", 9), background="#f6f8fa")
-        self.chat_display.tag_configure("code_block", font=("Consolas", 9), background="#f6f8fa", lmargin1=20, lmargin2=20)
-        self.chat_display.tag_configure("list_item", lmargin1=20, lmargin2=30)
-        self.chat_display.tag_configure("table_header", font=("Microsoft YaHei", 10, "bold"), background="#f0f0f0")
-        self.chat_display.tag_configure("table_cell", font=("Microsoft YaHei", 10))
-        self.chat_display.tag_configure("quote", font=("Microsoft YaHei", 10, "italic"), foreground="#666666", lmargin1=20, lmargin2=20)
-
-    def parse_and_insert_markdown(self, content, base_tag="assistant"):
-        """解析并插入Markdown格式的内容"""
-        self.chat_display.config(state=tk.NORMAL)
-        
-        lines = content.split('\n')
-        i = 0
-        
-        while i < len(lines):
-            line = lines[i]
-            
-            # 处理标题
-            if line.startswith('### '):
-                self.chat_display.insert(tk.END, line[4:] + '\n', ("h3", base_tag))
-            elif line.startswith('## '):
-                self.chat_display.insert(tk.END, line[3:] + '\n', ("h2", base_tag))
-            elif line.startswith('# '):
-                self.chat_display.insert(tk.END, line[2:] + '\n', ("h1", base_tag))
-            
-            # 处理代码块
-            elif line.strip().startswith('```'):
-                # 找到代码块结束
-                code_lines = []
-                i += 1
-                while i < len(lines) and not lines[i].strip().startswith('```'):
-                    code_lines.append(lines[i])
-                    i += 1
-                
-                if code_lines:
-                    self.chat_display.insert(tk.END, '\n'.join(code_lines) + '\n', ("code_block", base_tag))
-            
-            # 处理表格
-            elif '|' in line and line.strip().startswith('|') and line.strip().endswith('|'):
-                # 这是表格行
-                table_lines = [line]
-                # 收集连续的表格行
-                while i + 1 < len(lines) and '|' in lines[i + 1] and lines[i + 1].strip().startswith('|'):
-                    i += 1
-                    table_lines.append(lines[i])
-                
-                # 渲染表格
-                for j, table_line in enumerate(table_lines):
-                    # 跳过分隔行（包含 --- 的行）
-                    if '---' in table_line:
-                        continue
-                        
-                    cells = [cell.strip() for cell in table_line.split('|')[1:-1]]  # 去掉首尾的空元素
-                    cell_content = ' | '.join(cells)
-                    
-                    if j == 0:  # 表头
-                        self.chat_display.insert(tk.END, cell_content + '\n', ("table_header", base_tag))
-                    else:
-                        self.chat_display.insert(tk.END, cell_content + '\n', ("table_cell", base_tag))
-            
-            # 处理引用
-            elif line.startswith('> '):
-                self.chat_display.insert(tk.END, line[2:] + '\n', ("quote", base_tag))
-            
-            # 处理列表
-            elif re.match(r'^[\-\*\+]\s+', line) or re.match(r'^\d+\.\s+', line):
-                # 提取列表项内容
-                match = re.match(r'^([\-\*\+]|\d+\.)\s+(.*)', line)
-                if match:
-                    bullet, content_text = match.groups()
-                    self.chat_display.insert(tk.END, f"• {content_text}\n", ("list_item", base_tag))
-                else:
-                    self.chat_display.insert(tk.END, line + '\n', base_tag)
-            
-            # 处理普通段落（包含行内格式）
-            else:
-                self.parse_inline_markdown(line + '\n', base_tag)
-            
-            i += 1
-        
-        self.chat_display.config(state=tk.DISABLED)
+    def new_tab(self, title=None):
+        """新建会话标签页并切换过去"""
+        tab = ChatTab(self, title or f"会话 {next(self.tab_numbers)}")
+        self.tabs.append(tab)
+        tab.apply_theme(self.themes[self.current_theme], self.current_theme == "dark")
+        self.notebook.select(tab.frame)
+        tab.message_entry.focus_set()
+        return tab
 
-    def parse_inline_markdown(self, text, base_tag):
-        """解析行内Markdown格式"""
-        # 处理粗体 **text**
-        parts = re.split(r'(\*\*[^*]+\*\*)', text)
-        for part in parts:
-            if part.startswith('**') and part.endswith('**'):
-                self.chat_display.insert(tk.END, part[2:-2], ("bold", base_tag))
-            else:
-                # 处理斜体 *text*
-                italic_parts = re.split(r'(\*[^*]+\*)', part)
-                for italic_part in italic_parts:
-                    if italic_part.startswith('*') and italic_part.endswith('*') and len(italic_part) > 2:
-                        self.chat_display.insert(tk.END, italic_part[1:-1], ("italic", base_tag))
-                    else:
-                        # 处理行内代码 `code`
-                        code_parts = re.split(r'(`[^`]+`)', italic_part)
-                        for code_part in code_parts:
-                            if code_part.startswith('`') and code_part.endswith('`'):
-                                self.chat_display.insert(tk.END, code_part[1:-1], ("code_inline", base_tag))
-                            else:
-                                self.chat_display.insert(tk.END, code_part, base_tag)
+    def close_tab(self):
+        """关闭当前标签页，进行中的请求随之取消（会话保留在历史会话中）"""
+        if len(self.tabs) == 1:
+            messagebox.showinfo("提示", "至少需要保留一个标签页")
+            return
+        tab = self.current_tab()
+        tab.stop_request()
+        tab.discard_attachment()
+        tab.closed = True
+        # 保存消息的回调不涉及控件，保留到被取消的请求收尾：
+        # 已收到的部分回复照常写入会话，没有回复的用户消息照常撤回
+        tab.engine.on_queue = None
+        self.tabs.remove(tab)
+        self.notebook.forget(tab.frame)
+        tab.frame.destroy()
+
+    def current_tab(self):
+        """当前选中的标签页"""
+        selected = self.notebook.select()
+        for tab in self.tabs:
+            if str(tab.frame) == selected:
+                return tab
+        return self.tabs[0]
+
+    def on_tab_changed(self, event=None):
+        """切换标签页时让模型选择显示该标签页的模型"""
+        self.model_var.set(self.current_tab().engine.model)
+        self.update_model_info()
+
+    def filter_models(self, event):
+        """按输入内容过滤下拉列表（方向键等导航键不触发）"""
+        if event.keysym in ("Up", "Down", "Return", "Escape", "Tab"):
+            return
+        query = self.model_var.get().strip()
+        if self.catalog.ids:
+            self.model_combo['values'] = self.catalog.search(query)
+        else:
+            self.model_combo['values'] = [m for m in DEFAULT_MODELS if query.lower() in m]
+
+    def choose_model(self, event=None):
+        """确认模型选择：输入的不是完整模型 id 时取第一个匹配项"""
+        model = self.model_var.get().strip()
+        if self.catalog.ids and model not in self.catalog.models:
+            matches = self.catalog.search(model, limit=1)
+            if not matches:
+                return
+            model = matches[0]
+            self.model_var.set(model)
+        self.current_tab().set_model(model)
+        self.update_model_info()
+
+    def update_model_info(self):
+        """在模型选择旁显示目录中的上下文长度和最大回复 tokens"""
+        info = self.catalog.models.get(self.model_var.get())
+        if not info:
+            self.model_info_label.config(text="")
+            return
+        parts = []
+        if info["context_length"]:
+            parts.append(f"上下文 {info['context_length']:,}")
+        if info["max_completion_tokens"]:
+            parts.append(f"最大回复 {info['max_completion_tokens']:,}")
+        self.model_info_label.config(text=" · ".join(parts))
+
+    def refresh_catalog(self):
+        """在事件循环中刷新模型目录（缓存未过期时不访问网络），完成后安排下一次检查"""
+        if self.catalog_timer is not None:
+            self.root.after_cancel(self.catalog_timer)
+            self.catalog_timer = None
+        future = asyncio.run_coroutine_threadsafe(
+            self.catalog.refresh(self.engine.client, scheduler=self.engine.scheduler), self.loop)
+        future.add_done_callback(lambda f: self.root.after(0, lambda: self.handle_catalog(f)))
+
+    def handle_catalog(self, future):
+        """模型目录刷新完成后更新下拉列表"""
+        try:
+            changed = future.result()
+        except Exception as e:
+            print(f"模型目录刷新失败: {e}")
+            changed = False
+        if changed:
+            self.model_combo['values'] = self.catalog.search(self.model_var.get().strip()) or self.catalog.ids
+            self.update_model_info()
+        # 连接期间在目录过期时重新验证；刷新失败时至少隔一分钟再试
+        remaining = self.catalog.ttl - (time.time() - self.catalog.fetched)
+        self.catalog_timer = self.root.after(int(max(remaining, 60) * 1000), self.refresh_catalog)
 
     def toggle_theme(self):
         """切换主题"""
@@ -411,49 +3432,22 @@ class ChatApp:
         theme = self.themes[self.current_theme]
         
         # 应用ttk主题
+        self.style.theme_use(self.ensure_style_theme(self.current_theme))
         if self.current_theme == "light":
-            self.style.theme_use("custom_light")
             self.theme_btn.config(text="🌙 深色")
         else:
-            self.style.theme_use("custom_dark")
             self.theme_btn.config(text="☀️ 浅色")
         
         # 配置根窗口
         self.root.configure(bg=theme["bg"])
         
-        # 配置聊天显示区域
-        self.chat_display.config(
-            bg=theme["chat_bg"],
-            fg=theme["fg"],
-            insertbackground=theme["fg"],
-            selectbackground=theme["select_bg"],
-            selectforeground=theme["select_fg"]
-        )
-        
-        # 配置输入框
-        self.message_entry.config(
-            bg=theme["entry_bg"],
-            fg=theme["entry_fg"],
-            insertbackground=theme["fg"],
-            selectbackground=theme["select_bg"],
-            selectforeground=theme["select_fg"]
-        )
-        
-        # 重新配置聊天标签颜色以适应主题
-        if self.current_theme == "dark":
-            self.chat_display.tag_configure("user", foreground="#87CEEB", font=("Microsoft YaHei", 10, "bold"))
-            self.chat_display.tag_configure("assistant", foreground="#90EE90", font=("Microsoft YaHei", 10))
-            self.chat_display.tag_configure("error", foreground="#FF6B6B", font=("Microsoft YaHei", 10))
-            self.chat_display.tag_configure("system", foreground="#BBBBBB", font=("Microsoft YaHei", 9, "italic"))
-            self.chat_display.tag_configure("code_inline", background="#404040")
-            self.chat_display.tag_configure("code_block", background="#404040")
-            self.chat_display.tag_configure("table_header", background="#404040")
-        else:
-            self.setup_chat_tags()
+        for tab in self.tabs:
+            tab.apply_theme(theme, self.current_theme == "dark")
 
     def connect_api(self):
         """连接 API"""
         self.api_key = self.api_key_var.get().strip()
+        self.choose_model()
         self.model = self.model_var.get().strip()
         
         if not self.api_key:
@@ -462,119 +3456,864 @@ class ChatApp:
             
         self.save_config()
         
-        if self.init_client():
-            self.status_label.config(text="✅ 已连接")
-            self.add_message("系统", f"已连接到 {self.model}", "system")
-        else:
-            self.status_label.config(text="❌ 连接失败")
+        self.current_tab().set_model(self.model)
+        self.engine.model = self.model
+        self.set_connection_status("连接中...")
+        # 客户端在后台线程中创建：启动时的 openai 导入可能还没完成，界面线程不等待
+        threading.Thread(target=self.start_client, args=(True,), daemon=True).start()
 
-    def init_client(self):
-        """初始化 OpenAI 客户端"""
+    def probe_connection(self, announce=False):
+        """在事件循环中预热连接池，完成后在状态栏显示测得的延迟"""
+        future = asyncio.run_coroutine_threadsafe(self.engine.warm_up(), self.loop)
+        future.add_done_callback(lambda f: self.root.after(0, lambda: self.handle_probe(f, announce)))
+
+    def handle_probe(self, future, announce):
+        """处理连接预热结果"""
         try:
-            self.client = OpenAI(
-                base_url=self.base_url,
-                api_key=self.api_key
-            )
-            return True
+            connect_time, rtt = future.result()
         except Exception as e:
-            self.add_message("错误", f"客户端初始化失败: {str(e)}", "error")
-            return False
+            self.set_connection_status("❌ 连接失败")
+            self.current_tab().add_message("错误", f"连接检测失败: {str(e)}", "error")
+            return
+        self.set_connection_status(f"✅ 已连接 · 建连 {connect_time * 1000:.0f} ms / 往返 {rtt * 1000:.0f} ms")
+        if announce:
+            self.current_tab().add_message("系统", f"已连接到 {self.model}", "system")
+        # 连接可用后再在后台刷新模型目录
+        self.refresh_catalog()
 
-    def add_message(self, role, content, tag="assistant"):
-        """添加消息到聊天显示区域"""
-        self.chat_display.config(state=tk.NORMAL)
-        
-        # 添加时间戳
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        self.chat_display.insert(tk.END, f"[{timestamp}] ", "timestamp")
+    def set_connection_status(self, text):
+        """更新状态栏的连接状态"""
+        self.connection_status = text
+        self.update_cache_status()
+
+    def start_client(self, reconnect=False):
+        """后台线程：导入 openai 并创建客户端，完成后回到界面线程分发给各标签页并预热连接
         
-        # 添加角色标识
-        if role == "用户":
-            self.chat_display.insert(tk.END, f"{role}: ", "user")
-            self.chat_display.insert(tk.END, f"{content}\n\n")
-        elif role == "助手":
-            self.chat_display.insert(tk.END, f"{role}: \n", "assistant")
-            # 使用Markdown解析器处理AI回复
-            self.parse_and_insert_markdown(content, "assistant")
-            self.chat_display.insert(tk.END, "\n")
+        reconnect 为 True 时（点击连接）按当前设置重新创建客户端，旧客户端随后关闭。
+        """
+        try:
+            with self.client_lock:
+                previous = self.engine.client
+                # 启动时的创建：用户在此之前已点击连接时不再重复创建
+                if reconnect or previous is None:
+                    self.engine.configure(self.api_key, self.base_url)
+                if previous is self.engine.client:
+                    previous = None
+        except Exception as e:
+            error_msg = f"客户端初始化失败: {str(e)}"
+            self.root.after(0, lambda: self.handle_client_error(error_msg))
+            return
+        self.root.after(0, lambda: self.client_ready(previous, announce=reconnect))
+
+    def client_ready(self, previous=None, announce=False):
+        """后台创建的客户端交给各标签页使用，关闭被替换的旧客户端，并预热连接"""
+        for tab in self.tabs:
+            tab.engine.client = self.engine.client
+        # 旧客户端的连接在事件循环中关闭
+        if previous is not None:
+            asyncio.run_coroutine_threadsafe(previous.close(), self.loop)
+        self.probe_connection(announce)
+
+    def handle_client_error(self, error_msg):
+        """客户端创建失败"""
+        self.set_connection_status("❌ 连接失败")
+        self.current_tab().add_message("错误", error_msg, "error")
+
+    def show_metrics(self, sample):
+        """在底部状态栏显示一次请求的统计"""
+        parts = [sample["used_model"] or sample["model"], f"排队 {sample['queue'] * 1000:.0f} ms"]
+        if sample["ttft"] is not None:
+            parts.append(f"首 token {sample['ttft'] * 1000:.0f} ms")
+        if sample["latency"] is None:
+            parts.append("生成中...")
         else:
-            self.chat_display.insert(tk.END, f"{role}: ", tag)
-            self.chat_display.insert(tk.END, f"{content}\n\n")
+            parts.append(f"总耗时 {sample['latency']:.2f} s")
+        if sample["completion_tokens"]:
+            approx = "≈" if sample.get("usage_estimated") else ""
+            parts.append(f"{approx}{sample['completion_tokens']} tokens")
+        if sample["tokens_per_s"]:
+            parts.append(f"{sample['tokens_per_s']:.1f} tok/s")
+        if sample.get("cached_tokens"):
+            parts.append(f"prompt 缓存 {sample['cached_tokens']}/{sample['prompt_tokens']}")
+        if sample["retries"]:
+            parts.append(f"重试 {sample['retries']} 次")
+        self.metrics_label.config(text=" · ".join(parts))
+
+    def show_statistics(self):
+        """显示各模型最近请求的耗时分位数和延迟直方图"""
+        telemetry = self.engine.telemetry
+        if telemetry is None:
+            messagebox.showinfo("提示", "未启用请求统计")
+            return
         
-        # 滚动到底部
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
+        window = tk.Toplevel(self.root)
+        window.title("性能统计")
+        window.geometry("640x480")
+        window.transient(self.root)
+        
+        text = scrolledtext.ScrolledText(window, wrap=tk.NONE, font=("Consolas", 10))
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        
+        def fill():
+            text.config(state=tk.NORMAL)
+            text.delete("1.0", tk.END)
+            models = telemetry.models()
+            if not models:
+                text.insert(tk.END, "还没有成功的请求")
+            for model in models:
+                count = len(telemetry.values(model, "latency"))
+                text.insert(tk.END, f"{model}  （最近 {count} 次）\n")
+                text.insert(tk.END, f"  {'':<10}{'p50':>10}{'p90':>10}{'p99':>10}\n")
+                for field, label, scale, unit in (("queue", "排队", 1000, "ms"), ("ttft", "首 token", 1000, "ms"),
+                                                  ("latency", "总耗时", 1, "s"), ("tokens_per_s", "速度", 1, "tok/s")):
+                    values = telemetry.percentiles(model, field)
+                    if values is None:
+                        continue
+                    cells = "".join(f"{values[q] * scale:>10.1f}" for q in (50, 90, 99))
+                    text.insert(tk.END, f"  {label:<10}{cells}  {unit}\n")
+                # 服务端 prompt 缓存命中率
+                prompt, cached = telemetry.totals(model, "prompt_tokens", "cached_tokens")
+                if cached:
+                    text.insert(tk.END, f"  prompt 缓存命中 {cached}/{prompt} tokens ({cached / prompt:.0%})\n")
+                # 延迟直方图
+                counts = telemetry.histogram(model)
+                labels = [f"≤{bound}s" for bound in telemetry.LATENCY_BUCKETS] + [f">{telemetry.LATENCY_BUCKETS[-1]}s"]
+                peak = max(counts) or 1
+                for label, bucket in zip(labels, counts):
+                    if bucket:
+                        text.insert(tk.END, f"  {label:>7} {'█' * max(1, bucket * 30 // peak)} {bucket}\n")
+                text.insert(tk.END, "\n")
+            text.config(state=tk.DISABLED)
+        
+        button_frame = ttk.Frame(window)
+        button_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+        ttk.Button(button_frame, text="刷新", command=fill).pack(side=tk.LEFT)
+        if telemetry.path:
+            ttk.Label(button_frame, text=f"原始数据: {os.path.abspath(telemetry.path)}").pack(side=tk.LEFT, padx=(10, 0))
+        fill()
 
-    def send_message(self):
-        """发送消息"""
-        if not self.client:
+    def show_compare(self):
+        """对比模式：同一条提示同时发给多个模型，各自的回复并排流式显示，结束后列出耗时和速度"""
+        if not self.engine.client:
             messagebox.showerror("错误", "请先连接 API")
             return
+        
+        window = tk.Toplevel(self.root)
+        window.title("模型对比")
+        window.geometry("1000x700")
+        window.transient(self.root)
+        theme = self.themes[self.current_theme]
+        dark = self.current_theme == "dark"
+        
+        # 模型选择：关键词过滤，已选的模型排在前面，过滤时保留选择
+        chosen = [self.current_tab().engine.model]
+        shown = []
+        select_frame = ttk.Frame(window)
+        select_frame.pack(fill=tk.X, padx=10, pady=(10, 5))
+        filter_var = tk.StringVar()
+        filter_entry = ttk.Entry(select_frame, textvariable=filter_var, width=24)
+        filter_entry.pack(side=tk.LEFT, anchor=tk.N)
+        model_list = tk.Listbox(select_frame, selectmode=tk.MULTIPLE, height=6, exportselection=False)
+        model_list.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
+        
+        def fill_models(event=None):
+            query = filter_var.get().strip().lower()
+            shown[:] = chosen + [model for model in (self.catalog.ids or DEFAULT_MODELS)
+                                 if model not in chosen and query in model.lower()]
+            model_list.delete(0, tk.END)
+            for index, model in enumerate(shown):
+                model_list.insert(tk.END, model)
+                if model in chosen:
+                    model_list.selection_set(index)
+        
+        def on_select(event):
+            selected = {shown[index] for index in model_list.curselection()}
+            chosen[:] = [model for model in chosen if model not in shown or model in selected]
+            chosen.extend(model for model in shown if model in selected and model not in chosen)
+        
+        filter_entry.bind("<KeyRelease>", fill_models)
+        model_list.bind("<<ListboxSelect>>", on_select)
+        fill_models()
+        
+        # 提示和按钮
+        prompt_frame = ttk.Frame(window)
+        prompt_frame.pack(fill=tk.X, padx=10, pady=5)
+        prompt_text = tk.Text(prompt_frame, height=3, wrap=tk.WORD, font=("Microsoft YaHei", 10),
+                              bg=theme["entry_bg"], fg=theme["entry_fg"], insertbackground=theme["fg"])
+        prompt_text.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        button_frame = ttk.Frame(prompt_frame)
+        button_frame.pack(side=tk.RIGHT, padx=(5, 0))
+        run_button = ttk.Button(button_frame, text="开始对比")
+        run_button.pack(fill=tk.X)
+        stop_button = ttk.Button(button_frame, text="停止", state="disabled")
+        stop_button.pack(fill=tk.X, pady=(5, 0))
+        
+        # 结果表格和总耗时在底部，回复窗格占据中间
+        summary_label = ttk.Label(window, text="选择模型（可多选）并输入提示")
+        summary_label.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=(0, 10))
+        columns = ("model", "ttft", "latency", "speed", "prompt", "completion", "outcome")
+        table = ttk.Treeview(window, columns=columns, show="headings", height=5)
+        for column, heading, width in zip(columns, ("模型", "首 token (ms)", "总耗时 (s)", "tok/s",
+                                                    "prompt", "completion", "结果"),
+                                          (260, 100, 90, 80, 80, 90, 200)):
+            table.heading(column, text=heading)
+            table.column(column, width=width, anchor=tk.W if column in ("model", "outcome") else tk.E)
+        table.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=5)
+        panes = ttk.PanedWindow(window, orient=tk.HORIZONTAL)
+        panes.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
+        state = {"future": None, "frames": [], "views": []}
+        
+        def feed(index, delta):
+            if not window.winfo_exists():
+                return
+            text, renderer, highlighter = state["views"][index]
+            text.config(state=tk.NORMAL)
+            renderer.feed(delta)
+            text.config(state=tk.DISABLED)
+            text.see(tk.END)
+        
+        def done(index, sample):
+            if not window.winfo_exists():
+                return
+            text, renderer, highlighter = state["views"][index]
+            text.config(state=tk.NORMAL)
+            renderer.finish()
+            if sample["outcome"] == "error":
+                text.insert(tk.END, f"\n{sample['error']}\n", "error")
+            text.config(state=tk.DISABLED)
+            table.insert("", tk.END, values=(
+                sample["model"],
+                f"{sample['ttft'] * 1000:.0f}" if sample["ttft"] is not None else "-",
+                f"{sample['latency']:.2f}",
+                f"{sample['tokens_per_s']:.1f}" if sample["tokens_per_s"] else "-",
+                sample["prompt_tokens"] if sample["prompt_tokens"] is not None else "-",
+                sample["completion_tokens"] if sample["completion_tokens"] is not None else "-",
+                "完成" if sample["outcome"] == "ok" else sample["error"] or sample["outcome"]))
+        
+        def finished(future, started):
+            if not window.winfo_exists():
+                return
+            run_button.config(state="normal")
+            stop_button.config(state="disabled")
+            if future.cancelled():
+                summary_label.config(text="对比已停止")
+                return
+            try:
+                samples = future.result()
+            except Exception as e:
+                summary_label.config(text=f"对比失败: {e}")
+                return
+            latencies = [sample["latency"] for sample in samples]
+            summary_label.config(text=f"{len(samples)} 个模型，总耗时 {time.perf_counter() - started:.2f} s"
+                                      f"（最慢 {max(latencies):.2f} s，依次请求需 {sum(latencies):.2f} s）")
+        
+        def start():
+            prompt = prompt_text.get("1.0", tk.END).strip()
+            if not prompt or not chosen:
+                return
+            models = list(chosen)
+            for frame in state["frames"]:
+                frame.destroy()
+            table.delete(*table.get_children())
+            state["frames"], state["views"] = [], []
+            for model in models:
+                frame = ttk.Frame(panes)
+                state["frames"].append(frame)
+                ttk.Label(frame, text=model).pack(anchor=tk.W)
+                text = scrolledtext.ScrolledText(frame, wrap=tk.WORD, width=30, font=("Microsoft YaHei", 10),
+                                                 bg=theme["chat_bg"], fg=theme["fg"], state=tk.DISABLED)
+                text.pack(fill=tk.BOTH, expand=True)
+                configure_chat_tags(text, dark)
+                highlighter = None
+                if self.highlight_executor is not None:
+                    highlighter = CodeHighlighter(text, self.root, self.highlight_executor)
+                    highlighter.configure_tags(dark)
+                    # 滚动时检查进入可见区域的代码块
+                    text.config(yscrollcommand=lambda first, last, bar=text.vbar, h=highlighter:
+                                (bar.set(first, last), h.schedule()))
+                renderer = MarkdownRenderer(text, "assistant", on_code=highlighter.add if highlighter else None)
+                state["views"].append((text, renderer, highlighter))
+                panes.add(frame, weight=1)
             
-        message = self.message_entry.get("1.0", tk.END).strip()
-        if not message:
+            run_button.config(state="disabled")
+            stop_button.config(state="normal")
+            summary_label.config(text=f"正在请求 {len(models)} 个模型...")
+            started = time.perf_counter()
+            future = asyncio.run_coroutine_threadsafe(self.engine.compare(
+                prompt, models,
+                on_delta=lambda index, delta: self.root.after(0, lambda: feed(index, delta)),
+                on_done=lambda index, sample: self.root.after(0, lambda s=dict(sample): done(index, s))), self.loop)
+            future.add_done_callback(lambda f: self.root.after(0, lambda: finished(f, started)))
+            state["future"] = future
+        
+        def stop():
+            if state["future"] is not None:
+                state["future"].cancel()
+        
+        def close():
+            stop()
+            window.destroy()
+        
+        run_button.config(command=start)
+        stop_button.config(command=stop)
+        prompt_text.bind("<Control-Return>", lambda e: (start(), "break")[1])
+        window.protocol("WM_DELETE_WINDOW", close)
+        prompt_text.focus_set()
+
+    def show_diagnostics(self):
+        """显示主循环延迟、回调耗时和卡顿时的调用栈，可导出到文件"""
+        window = tk.Toplevel(self.root)
+        window.title("界面诊断")
+        window.geometry("760x520")
+        window.transient(self.root)
+        
+        text = scrolledtext.ScrolledText(window, wrap=tk.NONE, font=("Consolas", 10))
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        
+        def fill():
+            text.config(state=tk.NORMAL)
+            text.delete("1.0", tk.END)
+            text.insert(tk.END, self.watchdog.report())
+            text.config(state=tk.DISABLED)
+        
+        def export():
+            path = self.config["diagnostics_file"]
+            try:
+                self.watchdog.dump(path)
+            except OSError as e:
+                messagebox.showerror("错误", f"导出失败: {e}")
+                return
+            path_label.config(text=f"已导出: {os.path.abspath(path)}")
+        
+        button_frame = ttk.Frame(window)
+        button_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+        ttk.Button(button_frame, text="刷新", command=fill).pack(side=tk.LEFT)
+        ttk.Button(button_frame, text="导出", command=export).pack(side=tk.LEFT, padx=(10, 0))
+        path_label = ttk.Label(button_frame, text="")
+        path_label.pack(side=tk.LEFT, padx=(10, 0))
+        fill()
+
+    def update_cache_status(self):
+        """在状态栏显示缓存命中统计"""
+        cache = self.engine.cache
+        if cache is None:
+            self.status_label.config(text=self.connection_status)
+            return
+        total = cache.hits + cache.misses
+        self.status_label.config(text=f"{self.connection_status} · 缓存命中 {cache.hits}/{total}")
+
+    def show_sessions(self):
+        """显示历史会话列表"""
+        if self.store is None:
+            messagebox.showerror("错误", "会话存储不可用")
             return
-            
-        # 清空输入框
-        self.message_entry.delete("1.0", tk.END)
         
-        # 添加用户消息到显示区域
-        self.add_message("用户", message, "user")
+        window = tk.Toplevel(self.root)
+        window.title("历史会话")
+        window.geometry("500x400")
+        window.transient(self.root)
         
-        # 添加到聊天历史
-        self.chat_history.append({"role": "user", "content": message})
+        listbox = tk.Listbox(window, font=("Microsoft YaHei", 10))
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+        sessions = []
         
-        # 禁用发送按钮，防止重复发送
-        self.send_button.config(state="disabled", text="发送中...")
+        def load_page():
+            rows = self.store.list_sessions(self.page_size, len(sessions))
+            for session_id, title, model, updated in rows:
+                when = datetime.fromtimestamp(updated).strftime("%m-%d %H:%M")
+                listbox.insert(tk.END, f"[{when}] {title or '(空会话)'}  — {model}")
+                sessions.append((session_id, title, model))
+            if len(rows) < self.page_size:
+                more_btn.config(state="disabled")
+        
+        def open_selected(event=None):
+            selection = listbox.curselection()
+            if selection:
+                window.destroy()
+                self.open_session(*sessions[selection[0]])
+        
+        button_frame = ttk.Frame(window)
+        button_frame.pack(fill=tk.X, padx=10, pady=(0, 10))
+        ttk.Button(button_frame, text="打开", command=open_selected).pack(side=tk.LEFT)
+        more_btn = ttk.Button(button_frame, text="加载更多", command=load_page)
+        more_btn.pack(side=tk.LEFT, padx=(10, 0))
+        
+        listbox.bind("<Double-Button-1>", open_selected)
+        load_page()
+
+    def show_search(self, event=None):
+        """在所有会话中全文搜索，边输入边显示结果，双击结果跳转到对应消息"""
+        if self.store is None or not self.store.fts:
+            messagebox.showerror("错误", "全文搜索不可用")
+            return
+        
+        window = tk.Toplevel(self.root)
+        window.title("搜索消息")
+        window.geometry("600x450")
+        window.transient(self.root)
+        
+        query_var = tk.StringVar()
+        entry = ttk.Entry(window, textvariable=query_var)
+        entry.pack(fill=tk.X, padx=10, pady=(10, 5))
+        listbox = tk.Listbox(window, font=("Microsoft YaHei", 10))
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=(0, 5))
+        info_label = ttk.Label(window, text="")
+        info_label.pack(fill=tk.X, padx=10, pady=(0, 10))
+        hits = []
+        
+        def run_search(event=None):
+            query = query_var.get()
+            start = time.perf_counter()
+            try:
+                hits[:] = self.store.search(query)
+            except sqlite3.Error as e:
+                hits[:] = []
+                info_label.config(text=f"搜索失败: {e}")
+                return
+            elapsed = (time.perf_counter() - start) * 1000
+            listbox.delete(0, tk.END)
+            for msg_id, session_id, role, content, created, title, model in hits:
+                when = datetime.fromtimestamp(created).strftime("%m-%d %H:%M")
+                label = ChatTab.ROLE_LABELS.get(role, role)
+                listbox.insert(tk.END, f"[{when}] {title or '(空会话)'} · {label}: {ConversationStore.snippet(content, query)}")
+            info_label.config(text=f"{len(hits)} 条结果 · {elapsed:.1f} ms" if query.strip() else "")
         
-        # 在新线程中调用 API
-        threading.Thread(target=self.call_api, daemon=True).start()
+        def open_selected(event=None):
+            selection = listbox.curselection()
+            if selection:
+                self.jump_to_message(hits[selection[0]], query_var.get().split())
+        
+        entry.bind("<KeyRelease>", run_search)
+        listbox.bind("<Double-Button-1>", open_selected)
+        listbox.bind("<Return>", open_selected)
+        entry.focus_set()
+
+    def jump_to_message(self, hit, terms):
+        """切换到搜索结果所在的会话并滚动到该消息"""
+        msg_id, session_id, role, content, created, title, model = hit
+        for tab in self.tabs:
+            if tab.session_id != session_id:
+                continue
+            self.notebook.select(tab.frame)
+            index = tab.find_stored_record(msg_id)
+            if index is None and tab.request_active:
+                # 回复进行中不能重新加载，本次新发送的消息只能按内容查找
+                index = tab.find_record(role, content)
+            if index is not None and (tab.rendered_lo <= index < tab.rendered_hi or not tab.request_active):
+                tab.show_record(index, terms)
+            else:
+                # 消息不在已加载的范围内，从存储重新加载到它附近
+                tab.open_session(session_id, msg_id, terms)
+            return
+        self.open_session(session_id, title, model, msg_id, terms)
 
-    def call_api(self):
-        """调用 API 获取回复"""
+    def open_session(self, session_id, title, model, around_id=None, terms=()):
+        """在标签页中打开历史会话：已打开时切换过去，当前标签页为空时直接使用"""
+        for tab in self.tabs:
+            if tab.session_id == session_id:
+                self.notebook.select(tab.frame)
+                return
+        tab = self.current_tab()
+        if tab.request_active or tab.records:
+            tab = self.new_tab()
+        tab.set_model(model)
+        tab.open_session(session_id, around_id, terms)
+        if title:
+            tab.set_title(title[:12])
+        self.model_var.set(model)
+
+    def shutdown(self):
+        """退出时关闭客户端、事件循环和会话存储，删除未发送的临时附件"""
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        if self.highlight_executor is not None:
+            self.highlight_executor.shutdown(wait=False)
+        for tab in self.tabs:
+            tab.discard_attachment()
         try:
-            # 限制聊天历史长度，避免 token 超限
-            recent_history = self.chat_history[-10:]
-            
-            # 调用 API
-            completion = self.client.chat.completions.create(
-                model=self.model,
-                messages=recent_history,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature
-            )
-            
-            # 获取回复
-            response = completion.choices[0].message.content
-            
-            # 添加助手回复到聊天历史
-            self.chat_history.append({"role": "assistant", "content": response})
+            asyncio.run_coroutine_threadsafe(self.engine.aclose(), self.loop).result(timeout=5)
+        except Exception as e:
+            print(f"客户端关闭失败: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.store is not None:
+            self.store.close()
+
+async def run_batch(engine, input_path, output_path, concurrency=8):
+    """批量运行 JSONL 提示
+    
+    输入每行为 {"id": ..., "prompt": "..."} 或 {"id": ..., "messages": [...]}，
+    可选 "model"、"max_tokens"、"temperature" 覆盖配置；缺少 id 时使用行号。
+    无法解析的行以行号为 id 记为失败，不影响其余各行。
+    结果逐条追加写入输出文件；输出中已成功的 id 会被跳过，从而支持断点续跑。
+    返回 (完成数, 失败数, token 数, 耗时秒)。
+    """
+    done = set()
+    partial_tail = False
+    if os.path.exists(output_path):
+        with open(output_path, 'r', encoding='utf-8') as f:
+            line = ""
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时可能残留半行
+                if isinstance(record, dict) and "id" in record and "error" not in record:
+                    done.add(record["id"])
+            partial_tail = bool(line) and not line.endswith("\n")
+    
+    # 有界队列：输入文件边读边处理，内存占用与文件大小无关
+    queue = asyncio.Queue(maxsize=concurrency * 4)
+    stats = {"ok": 0, "failed": 0, "tokens": 0}
+    started = time.perf_counter()
+    
+    with open(output_path, 'a', encoding='utf-8') as out:
+        # 上次中断留下的半行单独成行，不影响后续记录
+        if partial_tail:
+            out.write("\n")
+        
+        def write(result):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            finished = stats["ok"] + stats["failed"]
+            if finished % 100 == 0:
+                print(f"已完成 {finished} 条")
+        
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                result = {"id": item["id"]}
+                begin = time.perf_counter()
+                try:
+                    messages = item.get("messages") or [{"role": "user", "content": item["prompt"]}]
+                    overrides = {k: item[k] for k in ("max_tokens", "temperature") if k in item}
+                    completion = await engine.create(messages, item.get("model"), **overrides)
+                    result["model"] = completion.model
+                    result["response"] = completion.choices[0].message.content
+                    if completion.usage is not None:
+                        result["usage"] = completion.usage.model_dump()
+                        stats["tokens"] += completion.usage.total_tokens
+                    stats["ok"] += 1
+                except Exception as e:
+                    result["error"] = str(e)
+                    stats["failed"] += 1
+                result["latency"] = round(time.perf_counter() - begin, 3)
+                write(result)
+        
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        with open(input_path, 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    if not isinstance(item, dict):
+                        raise ValueError("每行应为一个 JSON 对象")
+                    item.setdefault("id", number)
+                    if item["id"] in done:
+                        continue
+                except (ValueError, TypeError) as e:
+                    # TypeError：id 为列表、对象等不可哈希的值
+                    stats["failed"] += 1
+                    write({"id": number, "error": f"第 {number} 行无效: {e}"})
+                    continue
+                await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    
+    return stats["ok"], stats["failed"], stats["tokens"], time.perf_counter() - started
+
+def batch_main(argv):
+    """批量模式入口：python openrouter_chat.py batch INPUT OUTPUT"""
+    parser = argparse.ArgumentParser(prog="openrouter_chat.py batch", description="使用已保存的配置批量运行 JSONL 提示")
+    parser.add_argument("input", help="输入 JSONL 文件")
+    parser.add_argument("output", help="输出 JSONL 文件（已存在时断点续跑）")
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="并发请求数（默认 8）")
+    parser.add_argument("--config", default="chat_config.json", help="配置文件路径")
+    args = parser.parse_args(argv)
+    
+    config = read_config(args.config)
+    if not config["api_key"]:
+        print("错误: 配置文件中没有 API Key")
+        return 1
+    
+    async def run():
+        engine = ChatEngine.from_config(config)
+        try:
+            return await run_batch(engine, args.input, args.output, args.concurrency)
+        finally:
+            await engine.aclose()
+    
+    ok, failed, tokens, elapsed = asyncio.run(run())
+    elapsed = max(elapsed, 1e-9)
+    print(f"完成 {ok} 条，失败 {failed} 条，耗时 {elapsed:.1f} 秒")
+    print(f"吞吐: {(ok + failed) / elapsed:.2f} 请求/秒, {tokens / elapsed:.1f} tokens/秒")
+    return 0 if failed == 0 else 1
+
+class ProxyServer:
+    """本地 OpenAI 兼容代理
+    
+    在本机提供 /v1/chat/completions（流式和非流式）和 /v1/models，所有请求经引擎的长连接池
+    转发到配置中的 base_url，并统一使用配置中的 API Key（忽略客户端的 Authorization）。
+    多个本地脚本因此共用已建立的连接、调度器的限速和回复缓存：同时发往上游的请求不超过
+    连接池大小，其余在本地排队；可重试的错误按引擎的策略重试，但不切换到备用模型。
+    每个本地连接一个协程，支持 HTTP/1.1 长连接；只应监听本机地址。
+    """
+    
+    # 只含这些字段的请求才使用回复缓存，与界面的缓存键相同
+    CACHEABLE_FIELDS = {"model", "messages", "temperature", "max_tokens", "stream", "stream_options"}
+    # 转发给本地客户端的上游响应头
+    FORWARD_HEADERS = ("content-type", "retry-after")
+    
+    def __init__(self, engine, host="127.0.0.1", port=8787):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.slots = asyncio.Semaphore(engine.max_connections)
+        self.server = None
+        self.connections = {}    # 处理中的本地连接：协程任务 -> writer
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        await self.server.serve_forever()
+
+    async def close(self):
+        """停止监听，关闭空闲的长连接并等待各连接的协程结束"""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        """处理一个本地连接上的若干请求"""
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split(None, 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = (headers.get("connection", "").lower() != "close"
+                              and version.strip().upper() != "HTTP/1.0")
+                if "chunked" in headers.get("transfer-encoding", "").lower():
+                    await self.send_error(writer, 411, "chunked request bodies are not supported", False)
+                    break
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                
+                path = target.split("?")[0]
+                path = path[3:] if path.startswith("/v1/") else path
+                if method == "GET" and path == "/models":
+                    keep_alive = await self.forward_models(writer, keep_alive)
+                elif method == "POST" and path == "/chat/completions":
+                    keep_alive = await self.forward_chat(writer, body, keep_alive)
+                else:
+                    await self.send_error(writer, 404, "not found", keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            writer.close()
+
+    async def send(self, writer, status, body, headers=None, keep_alive=True):
+        """发送一个完整的响应"""
+        headers = dict(headers or {})
+        headers.setdefault("content-type", "application/json")
+        headers["content-length"] = str(len(body))
+        headers["connection"] = "keep-alive" if keep_alive else "close"
+        writer.write(self.status_line(status) + self.header_lines(headers) + body)
+        await writer.drain()
+
+    async def send_error(self, writer, status, message, keep_alive=True):
+        body = json.dumps({"error": {"message": message, "code": status}}, ensure_ascii=False).encode("utf-8")
+        await self.send(writer, status, body, keep_alive=keep_alive)
+
+    @staticmethod
+    def status_line(status):
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ""
+        return f"HTTP/1.1 {status} {reason}\r\n".encode("latin-1")
+
+    @staticmethod
+    def header_lines(headers):
+        return "".join(f"{name}: {value}\r\n" for name, value in headers.items()).encode("latin-1") + b"\r\n"
+
+    def upstream_headers(self, response):
+        return {name: value for name, value in response.headers.items()
+                if name in self.FORWARD_HEADERS or name.startswith("x-ratelimit-")}
+
+    async def forward_models(self, writer, keep_alive):
+        """转发模型列表"""
+        try:
+            response = await self.engine.client.get("/models", cast_to=httpx.Response)
+        except APIStatusError as e:
+            await self.send(writer, e.status_code, e.response.content, self.upstream_headers(e.response), keep_alive)
+        except Exception as e:
+            await self.send_error(writer, 502, f"上游请求失败: {e}", keep_alive)
+        else:
+            await self.send(writer, response.status_code, response.content, self.upstream_headers(response), keep_alive)
+        return keep_alive
+
+    def cache_key(self, request):
+        """可缓存时返回缓存键（与界面相同的规则和键），否则返回 None"""
+        engine = self.engine
+        if engine.cache is None or set(request) - self.CACHEABLE_FIELDS:
+            return None
+        params = {field: request.get(field) for field in ("model", "messages", "temperature", "max_tokens")}
+        if engine.cache_models and params["model"] not in engine.cache_models:
+            return None
+        if engine.cache_zero_temperature_only and params["temperature"] != 0:
+            return None
+        return ResponseCache.make_key(params)
+
+    async def forward_chat(self, writer, body, keep_alive):
+        """转发一次补全请求，返回连接是否可以继续使用"""
+        try:
+            request = json.loads(body)
+            model = request.setdefault("model", self.engine.model)
+            stream = bool(request.get("stream"))
+        except (ValueError, AttributeError):
+            await self.send_error(writer, 400, "请求体不是有效的 JSON 对象", keep_alive)
+            return keep_alive
+        
+        key = self.cache_key(request)
+        cached = self.engine.cache.get(key) if key else None
+        if cached is not None:
+            await self.send_cached(writer, model, cached, stream, keep_alive)
+            return keep_alive
+        
+        async def attempt(candidate):
+            return await self.engine.client.post("/chat/completions", cast_to=httpx.Response,
+                                                 body=request, stream=stream)
+        
+        # 同时发往上游的请求不超过连接池大小，多出的在这里排队
+        async with self.slots:
+            try:
+                used_model, response = await self.engine.with_failover(attempt, [model])
+            except APIStatusError as e:
+                await self.send(writer, e.status_code, e.response.content, self.upstream_headers(e.response), keep_alive)
+                return keep_alive
+            except Exception as e:
+                await self.send_error(writer, 502, f"上游请求失败: {e}", keep_alive)
+                return keep_alive
             
-            # 在主线程中更新 UI
-            self.root.after(0, lambda: self.handle_api_response(response))
+            if not stream:
+                await self.send(writer, response.status_code, response.content,
+                                self.upstream_headers(response), keep_alive)
+                if key:
+                    self.remember(key, response.content, stream)
+                return keep_alive
             
-        except Exception as e:
-            error_msg = f"API 调用失败: {str(e)}"
-            self.root.after(0, lambda: self.handle_api_error(error_msg))
+            # 流式：按收到的数据块原样转发（分块传输编码），需要缓存时同时保留一份
+            parts = [] if key else None
+            headers = dict(self.upstream_headers(response), **{"transfer-encoding": "chunked",
+                                                                "connection": "keep-alive" if keep_alive else "close"})
+            try:
+                writer.write(self.status_line(response.status_code) + self.header_lines(headers))
+                async for data in response.aiter_bytes():
+                    if parts is not None:
+                        parts.append(data)
+                    writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+                    await writer.drain()
+            except httpx.HTTPError:
+                # 上游中途断开：关闭本地连接，让客户端知道回复不完整
+                return False
+            finally:
+                await response.aclose()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        if parts is not None:
+            self.remember(key, b"".join(parts), stream)
+        return keep_alive
 
-    def handle_api_response(self, response):
-        """处理 API 响应"""
-        self.add_message("助手", response, "assistant")
-        self.send_button.config(state="normal", text="发送\n(Ctrl+Enter)")
+    def remember(self, key, body, stream):
+        """从上游的响应中取出回复文本存入缓存；带工具调用或没有文本的回复不缓存"""
+        parts = []
+        try:
+            if stream:
+                for line in body.decode("utf-8").splitlines():
+                    if not line.startswith("data:") or line[5:].strip() == "[DONE]":
+                        continue
+                    for choice in json.loads(line[5:]).get("choices") or ():
+                        delta = choice.get("delta") or {}
+                        if delta.get("tool_calls"):
+                            return
+                        parts.append(delta.get("content") or "")
+            else:
+                message = json.loads(body)["choices"][0]["message"]
+                if message.get("tool_calls"):
+                    return
+                parts.append(message.get("content") or "")
+        except (ValueError, KeyError, IndexError, TypeError):
+            return
+        if "".join(parts):
+            self.engine.cache.put(key, "".join(parts))
 
-    def handle_api_error(self, error_msg):
-        """处理 API 错误"""
-        self.add_message("错误", error_msg, "error")
-        self.send_button.config(state="normal", text="发送\n(Ctrl+Enter)")
+    async def send_cached(self, writer, model, content, stream, keep_alive):
+        """以上游相同的格式返回缓存的回复"""
+        base = {"id": "cache", "created": int(time.time()), "model": model}
+        headers = {"x-cache": "HIT"}
+        if not stream:
+            body = dict(base, object="chat.completion",
+                        choices=[{"index": 0, "message": {"role": "assistant", "content": content},
+                                  "finish_reason": "stop"}])
+            await self.send(writer, 200, json.dumps(body, ensure_ascii=False).encode("utf-8"), headers, keep_alive)
+            return
+        chunks = [dict(base, object="chat.completion.chunk",
+                       choices=[{"index": 0, "delta": {"role": "assistant", "content": content}, "finish_reason": None}]),
+                  dict(base, object="chat.completion.chunk",
+                       choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])]
+        events = "".join(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n" for chunk in chunks) + "data: [DONE]\n\n"
+        await self.send(writer, 200, events.encode("utf-8"), dict(headers, **{"content-type": "text/event-stream"}), keep_alive)
 
-    def clear_chat(self):
-        """清空聊天记录"""
-        if messagebox.askyesno("确认", "确定要清空所有聊天记录吗？"):
-            self.chat_display.config(state=tk.NORMAL)
-            self.chat_display.delete("1.0", tk.END)
-            self.chat_display.config(state=tk.DISABLED)
-            self.chat_history = []
-            self.add_message("系统", "聊天记录已清空", "system")
+def serve_main(argv):
+    """代理模式入口：python openrouter_chat.py serve [--port 8787]"""
+    parser = argparse.ArgumentParser(prog="openrouter_chat.py serve",
+                                     description="在本机提供 OpenAI 兼容接口，经共享的连接池和缓存转发到配置中的上游")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认只监听本机）")
+    parser.add_argument("--port", type=int, default=8787, help="监听端口（默认 8787）")
+    parser.add_argument("--config", default="chat_config.json", help="配置文件路径")
+    args = parser.parse_args(argv)
+    
+    config = read_config(args.config)
+    if not config["api_key"]:
+        print("错误: 配置文件中没有 API Key")
+        return 1
+    
+    async def run():
+        engine = ChatEngine.from_config(config)
+        server = await ProxyServer(engine, args.host, args.port).start()
+        print(f"代理已启动: http://{args.host}:{server.port}/v1 -> {engine.base_url}  (Ctrl+C 退出)")
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+            await engine.aclose()
+    
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
 
 def main():
     """主函数"""
@@ -582,9 +4321,14 @@ def main():
         root = tk.Tk()
         app = ChatApp(root)
         root.mainloop()
+        app.shutdown()
         
     except Exception as e:
         messagebox.showerror("启动错误", f"应用启动失败:\n{str(e)}")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        sys.exit(serve_main(sys.argv[2:]))
     main()